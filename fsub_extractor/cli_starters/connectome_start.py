@@ -0,0 +1,205 @@
+import argparse
+import os.path as op
+from os import getcwd
+from pathlib import Path
+from fsub_extractor.functions.connectome import connectome
+
+
+# Add input arguments
+def get_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Extracts the sub-bundle connecting every pair of labels in an atlas (e.g., a functional parcellation projected with project_rois_batch), with one assignment pass and one pass over the tract file."
+    )
+    parser.add_argument(
+        "--subject",
+        help="Subject name.",
+        required=True,
+        metavar=("sub-XXX"),
+    )
+    parser.add_argument(
+        "--tract",
+        help="Path to original tract file (.tck or .trk). Should be in the same space as the atlas.",
+        type=validate_file,
+        required=True,
+        metavar=("/PATH/TO/TRACT.trk|.tck"),
+        action=CheckExt({".trk", ".tck"}),
+    )
+    parser.add_argument(
+        "--tract-name",
+        "--tract_name",
+        help="Label for tract used in file names. Should not contain spaces. E.g., 'LeftAF' or 'wholebrain'. Default is 'tract'.",
+        default="tract",
+    )
+    parser.add_argument(
+        "--atlas",
+        help="Path to integer-labelled atlas (.nii.gz, .nii, or .mif). Labels are 1..N, with 0 as background.",
+        type=validate_file,
+        required=True,
+        metavar=("/PATH/TO/ATLAS.nii.gz|.nii|.mif"),
+        action=CheckExt({".nii.gz", ".nii", ".mif"}),
+    )
+    parser.add_argument(
+        "--atlas-name",
+        "--atlas_name",
+        help="Label for atlas used in file names. Default is 'atlas'.",
+        default="atlas",
+    )
+    parser.add_argument(
+        "--atlas-table",
+        "--atlas_table",
+        help="Path to label table (.tsv with 'index' and 'name' columns, as written by project_rois_batch). If supplied, label names are used in file names instead of label numbers.",
+        type=validate_file,
+        metavar=("/PATH/TO/ATLAS.tsv"),
+        action=CheckExt({".tsv"}),
+    )
+    parser.add_argument(
+        "--edges",
+        help="Comma delimited list (no spaces) of label pairs to extract, e.g. '1-2,1-3'. Default is every pair of labels connected by at least one streamline.",
+        metavar=("LABEL-LABEL,LABEL-LABEL"),
+    )
+    parser.add_argument(
+        "--include-self",
+        "--include_self",
+        help="Also extract streamlines that start and end in the same label (when --edges is not given).",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--search-dist",
+        "--search_dist",
+        help="Distance in mm to search from streamlines for ROIs (float). Default is 2.0 mm. Ignored if --search-type is 'end' or 'all'.",
+        type=check_positive_float,
+        default=2.0,
+        metavar=("DISTANCE"),
+    )
+    parser.add_argument(
+        "--search-type",
+        "--search_type",
+        choices=["forward", "radial", "reverse", "end", "all"],
+        help="Method of searching for streamlines (see documentation for MRTrix3 'tck2connectome'). Default is radial.",
+        default="radial",
+    )
+    parser.add_argument(
+        "--sift2-weights",
+        "--sift2_weights",
+        help="Path to SIFT2 weights file corresponding to input tract. If supplied, weights are saved for each edge along with a matrix of summed weights.",
+        type=validate_file,
+        metavar=("/PATH/TO/SIFT2_WEIGHTS.csv|.txt"),
+        action=CheckExt({".csv", ".txt"}),
+    )
+    parser.add_argument(
+        "--native-assignment",
+        "--native_assignment",
+        help="Whether to assign streamlines to labels in-process (for the 'radial' and 'end' search types with NIFTI atlases) instead of with MRtrix tck2connectome. Default is to assign in-process.",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+    )
+    parser.add_argument(
+        "--max-open-files",
+        "--max_open_files",
+        help="Maximum number of output files to keep open at once while writing sub-bundles (int). Default is 64.",
+        type=check_positive_int,
+        default=64,
+    )
+    parser.add_argument(
+        "--membership",
+        help="Also save which streamlines reach each label (_desc-membership.npz), so combinations of labels (e.g., reaching A and B but not C) can later be extracted with query_bundles without another pass over the tract file.",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--binary-assignments",
+        "--binary_assignments",
+        help="Save the streamline-to-label assignments and connectome as binary .npy files (int16/int32 pairs) instead of text. These are much smaller and faster to read for large tractograms.",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--out-dir",
+        "--out_dir",
+        help="Directory where outputs will be stored (a subject-folder will be created there if it does not exist). Default is current directory.",
+        type=op.abspath,
+        default=getcwd(),
+        metavar=("/PATH/TO/OUTDIR/"),
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Whether to overwrite outputs. Default is to overwrite.",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+    )
+
+    return parser
+
+
+# Check that files exist
+def validate_file(arg):
+    if (file := Path(arg)).is_file():
+        return op.abspath(file)
+    else:
+        raise FileNotFoundError(arg)
+
+
+# Function for checking file extensions
+def CheckExt(choices):
+    class Act(argparse.Action):
+        def __call__(self, parser, namespace, fname, option_string=None):
+            file_has_valid_ext = False
+            for choice in choices:
+                len_ext = len(choice)
+                if fname[(-1 * len_ext) :] == choice:
+                    file_has_valid_ext = True
+                    break
+
+            if file_has_valid_ext == False:
+                option_string = "({})".format(option_string) if option_string else ""
+                parser.error(
+                    "file doesn't end with one of {}{}".format(choices, option_string)
+                )
+            else:
+                setattr(namespace, self.dest, fname)
+
+    return Act
+
+
+# Check for positive values
+def check_positive_float(value):
+    value = float(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("%s is not positive" % value)
+    return value
+
+
+def check_positive_int(value):
+    value = int(value)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("%s is not positive" % value)
+    return value
+
+
+def main():
+
+    # Parse arguments and run the main code
+    parser = get_parser()
+    args = parser.parse_args()
+
+    main = connectome(
+        subject=args.subject,
+        tract=args.tract,
+        atlas=args.atlas,
+        tract_name=args.tract_name,
+        atlas_name=args.atlas_name,
+        atlas_table=args.atlas_table,
+        edges=args.edges,
+        search_dist=args.search_dist,
+        search_type=args.search_type,
+        sift2_weights=args.sift2_weights,
+        native_assignment=args.native_assignment,
+        include_self=args.include_self,
+        max_open_files=args.max_open_files,
+        membership=args.membership,
+        binary_assignments=args.binary_assignments,
+        out_dir=args.out_dir,
+        overwrite=args.overwrite,
+    )
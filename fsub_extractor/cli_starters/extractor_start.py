@@ -2,7 +2,7 @@ import argparse
 import os.path as op
 from os import getcwd
 from pathlib import Path
-from fsub_extractor.functions.extractor import extractor
+from fsub_extractor.functions.sweep import extractor_sweep
 
 # Add input arguments
 def get_parser():
@@ -87,10 +87,24 @@ def get_parser():
     parser.add_argument(
         "--projfrac-params",
         "--projfrac_params",
-        help="Comma delimited list (no spaces) of projfrac parameters for mri_surf2vol / mri_label2vol. Provided as start,stop,delta. Default is --projfrac-params='-1,0,0.05'. Start must be negative to project into white matter.",
+        help="Comma delimited list (no spaces) of projfrac parameters for mri_surf2vol / mri_label2vol. Provided as start,stop,delta. Default is --projfrac-params='-1,0,0.05'. Start must be negative to project into white matter. Several sets of parameters can be separated by semicolons to sweep them, e.g. --projfrac-params='-1,0,0.05;-0.5,0,0.05' (see --gmwmi-thresh).",
         default="-1,0,0.05",
         metavar=("START,STOP,DELTA"),
     )
+    parser.add_argument(
+        "--projection-backend",
+        "--projection_backend",
+        choices=["operator", "native", "freesurfer"],
+        help="How to project ROIs into white matter. 'operator' builds a projection operator once per subject, hemisphere and --projfrac-params with mri_surf2vol (cached in the output func folder) and reuses it for every ROI. 'native' builds the operator in Python and also samples volumetric ROIs onto the surface in Python, so no FreeSurfer binaries are needed for projection. 'freesurfer' runs mri_label2vol / mri_surf2vol for every ROI. The operators fill each voxel from the last vertex projected into it, as mri_surf2vol does, so .label ROIs can cover fewer voxels than with mri_label2vol, which fills a voxel if any label vertex projects into it. Default is 'freesurfer'.",
+        default="freesurfer",
+    )
+    parser.add_argument(
+        "--roi-resampling",
+        "--roi_resampling",
+        choices=["composed", "mrtrix"],
+        help="How to bring projected ROIs into DWI space and intersect them with the GMWMI. 'composed' combines the registration with the GMWMI grid and resamples each ROI once (nearest neighbour), in Python. 'mrtrix' runs mrtransform, mrgrid and mrcalc for every ROI. .mif inputs always use 'mrtrix'. Default is 'mrtrix'.",
+        default="mrtrix",
+    )
     parser.add_argument(
         "--fivett",
         help="Path to 5TT image (.nii.gz or .mif). Skips making it from FreeSurfer inputs. This is used if you opt to intersect ROIs with the GMWMI, and/or an FSuB is being generated (--generate).",
@@ -101,9 +115,10 @@ def get_parser():
     parser.add_argument(
         "--gmwmi-thresh",
         "--gmwmi_thresh",
-        help="Threshold above which to binarize the GMWMI image. Default is 0.0",
+        help="Threshold above which to binarize the GMWMI image. Default is 0.0. Several space-separated values can be given to sweep them: each combination of --gmwmi-thresh and --projfrac-params values is then run in its own sweep-XX folder of the output directory (listed in {subject}_desc-sweep.tsv), sharing the 5TT image.",
         type=check_positive_float,
         default=0.0,
+        nargs="+",
         metavar=("THRESHOLD"),
     )
     parser.add_argument(
@@ -135,12 +150,23 @@ def get_parser():
         default=getcwd(),
         metavar=("/PATH/TO/OUTDIR/"),
     )
+    parser.add_argument(
+        "--nthreads",
+        help="Number of threads to use for multi-threaded steps. Default is to let each program decide.",
+        type=check_positive_int,
+        metavar=("N"),
+    )
     parser.add_argument(
         "--overwrite",
         help="Whether to overwrite outputs. Default is to overwrite.",
         default=True,
         action=argparse.BooleanOptionalAction,
     )
+    parser.add_argument(
+        "--resume",
+        help="Skip steps whose outputs are up to date, as recorded in {out_dir}/{subject}/{subject}_desc-manifest.json (like make). A step reruns, overwriting its outputs, if its parameters or any of its input or output files changed since it last ran.",
+        action="store_true",
+    )
 
     # Streamline masking arguments
     mask_group = parser.add_argument_group("Options for Streamline Masking")
@@ -163,7 +189,7 @@ def get_parser():
     mask_group.add_argument(
         "--streamline-mask",
         "--streamline_mask",
-        help="Path to streamline mask (.nii.gz or .mif). If specified, streamlines exiting this mask will be truncated. Must be in DWI space.",
+        help="Path to streamline mask (.nii.gz or .mif). If specified, streamlines exiting this mask will be truncated (when extracting, only together with --exclude-mask or --include-mask, as with tckedit). Must be in DWI space.",
         type=validate_file,
         metavar=("/PATH/TO/STREAMLINE_MASK.nii.gz|.mif"),
         action=CheckExt({".nii.gz", ".mif"}),
@@ -174,17 +200,17 @@ def get_parser():
     reg_dir_group = reg_group.add_mutually_exclusive_group()
     reg_dir_group.add_argument(
         "--fs2dwi",
-        help="Path to MRTrix-ready or ANTs/ITK-generated registration for mapping FreeSurfer-to-DWI space. Mutually exclusive with --dwi2fs.",
+        help="Path to MRTrix-ready or ANTs/ITK-generated (.txt or .mat) registration for mapping FreeSurfer-to-DWI space. Mutually exclusive with --dwi2fs.",
         type=validate_file,
         metavar=("/PATH/TO/FS2DWI-REG.txt"),
-        action=CheckExt({".txt"}),
+        action=CheckExt({".txt", ".mat"}),
     )
     reg_dir_group.add_argument(
         "--dwi2fs",
-        help="Path to MRTrix-ready or ANTs/ITK-generated registration for mapping DWI-to-FreeSurfer space. Mutually exclusive with --fs2dwi.",
+        help="Path to MRTrix-ready or ANTs/ITK-generated (.txt or .mat) registration for mapping DWI-to-FreeSurfer space. Mutually exclusive with --fs2dwi.",
         type=validate_file,
         metavar=("/PATH/TO/DWI2FS-REG.txt"),
-        action=CheckExt({".txt"}),
+        action=CheckExt({".txt", ".mat"}),
     )
     reg_group.add_argument(
         "--reg-type",
@@ -198,17 +224,19 @@ def get_parser():
     ext_args.add_argument(
         "--search-dist",
         "--search_dist",
-        help="Distance in mm to search from streamlines for ROIs (float). Default is 2.0 mm. Ignored if --search-type is 'end' or 'all'.",
+        help="Distance in mm to search from streamlines for ROIs (float). Default is 2.0 mm. Ignored if --search-type is 'end' or 'all'. Several space-separated values can be given to sweep them: for 'radial' and 'end' searches, all of them are assigned with a single nearest-ROI search, and outputs are labelled by setting (e.g., _desc-radial2p5mm).",
         type=check_positive_float,
         default=2.0,
+        nargs="+",
         metavar=("DISTANCE"),
     )
     ext_args.add_argument(
         "--search-type",
         "--search_type",
         choices=["forward", "radial", "reverse", "end", "all"],
-        help="Method of searching for streamlines (see documentation for MRTrix3 'tck2connectome'). Default is radial.",
+        help="Method of searching for streamlines (see documentation for MRTrix3 'tck2connectome'). Default is radial. Several space-separated values can be given to sweep them (see --search-dist).",
         default="radial",
+        nargs="+",
     )
     ext_args.add_argument(
         "--sift2-weights",
@@ -218,6 +246,69 @@ def get_parser():
         metavar=("/PATH/TO/SIFT2_WEIGHTS.csv|.txt"),
         action=CheckExt({".csv", ".txt"}),
     )
+    ext_args.add_argument(
+        "--native-extraction",
+        "--native_extraction",
+        help="Select and mask streamlines in-process, in a single pass over the tractogram, instead of with MRtrix connectome2tck and tckedit. Masks must be NIFTI files.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--native-assignment",
+        "--native_assignment",
+        help="Assign streamlines to ROIs in-process, with a KD-tree search over ROI voxels, instead of with MRtrix tck2connectome. Only applies to the 'radial' and 'end' search types with NIFTI ROIs.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--extraction-space",
+        "--extraction_space",
+        choices=["DWI", "FS", "auto"],
+        help="Space in which streamlines are assigned to ROIs when a registration is given. 'DWI' registers the 5TT, GMWMI and ROIs into DWI space. 'FS' instead transforms the tractogram into FreeSurfer space once and leaves all images unresampled; the sub-bundle is still extracted from the original (DWI space) tractogram. 'auto' picks whichever has less data to transform. Default is 'DWI'.",
+        default="DWI",
+    )
+    ext_args.add_argument(
+        "--cull",
+        help="Drop streamlines without an endpoint within --search-dist of any ROI's bounding box before passing the rest to tck2connectome. They are unassigned anyway, so this changes neither the extracted bundle nor the saved assignments and connectome, but the whole tractogram is read in Python to find them. Mostly useful with --endpoint-index or for tractograms much larger than the ROIs' reach.",
+        dest="cull_streamlines",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--endpoint-index",
+        "--endpoint_index",
+        help="Save an index of the tractogram's streamline endpoints in the output dwi folder, and use it to find streamlines near the ROIs. The index is built on the first run and reused by later runs on the same tractogram (e.g., with other ROIs), which then read only the streamlines near the ROIs. It is rebuilt if the tractogram changes. Implies --cull.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--virtual-output",
+        "--virtual_output",
+        help="Save the extracted sub-bundle as a selection of the input tractogram's streamlines (_selection.npz), instead of copying them into a .tck file. The selection refers to the input tractogram, which must be kept unchanged; it can be read directly by streamline_scalar and converted to .tck on demand. Implies --native-extraction, and is not possible with --streamline-mask.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--membership",
+        help="Also save which streamlines of the input tractogram reach each ROI (_desc-membership.npz), so combinations of ROIs can later be extracted with query_bundles without another pass over the tractogram.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--binary-assignments",
+        "--binary_assignments",
+        help="Save the streamline-to-ROI assignments and connectome as binary .npy files (int16/int32 pairs) instead of text. These are much smaller and faster to read for large tractograms. Implies --native-extraction.",
+        default=False,
+        action="store_true",
+    )
+    ext_args.add_argument(
+        "--extraction-shards",
+        "--extraction_shards",
+        help="Split the tractogram into K contiguous shards, and assign and select their streamlines in K parallel processes. The outputs are merged in the original streamline order and match those of an unsharded run. Needs the 'radial' or 'end' search type and NIFTI ROIs and masks. Default is 1 (no sharding).",
+        type=check_positive_int,
+        metavar=("K"),
+        default=1,
+    )
 
     # Generator-specific arguments
     gen_args = parser.add_argument_group("Options Specific to Streamline Generator")
@@ -245,6 +336,55 @@ def get_parser():
         action=CheckExt({".txt"}),
     )
 
+    gen_args.add_argument(
+        "--n-shards",
+        "--n_shards",
+        help="Number of tckgen processes to split streamline generation across. Shards run concurrently and are merged into one output. Default is 1.",
+        type=check_positive_int,
+        metavar=("K"),
+        default=1,
+    )
+    gen_args.add_argument(
+        "--seed",
+        help="Random seed for streamline generation. Each shard is seeded with SEED plus its shard number (with two ROIs, the second direction uses a seed derived from SEED). Default is a random seed, which is printed to the log.",
+        type=int,
+        metavar=("SEED"),
+    )
+    gen_args.add_argument(
+        "--pilot-seeds",
+        "--pilot_seeds",
+        help="Number of seeds for a pilot tckgen run that estimates the acceptance rate. The main run is then capped at a multiple of the expected number of seeds, so poorly connected ROIs cannot stall generation. Default is no pilot.",
+        type=check_positive_int,
+        metavar=("N"),
+    )
+    gen_args.add_argument(
+        "--time-budget",
+        "--time_budget",
+        help="Approximate maximum time in seconds for streamline generation in each direction, enforced as a seed cap extrapolated from a pilot run. Default is no time limit.",
+        type=check_positive_float,
+        metavar=("SECONDS"),
+    )
+    gen_args.add_argument(
+        "--adaptive",
+        help="Generate streamlines in increments until the distribution of streamline endpoints converges, treating --n-streamlines as a maximum. Default is to generate exactly --n-streamlines.",
+        default=False,
+        action="store_true",
+    )
+    gen_args.add_argument(
+        "--increment",
+        help="Number of streamlines added per increment with --adaptive. Default is 500.",
+        type=check_positive_int,
+        metavar=("N"),
+        default=500,
+    )
+    gen_args.add_argument(
+        "--tolerance",
+        help="With --adaptive, stop once the estimated error of the endpoint distribution, as a total variation distance (0-1), falls below this. The error is estimated by comparing two independent halves of the streamlines. Default is 0.05.",
+        type=check_positive_float,
+        metavar=("TOLERANCE"),
+        default=0.05,
+    )
+
     # Visualization arguments
     viz_args = parser.add_argument_group("Options for Visualization")
     viz_args.add_argument(
@@ -404,7 +544,7 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    main = extractor(
+    main = extractor_sweep(
         subject=args.subject,
         tract=args.tract,
         generate=args.generate,
@@ -417,6 +557,8 @@ def main():
         fs_dir=args.fs_dir,
         # fs_license=args.fs_license,
         projfrac_params=args.projfrac_params,
+        projection_backend=args.projection_backend,
+        roi_resampling=args.roi_resampling,
         fivett=args.fivett,
         gmwmi_thresh=args.gmwmi_thresh,
         skip_fivett_registration=args.skip_fivett_registration,
@@ -424,18 +566,36 @@ def main():
         skip_gmwmi_intersection=args.skip_gmwmi_intersection,
         out_dir=args.out_dir,
         overwrite=args.overwrite,
+        resume=args.resume,
         exclude_mask=args.exclude_mask,
         include_mask=args.include_mask,
         streamline_mask=args.streamline_mask,
         fs2dwi=args.fs2dwi,
         dwi2fs=args.dwi2fs,
         reg_type=args.reg_type,
-        search_dist=str(args.search_dist),
-        search_type=str(args.search_type),
+        search_dist=args.search_dist,
+        search_type=args.search_type,
         sift2_weights=args.sift2_weights,
+        native_extraction=args.native_extraction,
+        native_assignment=args.native_assignment,
+        extraction_space=args.extraction_space,
+        cull_streamlines=args.cull_streamlines,
+        endpoint_index=args.endpoint_index,
+        virtual_output=args.virtual_output,
+        membership=args.membership,
+        binary_assignments=args.binary_assignments,
+        extraction_shards=args.extraction_shards,
         wmfod=args.wmfod,
         n_streamlines=args.n_streamlines,
         tckgen_params=args.tckgen_params,
+        n_shards=args.n_shards,
+        nthreads=args.nthreads,
+        seed=args.seed,
+        pilot_seeds=args.pilot_seeds,
+        time_budget=args.time_budget,
+        adaptive=args.adaptive,
+        increment=args.increment,
+        tolerance=args.tolerance,
         make_viz=args.make_viz,
         interactive_viz=args.interactive_viz,
         img_viz=args.img_viz,
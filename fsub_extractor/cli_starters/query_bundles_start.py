@@ -0,0 +1,96 @@
+import argparse
+import os.path as op
+from pathlib import Path
+from fsub_extractor.functions.query_bundles import query_bundles
+
+
+# Add input arguments
+def get_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Extracts a combination of ROIs (e.g., streamlines reaching ROI A and ROI B but not ROI C) from the ROI membership saved by extractor or connectome with --membership, without another pass over the tract file."
+    )
+    parser.add_argument(
+        "--membership",
+        help="Path to membership file (_desc-membership.npz) saved by extractor or connectome with --membership.",
+        type=validate_file,
+        required=True,
+        metavar=("/PATH/TO/MEMBERSHIP.npz"),
+        action=CheckExt({".npz"}),
+    )
+    parser.add_argument(
+        "--query",
+        help="Combination of ROIs to extract, by name (as in the file names) or label, with '&' (and), '|' (or), '~' (not) and parentheses. E.g., 'V1 & MT & ~FEF' or '(1 | 2) & 3'. Quote the query in the shell.",
+        required=True,
+        metavar=("'ROI & ROI & ~ROI'"),
+    )
+    parser.add_argument(
+        "--out-file",
+        "--out_file",
+        help="Path to output sub-bundle (.tck), or to a virtual sub-bundle (_selection.npz) that refers to the original tract file instead of copying streamlines.",
+        type=op.abspath,
+        required=True,
+        metavar=("/PATH/TO/OUTPUT.tck|_selection.npz"),
+        action=CheckExt({".tck", ".npz"}),
+    )
+    parser.add_argument(
+        "--sift2-weights",
+        "--sift2_weights",
+        help="Path to SIFT2 weights file corresponding to the original tract file. If supplied, the weights of the extracted streamlines are saved next to the output.",
+        type=validate_file,
+        metavar=("/PATH/TO/SIFT2_WEIGHTS.csv|.txt"),
+        action=CheckExt({".csv", ".txt"}),
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Whether to overwrite outputs. Default is to overwrite.",
+        default=True,
+        action=argparse.BooleanOptionalAction,
+    )
+
+    return parser
+
+
+# Check that files exist
+def validate_file(arg):
+    if (file := Path(arg)).is_file():
+        return op.abspath(file)
+    else:
+        raise FileNotFoundError(arg)
+
+
+# Function for checking file extensions
+def CheckExt(choices):
+    class Act(argparse.Action):
+        def __call__(self, parser, namespace, fname, option_string=None):
+            file_has_valid_ext = False
+            for choice in choices:
+                len_ext = len(choice)
+                if fname[(-1 * len_ext) :] == choice:
+                    file_has_valid_ext = True
+                    break
+
+            if file_has_valid_ext == False:
+                option_string = "({})".format(option_string) if option_string else ""
+                parser.error(
+                    "file doesn't end with one of {}{}".format(choices, option_string)
+                )
+            else:
+                setattr(namespace, self.dest, fname)
+
+    return Act
+
+
+def main():
+
+    # Parse arguments and run the main code
+    parser = get_parser()
+    args = parser.parse_args()
+
+    main = query_bundles(
+        membership=args.membership,
+        query=args.query,
+        out_file=args.out_file,
+        sift2_weights=args.sift2_weights,
+        overwrite=args.overwrite,
+    )
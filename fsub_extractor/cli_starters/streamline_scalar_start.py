@@ -18,11 +18,11 @@ def get_parser():
     )
     parser.add_argument(
         "--tract",
-        help="Path to tract file (.tck or .trk). Should be in the same space as the scalar map inputs.",
+        help="Path to tract file (.tck or .trk), or a virtual sub-bundle (_selection.npz) saved by the extractor with --virtual-output. Should be in the same space as the scalar map inputs.",
         type=validate_file,
         required=True,
-        metavar=("/PATH/TO/TRACT.trk|.tck"),
-        action=CheckExt({".trk", ".tck"}),
+        metavar=("/PATH/TO/TRACT.trk|.tck|.npz"),
+        action=CheckExt({".trk", ".tck", ".npz"}),
     )
     parser.add_argument(
         "--scalar_paths",
@@ -62,6 +62,14 @@ def get_parser():
         default=100,
         metavar=("POINTS"),
     )
+    parser.add_argument(
+        "--sift2-weights",
+        "--sift2_weights",
+        help="Path to SIFT2 weights corresponding to the tract (e.g., the weights file written with an extracted FSuB). If supplied, tract profiles and summary statistics are SIFT2-weighted.",
+        type=validate_file,
+        metavar=("/PATH/TO/SIFT2_WEIGHTS.csv|.txt|.npy"),
+        action=CheckExt({".csv", ".txt", ".npy"}),
+    )
     parser.add_argument(
         "--out-dir",
         "--out_dir",
@@ -143,4 +151,5 @@ def main():
         out_prefix=args.out_prefix,
         overwrite=args.overwrite,
         n_points=args.n_points,
+        sift2_weights=args.sift2_weights,
     )
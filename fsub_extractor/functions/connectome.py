@@ -0,0 +1,121 @@
+import os
+import os.path as op
+from fsub_extractor.utils.streamline_utils import trk_to_tck, extract_connectome
+
+
+def connectome(
+    subject,
+    tract,
+    atlas,
+    tract_name,
+    atlas_name,
+    atlas_table,
+    edges,
+    search_dist,
+    search_type,
+    sift2_weights,
+    native_assignment,
+    include_self,
+    max_open_files,
+    membership,
+    binary_assignments,
+    out_dir,
+    overwrite,
+):
+    """Extracts the FSuB of every pair of labels in an atlas in one run
+    Parameters
+    ==========
+    subject: str
+        Subject name
+    tract: str
+        Path to tract input (.tck or .trk), in the same space as the atlas
+    atlas: str
+        Path to integer-labelled atlas (.nii.gz, .nii or .mif), e.g. from project_rois_batch
+    tract_name: str
+        Label for tract used in file names
+    atlas_name: str
+        Label for atlas used in file names
+    atlas_table: str
+        Path to a label table (.tsv with 'index' and 'name' columns) used to name outputs, or None to use label numbers
+    edges: str
+        Comma delimited list of label pairs to extract (e.g. '1-2,1-3'), or None for every connected pair
+    search_dist: float
+        How far to search ahead of streamlines for ROIs, in mm
+    search_type: str
+        Method of searching for streamlines (forward, reverse, radial, end, or all)
+    sift2_weights: str
+        Path to SIFT2 weights file for the tract
+    native_assignment: bool
+        Assign streamlines to labels in-process where possible, instead of with tck2connectome
+    include_self: bool
+        Whether to extract streamlines that start and end in the same label (only when edges is None)
+    max_open_files: int
+        Maximum number of output files open at once
+    membership: bool
+        Whether to save which streamlines reach each label, for later queries with query_bundles
+    binary_assignments: bool
+        Whether to save the assignments and connectome as binary .npy files instead of text
+    out_dir: str
+        Path to output directory
+    overwrite: bool
+        Whether to overwrite existing files
+
+    Outputs
+    =======
+    Function returns a dict mapping each (label, label) edge to its extracted .tck file
+    See extract_connectome for the outputs saved to {out_dir}/{subject}/dwi
+    """
+    # Force start log outputs on new line
+    print("\n")
+
+    dwi_out_dir = op.join(out_dir, subject, "dwi")
+    os.makedirs(dwi_out_dir, exist_ok=True)
+
+    ### Convert .trk to .tck if needed ###
+    if op.splitext(tract)[-1] == ".trk":
+        print("\n Converting .trk to .tck \n")
+        tck_file = trk_to_tck(tract, dwi_out_dir, overwrite=overwrite)
+    else:
+        tck_file = tract
+
+    # Read label names, if given
+    node_names = None
+    if atlas_table != None:
+        node_names = {}
+        with open(atlas_table) as f:
+            columns = f.readline().rstrip("\n").split("\t")
+            for line in f:
+                values = dict(zip(columns, line.rstrip("\n").split("\t")))
+                node_names[int(values["index"])] = values["name"]
+
+    # Parse requested edges
+    if edges != None:
+        edges = [[int(node) for node in edge.split("-")] for edge in edges.split(",")]
+        for edge in edges:
+            if len(edge) != 2:
+                raise Exception(
+                    "Edges must be given as pairs of labels, e.g. --edges 1-2,1-3."
+                )
+
+    print("\n Extracting sub-bundles for every edge of the atlas \n")
+    edge_files = extract_connectome(
+        tck_file,
+        atlas,
+        outpath_base=op.join(dwi_out_dir, f"{subject}_{tract_name}_{atlas_name}"),
+        edges=edges,
+        node_names=node_names,
+        search_dist=search_dist,
+        search_type=search_type,
+        sift2_weights=sift2_weights,
+        native_assignment=native_assignment,
+        include_self=include_self,
+        max_open_files=max_open_files,
+        membership=membership,
+        binary_assignments=binary_assignments,
+        overwrite=overwrite,
+    )
+
+    print(f"\n The extracted tracts are located in {dwi_out_dir}.\n")
+    print("\n DONE! \n")
+
+    return edge_files
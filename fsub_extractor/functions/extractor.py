@@ -1,6 +1,7 @@
 import os.path as op
 import warnings
-from numpy import unique
+from numpy import unique, prod
+from numpy.random import SeedSequence
 from fsub_extractor.utils.anat_utils import *
 from fsub_extractor.utils.system_utils import *
 from fsub_extractor.utils.froi_utils import *
@@ -20,6 +21,8 @@ def extractor(
     fs_dir,
     # fs_license,
     projfrac_params,
+    projection_backend,
+    roi_resampling,
     fivett,
     gmwmi_thresh,
     skip_fivett_registration,
@@ -27,6 +30,7 @@ def extractor(
     skip_gmwmi_intersection,
     out_dir,
     overwrite,
+    resume,
     exclude_mask,
     include_mask,
     streamline_mask,
@@ -36,9 +40,26 @@ def extractor(
     search_dist,
     search_type,
     sift2_weights,
+    native_extraction,
+    native_assignment,
+    extraction_space,
+    cull_streamlines,
+    endpoint_index,
+    virtual_output,
+    membership,
+    binary_assignments,
+    extraction_shards,
     wmfod,
     n_streamlines,
     tckgen_params,
+    n_shards,
+    nthreads,
+    seed,
+    pilot_seeds,
+    time_budget,
+    adaptive,
+    increment,
+    tolerance,
     make_viz,
     interactive_viz,
     img_viz,
@@ -51,10 +72,18 @@ def extractor(
     axial_offset,
     saggital_offset,
     camera_angle,
+    shared_stages=None,
 ):
     # Force start log outputs on new line
     print("\n")
 
+    # Outputs of stages that an earlier run (e.g., of a sweep) already made for this subject are reused as they are:
+    # 'reg' (registration in MRtrix format), 'gmwmi' (5TT, GMWMI and binarized GMWMI in FreeSurfer space) and
+    # 'rois' (ROIs projected into white matter, in FreeSurfer space). The outputs of these stages are returned.
+    if shared_stages == None:
+        shared_stages = {}
+    stages = {}
+
     # Warn that generate function is still in beta
     if generate:
         warnings.warn(
@@ -88,6 +117,22 @@ def extractor(
                 f"If skipping ROI projection, all input ROIs must be .nii.gz files."
             )
 
+    # In-process extraction reads masks with nibabel, which does not support .mif
+    if native_extraction or virtual_output or binary_assignments:
+        for mask in [exclude_mask, include_mask, streamline_mask]:
+            if mask != None and mask[-4:] == ".mif":
+                raise Exception(
+                    f"Masks must be NIFTI files with --native-extraction, but {mask} is not."
+                )
+
+    # Search type 'all' assigns any number of nodes to a streamline, which only connectome2tck can select from
+    if "all" in (search_type if isinstance(search_type, list) else [search_type]) and (
+        native_extraction or virtual_output or binary_assignments or membership
+    ):
+        raise Exception(
+            f"--search-type all cannot be used with --native-extraction, --virtual-output, --binary-assignments or --membership."
+        )
+
     # Split hemisphere input into list (useful if multiple are hemis are used)
     if hemi != None:
         hemi_list = hemi.split(",")
@@ -142,9 +187,11 @@ def extractor(
         reg_invert = True
     # Infer registration type if not supplied
     if reg != None and reg_type == None:
-        with open(reg) as f:
-            reg_first_line = f.readlines()[0]
-        f.close()
+        if op.splitext(reg)[-1] == ".mat":
+            reg_first_line = ""
+        else:
+            with open(reg) as f:
+                reg_first_line = f.readline()
         if "command_history" in reg_first_line:
             reg_type = "mrtrix"
         else:
@@ -165,6 +212,14 @@ def extractor(
     os.makedirs(dwi_out_dir, exist_ok=True)
     os.makedirs(func_out_dir, exist_ok=True)
 
+    # With --resume, steps whose inputs, parameters and outputs are unchanged since the last run are skipped
+    if resume:
+        manifest = op.join(out_dir, subject, f"{subject}_desc-manifest.json")
+        # Out-of-date steps are rerun in place
+        overwrite = True
+    else:
+        manifest = None
+
     # Prepare registration, if needed
     if reg != None and reg_type != "mrtrix":
         if reg_invert:
@@ -175,9 +230,51 @@ def extractor(
             mrtrix_reg_out = op.join(
                 anat_out_dir, f"{subject}_from-FS_to-DWI_mode-image_desc-MRTrix_xfm.txt"
             )
-        reg = convert_to_mrtrix_reg(
-            reg, mrtrix_reg_out, reg_in_type=reg_type, overwrite=overwrite
-        )
+        if "reg" in shared_stages:
+            reg = shared_stages["reg"]
+        else:
+            reg = run_step(
+                manifest,
+                "convert_reg",
+                convert_to_mrtrix_reg,
+                reg,
+                mrtrix_reg_out,
+                reg_in_type=reg_type,
+                overwrite=overwrite,
+            )
+        stages["reg"] = reg
+
+    # Decide whether to register images into DWI space or streamlines into FS space
+    if extraction_space != "DWI":
+        if generate or reg == None or skip_fivett_registration:
+            if extraction_space == "FS" and reg != None:
+                warnings.warn(
+                    "Extraction in FS space requires a registration, an existing tractogram (no --generate) and unregistered anatomicals. Extracting in DWI space instead."
+                )
+            extraction_space = "DWI"
+        elif extraction_space == "auto":
+            # Compare voxels written when registering images with points written when transforming streamlines
+            import nibabel as nib
+
+            n_voxels = prod(nib.load(op.join(fs_dir, subject, "mri", "orig.mgz")).shape)
+            # 5TT (5 volumes), GMWMI, binarized GMWMI and each ROI
+            n_images = 5 + 2 + (2 if two_rois else 1)
+            if op.splitext(tract)[-1] == ".tck":
+                n_points = tck_point_count(tract)
+            else:
+                n_points = op.getsize(tract) // 12
+            if n_points < n_voxels * n_images:
+                extraction_space = "FS"
+            else:
+                extraction_space = "DWI"
+            print(
+                f"\n Extracting in {extraction_space} space ({n_points} streamline points vs. {n_voxels * n_images} image voxels to transform) \n"
+            )
+    if extraction_space == "FS":
+        # ROIs stay in FS space; streamlines are brought to them instead
+        roi_reg = None
+    else:
+        roi_reg = reg
 
     # TODO: Parallelize stuff...
 
@@ -204,9 +301,15 @@ def extractor(
         )
         fivett = None
 
-    if skip_gmwmi_intersection == False or generate == True:
+    if "gmwmi" in shared_stages:
+        fivett, gmwmi, gmwmi_bin = shared_stages["gmwmi"]
+        stages["gmwmi"] = (fivett, gmwmi, gmwmi_bin)
+    elif skip_gmwmi_intersection == False or generate == True:
         print("\n Running GMWMI creation workflow \n")
-        (fivett, gmwmi, gmwmi_bin) = anat_to_gmwmi(
+        (fivett, gmwmi, gmwmi_bin) = run_step(
+            manifest,
+            "anat_to_gmwmi",
+            anat_to_gmwmi,
             op.join(fs_dir, subject),
             anat_out_dir,
             threshold=gmwmi_thresh,
@@ -215,25 +318,35 @@ def extractor(
             space_label=anat_space_label,
             overwrite=overwrite,
         )
+        stages["gmwmi"] = (fivett, gmwmi, gmwmi_bin)
 
     # Register 5TT / GMWMI to DWI space if needed
-    if skip_fivett_registration == False and reg != None:
+    if skip_fivett_registration == False and roi_reg != None:
         print("\n Registering 5TT and GMWMI to DWI space \n")
-        fivett = register_to_dwi(
+        fivett = run_step(
+            manifest,
+            "register_fivett",
+            register_to_dwi,
             fivett,
             op.join(out_dir, subject, "anat", f"{subject}_space-DWI_desc-5tt.nii.gz"),
             reg,
             invert=reg_invert,
             overwrite=True,
         )
-        gmwmi = register_to_dwi(
+        gmwmi = run_step(
+            manifest,
+            "register_gmwmi",
+            register_to_dwi,
             gmwmi,
             gmwmi.replace("space-FS", "space-DWI"),
             reg,
             invert=reg_invert,
             overwrite=True,
         )
-        gmwmi_bin = register_to_dwi(
+        gmwmi_bin = run_step(
+            manifest,
+            "register_gmwmi_bin",
+            register_to_dwi,
             gmwmi_bin,
             gmwmi_bin.replace("space-FS", "space-DWI"),
             reg,
@@ -243,9 +356,14 @@ def extractor(
         )
 
     ### Project the ROI(s) into the white matter and intersect with GMWMI ###
-    if skip_roi_projection == False:
+    if skip_roi_projection == False and "rois" in shared_stages:
+        roi1_projected = shared_stages["rois"][0]
+    elif skip_roi_projection == False:
         print(f"\n Projecting {roi1_name} into white matter \n")
-        roi1_projected = project_roi(
+        roi1_projected = run_step(
+            manifest,
+            "project_roi1",
+            project_roi,
             roi_in=roi1,
             roi_name=roi1_name,
             fs_dir=fs_dir,
@@ -253,30 +371,55 @@ def extractor(
             hemi=hemi_list[0],
             outdir=func_out_dir,
             projfrac_params=projfrac_params_list,
+            projection_backend=projection_backend,
             overwrite=overwrite,
         )
     else:
         print(f"\n Skipping {roi1_name} projection \n")
         roi1_projected = roi1
-    if reg != None:
-        registed_roi_name = roi1_projected.replace("space-FS", "space-DWI")
-        roi1_projected = register_to_dwi(
-            roi1_projected,
-            registed_roi_name,
-            reg,
-            invert=reg_invert,
-            interp="nearest",
-            overwrite=True,
-        )
-    if skip_gmwmi_intersection == False:
-        print(f"\n Intersecting {roi1_name} with GMWMI \n")
-        roi1_projected = intersect_gmwmi(
-            roi_in=roi1_projected,
-            roi_name=roi1_name,
-            gmwmi=gmwmi_bin,
-            outpath_base=op.join(func_out_dir, subject),
-            overwrite=overwrite,
-        )
+    if skip_roi_projection == False:
+        stages["rois"] = [roi1_projected]
+    if roi_resampling == "composed":
+        if roi_reg != None or skip_gmwmi_intersection == False:
+            print(f"\n Resampling {roi1_name} to DWI space and GMWMI \n")
+            roi1_projected = run_step(
+                manifest,
+                "resample_roi1",
+                resample_roi_once,
+                roi1_projected,
+                roi_name=roi1_name,
+                outpath_base=op.join(func_out_dir, subject),
+                mrtrix_xfm=roi_reg,
+                invert=reg_invert,
+                gmwmi=None if skip_gmwmi_intersection else gmwmi_bin,
+                overwrite=overwrite,
+            )
+    else:
+        if roi_reg != None:
+            registed_roi_name = roi1_projected.replace("space-FS", "space-DWI")
+            roi1_projected = run_step(
+                manifest,
+                "register_roi1",
+                register_to_dwi,
+                roi1_projected,
+                registed_roi_name,
+                reg,
+                invert=reg_invert,
+                interp="nearest",
+                overwrite=True,
+            )
+        if skip_gmwmi_intersection == False:
+            print(f"\n Intersecting {roi1_name} with GMWMI \n")
+            roi1_projected = run_step(
+                manifest,
+                "intersect_roi1",
+                intersect_gmwmi,
+                roi_in=roi1_projected,
+                roi_name=roi1_name,
+                gmwmi=gmwmi_bin,
+                outpath_base=op.join(func_out_dir, subject),
+                overwrite=overwrite,
+            )
 
     ### Process ROI2 the same way if specified ###
     if two_rois == False:
@@ -285,9 +428,14 @@ def extractor(
         roi2_projected = None
     else:
         rois_name = f"{roi1_name}-{roi2_name}"
-        if skip_roi_projection == False:
+        if skip_roi_projection == False and "rois" in shared_stages:
+            roi2_projected = shared_stages["rois"][1]
+        elif skip_roi_projection == False:
             print(f"\n Projecting {roi2_name} into white matter \n")
-            roi2_projected = project_roi(
+            roi2_projected = run_step(
+                manifest,
+                "project_roi2",
+                project_roi,
                 roi_in=roi2,
                 roi_name=roi2_name,
                 fs_dir=fs_dir,
@@ -295,34 +443,62 @@ def extractor(
                 hemi=hemi_list[-1],
                 outdir=func_out_dir,
                 projfrac_params=projfrac_params_list,
+                projection_backend=projection_backend,
                 overwrite=overwrite,
             )
         else:
             print(f"\n Skipping {roi2_name} projection \n")
             roi2_projected = roi2
-        if reg != None:
-            registed_roi_name = roi2_projected.replace("space-FS", "space-DWI")
-            roi2_projected = register_to_dwi(
-                roi2_projected,
-                registed_roi_name,
-                reg,
-                invert=reg_invert,
-                interp="nearest",
-                overwrite=True,
-            )
-        if skip_gmwmi_intersection == False:
-            print(f"\n Intersecting {roi2_name} with GMWMI \n")
-            roi2_projected = intersect_gmwmi(
-                roi_in=roi2_projected,
-                roi_name=roi2_name,
-                gmwmi=gmwmi_bin,
-                outpath_base=op.join(func_out_dir, subject),
-                overwrite=overwrite,
-            )
+        if skip_roi_projection == False:
+            stages["rois"] += [roi2_projected]
+        if roi_resampling == "composed":
+            if roi_reg != None or skip_gmwmi_intersection == False:
+                print(f"\n Resampling {roi2_name} to DWI space and GMWMI \n")
+                roi2_projected = run_step(
+                    manifest,
+                    "resample_roi2",
+                    resample_roi_once,
+                    roi2_projected,
+                    roi_name=roi2_name,
+                    outpath_base=op.join(func_out_dir, subject),
+                    mrtrix_xfm=roi_reg,
+                    invert=reg_invert,
+                    gmwmi=None if skip_gmwmi_intersection else gmwmi_bin,
+                    overwrite=overwrite,
+                )
+        else:
+            if roi_reg != None:
+                registed_roi_name = roi2_projected.replace("space-FS", "space-DWI")
+                roi2_projected = run_step(
+                    manifest,
+                    "register_roi2",
+                    register_to_dwi,
+                    roi2_projected,
+                    registed_roi_name,
+                    reg,
+                    invert=reg_invert,
+                    interp="nearest",
+                    overwrite=True,
+                )
+            if skip_gmwmi_intersection == False:
+                print(f"\n Intersecting {roi2_name} with GMWMI \n")
+                roi2_projected = run_step(
+                    manifest,
+                    "intersect_roi2",
+                    intersect_gmwmi,
+                    roi_in=roi2_projected,
+                    roi_name=roi2_name,
+                    gmwmi=gmwmi_bin,
+                    outpath_base=op.join(func_out_dir, subject),
+                    overwrite=overwrite,
+                )
 
         ### Merge ROIS ###
         print("\n Merging ROIs \n")
-        rois_atlas_in = merge_rois(
+        rois_atlas_in = run_step(
+            manifest,
+            "merge_rois",
+            merge_rois,
             roi1=roi1_projected,
             roi2=roi2_projected,
             out_file=op.join(
@@ -336,25 +512,135 @@ def extractor(
         ### Convert .trk to .tck if needed ###
         if op.splitext(tract)[-1] == ".trk":
             print("\n Converting .trk to .tck \n")
-            tck_file = trk_to_tck(tract, dwi_out_dir, overwrite=overwrite)
+            tck_file = run_step(
+                manifest,
+                "trk_to_tck",
+                trk_to_tck,
+                tract,
+                dwi_out_dir,
+                overwrite=overwrite,
+            )
         else:
             tck_file = tract
 
+        ### Bring streamlines into FS space, where the ROIs are ###
+        if extraction_space == "FS":
+            print("\n Transforming streamlines to FS space \n")
+            tck_file_fs = run_step(
+                manifest,
+                "transform_tck",
+                transform_tck,
+                tck_file,
+                op.join(dwi_out_dir, f"{subject}_space-FS_desc-{tract_name}.tck"),
+                dwi_to_fs_xfm(reg, invert=reg_invert),
+                overwrite=overwrite,
+            )
+        else:
+            tck_file_fs = None
+
+        # Keep the endpoint index with the outputs, so later runs on this tractogram reuse it
+        if endpoint_index:
+            endpoint_index_file = op.join(
+                dwi_out_dir,
+                f"{subject}_space-{extraction_space}_desc-{tract_name}_endpoints.npz",
+            )
+        else:
+            endpoint_index_file = None
+
         ### Run MRtrix Tract Extraction ###
-        print("\n Extracing the sub-bundle \n")
-        fsub_bundle = extract_tck_mrtrix(
-            tck_file,
-            rois_atlas_in,
-            outpath_base=op.join(dwi_out_dir, f"{subject}_{tract_name}_{rois_name}"),
-            two_rois=two_rois,
-            search_dist=search_dist,
-            search_type=search_type,
-            sift2_weights=sift2_weights,
-            exclude_mask=exclude_mask,
-            include_mask=include_mask,
-            streamline_mask=streamline_mask,
-            overwrite=overwrite,
+        # Several search settings (a sweep) share one pass over the endpoints
+        settings = search_settings(
+            search_type if isinstance(search_type, list) else [search_type],
+            search_dist if isinstance(search_dist, list) else [search_dist],
         )
+        fsub_outpath_base = op.join(dwi_out_dir, f"{subject}_{tract_name}_{rois_name}")
+        node_names = {1: roi1_name, 2: roi2_name} if two_rois else {1: roi1_name}
+
+        # Files written besides the sub-bundle, so that --resume reruns extraction if any is deleted
+        if len(settings) > 1:
+            setting_bases = [
+                f"{fsub_outpath_base}_desc-{search_setting_label(*setting)}"
+                for setting in settings
+            ]
+        else:
+            setting_bases = [fsub_outpath_base]
+        extraction_outputs = [endpoint_index_file] + [
+            setting_base + suffix
+            for setting_base in setting_bases
+            for suffix in [
+                "_desc-assignments.txt",
+                "_desc-assignments.npy",
+                "_desc-connectome.txt",
+                "_desc-connectome.npy",
+                "_desc-membership.npz",
+                "desc-fsubSIFT2weights.csv",
+                "desc-fsubSIFT2weights_desc-masked.csv",
+            ]
+        ]
+        if len(settings) > 1:
+            print(f"\n Extracing the sub-bundle for {len(settings)} search settings \n")
+            fsub_bundles = run_step(
+                manifest,
+                "extract_tck_sweep",
+                extract_tck_sweep,
+                tck_file,
+                rois_atlas_in,
+                outpath_base=fsub_outpath_base,
+                two_rois=two_rois,
+                settings=settings,
+                sift2_weights=sift2_weights,
+                exclude_mask=exclude_mask,
+                include_mask=include_mask,
+                streamline_mask=streamline_mask,
+                connectome_tck=tck_file_fs,
+                binary_assignments=binary_assignments,
+                virtual=virtual_output,
+                membership=membership,
+                node_names=node_names,
+                overwrite=overwrite,
+                native=native_extraction,
+                cull=cull_streamlines,
+                endpoint_index=endpoint_index_file,
+                native_assignment=native_assignment,
+                n_shards=extraction_shards,
+                outputs=extraction_outputs,
+            )
+            for (search_type_i, search_dist_i), fsub_bundle_i in fsub_bundles.items():
+                print(
+                    f"\n The tract extracted with {search_setting_label(search_type_i, search_dist_i)} search is located at {fsub_bundle_i}.\n"
+                )
+            # Visualize the first setting
+            fsub_bundle = fsub_bundles[settings[0]]
+        else:
+            search_type, search_dist = settings[0]
+            print("\n Extracing the sub-bundle \n")
+            fsub_bundle = run_step(
+                manifest,
+                "extract_tck",
+                extract_tck_mrtrix,
+                tck_file,
+                rois_atlas_in,
+                outpath_base=fsub_outpath_base,
+                two_rois=two_rois,
+                search_dist=search_dist,
+                search_type=search_type,
+                sift2_weights=sift2_weights,
+                exclude_mask=exclude_mask,
+                include_mask=include_mask,
+                streamline_mask=streamline_mask,
+                native=native_extraction,
+                connectome_tck=tck_file_fs,
+                cull=cull_streamlines,
+                endpoint_index=endpoint_index_file,
+                native_assignment=native_assignment,
+                virtual=virtual_output,
+                membership=membership,
+                binary_assignments=binary_assignments,
+                n_shards=extraction_shards,
+                node_names=node_names,
+                overwrite=overwrite,
+                outputs=extraction_outputs,
+            )
 
         print("\n The extracted tract is located at " + fsub_bundle + ".\n")
 
@@ -385,68 +671,94 @@ def extractor(
 
         print(f"\n Generating Sub-bundles \n")
 
-        if two_rois:
-            # Seed half of streamlines from each seed ROI
-            n_streamlines = int(n_streamlines / 2)
-
-            fsub_1_name = f"{subject}_space-DWI_from-{roi1_name}_to-{roi2_name}_desc-{tract_name}_fsub.tck"
-            fsub_2_name = f"{subject}_space-DWI_from-{roi2_name}_to-{roi1_name}_desc-{tract_name}_fsub.tck"
-
-            # Generate FSuB from 2nd ROI
-            fsub_gen_2 = generate_tck_mrtrix(
-                roi_begin=roi2_projected,
-                roi_end=roi1_projected,
-                wmfod=wmfod,
-                fivett=fivett,
-                n_streamlines=n_streamlines,
-                outfile=op.join(dwi_out_dir, fsub_2_name),
-                # pial_exclusion_mask=pial_surf,
-                pial_exclusion_mask=None,
-                exclude_mask=exclude_mask,
-                include_mask=include_mask,
-                streamline_mask=streamline_mask,
-                tckgen_params=tckgen_params,
-                overwrite=overwrite,
-            )
-        else:
-            fsub_1_name = (
-                f"{subject}_space-DWI_from-{roi1_name}_desc-{tract_name}_fsub.tck"
-            )
-            fsub_2_name = None
-
-        # Generate FSuB from 1st ROI
-        fsub_gen_1 = generate_tck_mrtrix(
-            roi_begin=roi1_projected,
-            roi_end=roi2_projected,
+        # Arguments shared by both generation directions
+        generate_args = dict(
             wmfod=wmfod,
             fivett=fivett,
-            n_streamlines=n_streamlines,
-            outfile=op.join(dwi_out_dir, fsub_1_name),
             # pial_exclusion_mask=pial_surf,
             pial_exclusion_mask=None,
             exclude_mask=exclude_mask,
             include_mask=include_mask,
             streamline_mask=streamline_mask,
             tckgen_params=tckgen_params,
+            n_shards=n_shards,
+            pilot_seeds=pilot_seeds,
+            time_budget=time_budget,
             overwrite=overwrite,
         )
 
+        # In adaptive mode, n_streamlines is a maximum and generation stops once the bundle converges
+        if adaptive:
+            generate_function = generate_tck_adaptive
+            generate_args.update(increment=increment, tolerance=tolerance)
+        else:
+            generate_function = generate_tck_mrtrix
+
         if two_rois:
-            # Merge the tracks
+            # Seed half of streamlines from each seed ROI
+            n_streamlines = int(n_streamlines / 2)
+
+            fsub_1_name = f"{subject}_space-DWI_from-{roi1_name}_to-{roi2_name}_desc-{tract_name}_fsub.tck"
+            fsub_2_name = f"{subject}_space-DWI_from-{roi2_name}_to-{roi1_name}_desc-{tract_name}_fsub.tck"
+
+            # The two directions are independent, so run them concurrently on half the threads each
+            from concurrent.futures import ThreadPoolExecutor
+
+            if nthreads == None:
+                nthreads = os.cpu_count()
+            # Each direction uses consecutive seeds from its own seed (for the pilot, shards and any increments),
+            # so derive a distant seed for the 2nd direction rather than offsetting the 1st
+            if seed == None:
+                seed_2 = None
+            else:
+                seed_2 = int(SeedSequence(seed).generate_state(1)[0] % 2**29) + 2**30
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # Generate FSuB from 1st ROI
+                future_gen_1 = executor.submit(
+                    generate_function,
+                    roi_begin=roi1_projected,
+                    roi_end=roi2_projected,
+                    n_streamlines=n_streamlines,
+                    outfile=op.join(dwi_out_dir, fsub_1_name),
+                    nthreads=max(1, nthreads // 2),
+                    seed=seed,
+                    **generate_args,
+                )
+                # Generate FSuB from 2nd ROI
+                future_gen_2 = executor.submit(
+                    generate_function,
+                    roi_begin=roi2_projected,
+                    roi_end=roi1_projected,
+                    n_streamlines=n_streamlines,
+                    outfile=op.join(dwi_out_dir, fsub_2_name),
+                    nthreads=max(1, nthreads - nthreads // 2),
+                    seed=seed_2,
+                    **generate_args,
+                )
+                fsub_gen_1 = future_gen_1.result()
+                fsub_gen_2 = future_gen_2.result()
+
+            # Merge the tracks by streaming both files into one
             fsub_bundle = op.join(
                 dwi_out_dir,
                 f"{subject}_space-DWI_from-{roi1_name}_to-{roi2_name}_desc-{tract_name}_desc-merged_fsub.tck",
             )
-            tckedit = find_program("tckedit")
-            cmd_tckedit = [
-                tckedit,
-                fsub_gen_1,
-                fsub_gen_2,
-                fsub_bundle,
-            ]
-            run_command(cmd_tckedit)
+            concatenate_tck([fsub_gen_1, fsub_gen_2], fsub_bundle, overwrite=overwrite)
         else:
-            fsub_bundle = fsub_gen_1
+            fsub_1_name = (
+                f"{subject}_space-DWI_from-{roi1_name}_desc-{tract_name}_fsub.tck"
+            )
+
+            # Generate FSuB from 1st ROI
+            fsub_bundle = generate_function(
+                roi_begin=roi1_projected,
+                roi_end=roi2_projected,
+                n_streamlines=n_streamlines,
+                outfile=op.join(dwi_out_dir, fsub_1_name),
+                nthreads=nthreads,
+                seed=seed,
+                **generate_args,
+            )
 
         print("\n The generated tract is located at " + fsub_bundle + ".\n")
 
@@ -476,14 +788,43 @@ def extractor(
                 ","
             )  # TODO: redundant to define twice, already defined above if not skip projection
 
-        visualize_sub_bundles(
+        # ROIs and GMWMI stayed in FS space, so show the streamlines there too
+        if extraction_space == "FS" and fsub_bundle.endswith(".npz"):
+            # The transformed tractogram holds the same streamlines, so select them there
+            tck_file = tck_file_fs
+            fsub_bundle = run_step(
+                manifest,
+                "rebase_fsub",
+                rebase_virtual_tck,
+                fsub_bundle,
+                tck_file_fs,
+                fsub_bundle.replace("_selection.npz", "_space-FS_selection.npz"),
+            )
+        elif extraction_space == "FS":
+            tck_file = tck_file_fs
+            fsub_bundle = run_step(
+                manifest,
+                "transform_fsub",
+                transform_tck,
+                fsub_bundle,
+                fsub_bundle.replace(".tck", "_space-FS.tck"),
+                dwi_to_fs_xfm(reg, invert=reg_invert),
+                overwrite=overwrite,
+            )
+
+        viz_fname = op.join(
+            dwi_out_dir,
+            f"{subject}_hemi-{hemi_list[0]}_{tract_name}_{rois_name}_desc-visualization.png",
+        )
+        # An interactive window is always shown
+        run_step(
+            None if interactive_viz else manifest,
+            "visualize",
+            visualize_sub_bundles,
             orig_bundle=tck_file,
             fsub_bundle=fsub_bundle,
             ref_anat=ref_anat,
-            fname=op.join(
-                dwi_out_dir,
-                f"{subject}_hemi-{hemi_list[0]}_{tract_name}_{rois_name}_desc-visualization.png",
-            ),
+            fname=viz_fname,
             roi1=roi1_projected,
             roi2=roi2_projected,
             orig_color=orig_color_list,
@@ -498,6 +839,9 @@ def extractor(
             saggital_offset=saggital_offset,
             camera_angle=camera_angle,
             hemi=hemi_list[0],
+            outputs=[viz_fname],
         )
 
     print("\n DONE! \n")
+
+    return stages
@@ -0,0 +1,47 @@
+import os
+import os.path as op
+from fsub_extractor.utils.streamline_utils import extract_membership_query
+
+
+def query_bundles(
+    membership,
+    query,
+    out_file,
+    sift2_weights,
+    overwrite,
+):
+    """Extracts a combination of ROIs (e.g., streamlines reaching A and B but not C) from saved ROI membership
+    Parameters
+    ==========
+    membership: str
+        Path to membership file (_desc-membership.npz) saved by extractor or connectome with --membership
+    query: str
+        Combination of ROIs, by name or label, with & (and), | (or), ~ (not) and parentheses, e.g. 'V1 & MT & ~FEF'
+    out_file: str
+        Path to output sub-bundle (.tck), or a virtual sub-bundle (_selection.npz)
+    sift2_weights: str
+        Path to SIFT2 weights file for the tract the membership was saved for
+    overwrite: bool
+        Whether to overwrite existing files
+
+    Outputs
+    =======
+    Function returns the path of the output sub-bundle
+    Selected SIFT2 weights are saved next to it (if sift2_weights is given)
+    """
+    # Force start log outputs on new line
+    print("\n")
+
+    os.makedirs(op.dirname(out_file), exist_ok=True)
+    out_file = extract_membership_query(
+        membership,
+        query,
+        out_file,
+        sift2_weights=sift2_weights,
+        overwrite=overwrite,
+    )
+
+    print(f"\n The extracted tract is located at {out_file}.\n")
+    print("\n DONE! \n")
+
+    return out_file
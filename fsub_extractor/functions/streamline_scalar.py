@@ -12,7 +12,12 @@ from fsub_extractor.utils.system_utils import (
     overwrite_check,
     find_program,
 )
-from fsub_extractor.utils.streamline_utils import trk_to_tck
+from fsub_extractor.utils.streamline_utils import (
+    trk_to_tck,
+    load_sift2_weights,
+    load_virtual_streamlines,
+    materialize_virtual_tck,
+)
 
 
 def streamline_scalar(
@@ -26,6 +31,7 @@ def streamline_scalar(
     out_prefix,
     overwrite,
     n_points=100,
+    sift2_weights=None,
 ):
 
     """Creates scalar statistics on tract files
@@ -34,13 +40,15 @@ def streamline_scalar(
     subject name: str
         Subject name
     tract: str
-        Path to tract input
+        Path to tract input (.tck, .trk, or a virtual sub-bundle .npz saved with --virtual-output)
     scalar_paths: str
         Comma-delimited paths of scalars (.nii.gz) to analyze
     scalar_names: str
         Comma-delimited paths of scalar namess
     n_points: int
         Number of points to use in tract profiles
+    sift2_weights: str
+        Path to SIFT2 weights (.csv, .txt, or .npy) for the tract. If given, profiles and summary stats are SIFT2-weighted
     out_dir: str
         Path to output directory
     out_prefix: str
@@ -73,12 +81,23 @@ def streamline_scalar(
     # Make sure tract file is okay
     if op.exists(tract) == False:
         raise Exception(f"Tract file {tract} is not found on the system.")
-    if tract[-4:] not in [".trk", ".tck"]:
+    if tract[-4:] not in [".trk", ".tck", ".npz"]:
         raise Exception(f"Tract file {tract} is not of a supported file type.")
     # Convert tract to .tck if needed
     if tract[-4:] == ".trk":
         print("\n Converting .trk to .tck \n")
         tck_file = trk_to_tck(tract, out_dir, overwrite=overwrite)
+    elif tract[-4:] == ".npz":
+        # tcksample needs a .tck file; tract profiles read the parent tractogram directly
+        print("\n Materializing virtual sub-bundle to .tck \n")
+        tck_file = materialize_virtual_tck(
+            tract,
+            op.join(
+                out_dir,
+                op.basename(tract[:-4]).removesuffix("_selection") + ".tck",
+            ),
+            overwrite=overwrite,
+        )
     else:
         tck_file = tract
     # Make sure number of points for tract profile is not negative
@@ -108,7 +127,10 @@ def streamline_scalar(
     func_out_base = op.join(func_out_dir, out_prefix)
 
     ### Reorient streamlines so beginning of each streamline are at the same end
-    tract_loaded = load_tractogram(tract, scalar_path_list[0]).streamlines
+    if tract[-4:] == ".npz":
+        tract_loaded = load_virtual_streamlines(tract)
+    else:
+        tract_loaded = load_tractogram(tract, scalar_path_list[0]).streamlines
     # TODO: See if we need to reorient streamlines, and how
     # trk_ref_img, ref_affine = load_nifti(trk_ref)
     # roi_begin_img = load_nifti_data(roi_begin)
@@ -123,6 +145,18 @@ def streamline_scalar(
     # weights_bundle = dsa.gaussian_weights(oriented_bundle)
     weights_bundle = dsa.gaussian_weights(tract_loaded, n_points=n_points)
 
+    # Scale each streamline's node weights by its SIFT2 weight, keeping each node's weights summing to 1
+    if sift2_weights != None:
+        streamline_weights = np.asarray(load_sift2_weights(sift2_weights), dtype=float)
+        if len(streamline_weights) != len(tract_loaded):
+            raise Exception(
+                f"Number of SIFT2 weights ({len(streamline_weights)}) does not match number of streamlines ({len(tract_loaded)})."
+            )
+        weights_bundle = weights_bundle * streamline_weights[:, np.newaxis]
+        weights_bundle = weights_bundle / np.sum(weights_bundle, axis=0)
+    else:
+        streamline_weights = None
+
     for scalar_path, scalar_name in zip(scalar_path_list, scalar_name_list):
 
         print(f"\n Processing scalar {scalar_path} under name {scalar_name} \n")
@@ -174,9 +208,24 @@ def streamline_scalar(
             float(avg.removesuffix(".1")) for avg in streamline_avgs.columns
         ]
         # Calculate summary stats across streamlines
-        tract_avg = np.mean(streamline_avgs_num)
-        tract_std = np.std(streamline_avgs_num)
-        tract_med = np.median(streamline_avgs_num)
+        if streamline_weights is None:
+            tract_avg = np.mean(streamline_avgs_num)
+            tract_std = np.std(streamline_avgs_num)
+            tract_med = np.median(streamline_avgs_num)
+        else:
+            tract_avg = np.average(streamline_avgs_num, weights=streamline_weights)
+            tract_std = np.sqrt(
+                np.average(
+                    (np.array(streamline_avgs_num) - tract_avg) ** 2,
+                    weights=streamline_weights,
+                )
+            )
+            # Weighted median: first value at which the cumulative weight reaches half
+            order = np.argsort(streamline_avgs_num)
+            cumulative_weights = np.cumsum(streamline_weights[order])
+            tract_med = np.array(streamline_avgs_num)[order][
+                np.searchsorted(cumulative_weights, cumulative_weights[-1] / 2)
+            ]
         n_streamlines = len(streamline_avgs_num)
         # Write summary stats to outfile
         stats_outfile = dwi_out_base + scalar_name + "_stats.txt"
@@ -184,6 +233,8 @@ def streamline_scalar(
             overwrite_check(stats_outfile)
         stats_outfile_object = open(stats_outfile, "w")
         stats_string = f"Tract: {tract} \nNumber of Streamlines: {n_streamlines} \nScalar: {scalar_path} \nMean: {tract_avg} \nMedian: {tract_med} \nStandard Deviation: {tract_std} \nTract Profile: {profile_bundle} \nProfile Length: {n_points}"
+        if streamline_weights is not None:
+            stats_string += f" \nSIFT2 Weights: {sift2_weights} \nSum of SIFT2 Weights: {np.sum(streamline_weights)}"
         stats_outfile_object.write(stats_string)
         stats_outfile_object.close()
 
@@ -0,0 +1,142 @@
+import os
+import os.path as op
+from itertools import product
+from fsub_extractor.functions.extractor import extractor
+from fsub_extractor.utils.streamline_utils import trk_to_tck
+from fsub_extractor.utils.system_utils import run_step
+
+
+def extractor_sweep(
+    subject,
+    tract,
+    generate,
+    gmwmi_thresh,
+    projfrac_params,
+    fivett,
+    out_dir,
+    overwrite,
+    **extractor_args,
+):
+    """Runs the extractor for every combination of swept parameters, sharing the stages they do not affect
+    Search settings (search_dist, search_type) only affect extraction, so one extractor run handles all of them with a
+    single nearest-ROI search (see extract_tck_sweep). Every combination of gmwmi_thresh and projfrac_params gets its
+    own run in a sweep-XX folder of out_dir. The .tck conversion of the tract and the registration conversion are
+    shared by all runs, the 5TT and GMWMI are made once per gmwmi_thresh, and the ROIs are projected once per
+    projfrac_params (in the folder of the first run that needs them). Only the ROI resampling and GMWMI intersection,
+    which depend on both, and extraction run for every combination.
+
+    Parameters
+    ==========
+    subject: str
+        Subject name
+    tract: str
+        Path to tract input (.tck or .trk)
+    generate: bool
+        Whether to generate streamlines instead of extracting them from tract
+    gmwmi_thresh: float or list
+        GMWMI threshold(s) to sweep
+    projfrac_params: str or list
+        projfrac parameters ('start,stop,delta') to sweep, as a list or separated by semicolons
+    fivett: str
+        Path to 5TT image, or None to make one (once) from the FreeSurfer outputs
+    out_dir: str
+        Path to output directory
+    overwrite: bool
+        Whether to overwrite existing files
+    extractor_args:
+        Other arguments of extractor, where search_dist and search_type may be lists
+
+    Outputs
+    =======
+    Function returns a list of the output directories, one per combination of gmwmi_thresh and projfrac_params
+    {out_dir}/{subject}_desc-sweep.tsv lists the parameters of each sweep-XX folder (if there is more than one)
+    """
+    if not isinstance(gmwmi_thresh, list):
+        gmwmi_thresh = [gmwmi_thresh]
+    if not isinstance(projfrac_params, list):
+        projfrac_params = projfrac_params.split(";")
+    combinations = list(product(gmwmi_thresh, projfrac_params))
+
+    # A single combination runs as usual
+    if len(combinations) == 1:
+        extractor(
+            subject=subject,
+            tract=tract,
+            generate=generate,
+            gmwmi_thresh=combinations[0][0],
+            projfrac_params=combinations[0][1],
+            fivett=fivett,
+            out_dir=out_dir,
+            overwrite=overwrite,
+            **extractor_args,
+        )
+        return [out_dir]
+
+    ### Stages shared by every combination
+    print(f"\n Sweeping {len(combinations)} combinations of parameters \n")
+    if generate == False and op.splitext(tract)[-1] == ".trk":
+        print("\n Converting .trk to .tck \n")
+        shared_dwi_dir = op.join(out_dir, subject, "dwi")
+        os.makedirs(shared_dwi_dir, exist_ok=True)
+        if extractor_args.get("resume", False):
+            manifest = op.join(out_dir, subject, f"{subject}_desc-manifest.json")
+        else:
+            manifest = None
+        tract = run_step(
+            manifest,
+            "trk_to_tck",
+            trk_to_tck,
+            tract,
+            shared_dwi_dir,
+            overwrite=manifest != None or overwrite,
+        )
+
+    os.makedirs(out_dir, exist_ok=True)
+    sweep_dirs = []
+    sweep_table = op.join(out_dir, f"{subject}_desc-sweep.tsv")
+    with open(sweep_table, "w") as f:
+        f.write("sweep\tgmwmi_thresh\tprojfrac_params\tout_dir\n")
+        for i, (thresh, projfrac) in enumerate(combinations):
+            sweep_dirs += [op.join(out_dir, f"sweep-{i + 1:02d}")]
+            f.write(f"{i + 1:02d}\t{thresh}\t{projfrac}\t{sweep_dirs[-1]}\n")
+
+    ### Fan out the combinations, reusing the stages each one shares with earlier ones
+    shared_reg = None
+    shared_gmwmi = {}
+    shared_rois = {}
+    for sweep_dir, (thresh, projfrac) in zip(sweep_dirs, combinations):
+        print(
+            f"\n Running combination gmwmi_thresh={thresh}, projfrac_params={projfrac} in {sweep_dir} \n"
+        )
+        os.makedirs(sweep_dir, exist_ok=True)
+        shared_stages = {}
+        if shared_reg != None:
+            shared_stages["reg"] = shared_reg
+        if thresh in shared_gmwmi:
+            shared_stages["gmwmi"] = shared_gmwmi[thresh]
+        if projfrac in shared_rois:
+            shared_stages["rois"] = shared_rois[projfrac]
+        stages = extractor(
+            subject=subject,
+            tract=tract,
+            generate=generate,
+            gmwmi_thresh=thresh,
+            projfrac_params=projfrac,
+            fivett=fivett,
+            out_dir=sweep_dir,
+            overwrite=overwrite,
+            shared_stages=shared_stages,
+            **extractor_args,
+        )
+        shared_reg = stages.get("reg")
+        if "gmwmi" in stages:
+            shared_gmwmi[thresh] = stages["gmwmi"]
+            # Later thresholds only rerun 5tt2gmwmi on the same 5TT
+            if fivett == None:
+                fivett = stages["gmwmi"][0]
+        if "rois" in stages:
+            shared_rois[projfrac] = stages["rois"]
+
+    print(f"\n The sweep is described in {sweep_table}.\n")
+
+    return sweep_dirs
@@ -1,7 +1,11 @@
 import os.path as op
 import os
+import numpy as np
 from fsub_extractor.utils.system_utils import *
 
+# ITK transforms already converted in this process, keyed by file hash
+ITK_XFMS = {}
+
 
 def anat_to_gmwmi(
     anat, outdir, subject, threshold=0, fivett=None, space_label="FS", overwrite=True
@@ -160,8 +164,8 @@ def get_pial_surf(
     outfile is the binarized image
     """
 
-    ### Tell FreeSurfer where subject data is
-    os.environ["SUBJECTS_DIR"] = fs_dir
+    ### Tell FreeSurfer where subject data is (without changing our own environment)
+    fs_env = dict(os.environ, SUBJECTS_DIR=fs_dir)
 
     ### Define the mri_surf2surf command, recreat pial surface in each hemisphere
     mri_surf2vol = find_program("mri_surf2vol")
@@ -191,7 +195,7 @@ def get_pial_surf(
         if overwrite == False:
             overwrite_check(outpath_hemi)
 
-        run_command(cmd_mri_surf2vol)
+        run_command(cmd_mri_surf2vol, env=fs_env)
 
     ### Merge the images into one mask
     outpath_merged = op.join(
@@ -216,12 +220,14 @@ def get_pial_surf(
 
 
 def convert_to_mrtrix_reg(reg_in, mrtrix_reg_out, reg_in_type="itk", overwrite=True):
-    """Makes an LTA convert file for mapping between FreeSurfer and DWI space
+    """Makes an MRtrix-readable transform file for mapping between FreeSurfer and DWI space
+    ITK transforms are converted in-process (like transformconvert itk_import). The output records the hash
+    of reg_in, and is reused if it was already made from the same input.
 
     Parameters
     ==========
     reg_in: str
-            Path to input registation
+            Path to input registation (.txt or .mat)
     mrtrix_reg_out: str
             Where to save output registation
     reg_type: str
@@ -234,23 +240,85 @@ def convert_to_mrtrix_reg(reg_in, mrtrix_reg_out, reg_in_type="itk", overwrite=T
     Function MRTrix-readable registration file
     """
 
-    if reg_in_type == "itk":
-        reg_fmt_string = "itk_import"
-
-    # Define the lta_convert command
-    transformconvert = find_program("transformconvert")
-    cmd_transformconvert = [
-        transformconvert,
-        reg_in,
-        reg_fmt_string,
-        mrtrix_reg_out,
-    ]
-
-    if overwrite:
-        cmd_transformconvert += ["-force"]
-    else:
+    if reg_in_type != "itk":
+        raise Exception(f"Registration type '{reg_in_type}' cannot be converted.")
+
+    # Reuse an output already converted from this registration
+    reg_hash = file_hash(reg_in)
+    source_line = f"# source: {op.basename(reg_in)} sha1:{reg_hash}\n"
+    if op.exists(mrtrix_reg_out):
+        with open(mrtrix_reg_out) as f:
+            if source_line in f.readlines()[:2]:
+                return mrtrix_reg_out
+    if overwrite == False:
         overwrite_check(mrtrix_reg_out)
 
-    run_command(cmd_transformconvert)
+    xfm = itk_to_mrtrix_xfm(reg_in, reg_hash=reg_hash)
+    with open(mrtrix_reg_out, "w") as f:
+        f.write("#! converted from ITK by fsub_extractor\n")
+        f.write(source_line)
+        np.savetxt(f, xfm, fmt="%.12g")
 
     return mrtrix_reg_out
+
+
+def itk_to_mrtrix_xfm(reg_in, reg_hash=None):
+    """Reads an ITK/ANTs affine transform (.txt or .mat) as a 4x4 matrix in MRtrix (RAS) convention
+    Matches transformconvert itk_import. Results are cached in memory by file hash.
+
+    Parameters
+    ==========
+    reg_in: str
+            Path to ITK/ANTs affine transform (.txt or .mat)
+    reg_hash: str
+            SHA-1 hash of reg_in, computed if not supplied
+
+    Outputs
+    =======
+    xfm: numpy.ndarray
+            4x4 affine matrix
+    """
+
+    if reg_hash == None:
+        reg_hash = file_hash(reg_in)
+    if reg_hash in ITK_XFMS:
+        return ITK_XFMS[reg_hash].copy()
+
+    if op.splitext(reg_in)[-1] == ".mat":
+        from scipy.io import loadmat
+
+        mat = loadmat(reg_in)
+        parameter_keys = [key for key in mat if key.startswith("AffineTransform")]
+        if len(parameter_keys) == 0 or "fixed" not in mat:
+            raise Exception(f"Could not find an affine transform in {reg_in}.")
+        parameters = np.ravel(mat[parameter_keys[0]]).astype(np.float64)
+        fixed_parameters = np.ravel(mat["fixed"]).astype(np.float64)
+    else:
+        parameters = None
+        fixed_parameters = np.zeros(3)
+        with open(reg_in) as f:
+            for line in f:
+                key, _, values = line.partition(":")
+                if key.strip() == "Parameters":
+                    parameters = np.array(values.split(), dtype=np.float64)
+                elif key.strip() == "FixedParameters":
+                    fixed_parameters = np.array(values.split(), dtype=np.float64)
+        if parameters is None:
+            raise Exception(f"Could not find transform parameters in {reg_in}.")
+    if len(parameters) != 12 or len(fixed_parameters) != 3:
+        raise Exception(f"{reg_in} is not a 3D affine transform.")
+
+    # ITK rotates about the centre in FixedParameters: y = A (x - c) + c + t
+    matrix = parameters[:9].reshape(3, 3)
+    centre = fixed_parameters
+    xfm = np.eye(4)
+    xfm[:3, :3] = matrix
+    xfm[:3, 3] = parameters[9:] + centre - matrix @ centre
+
+    # ITK works in LPS coordinates, MRtrix in RAS
+    lps_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+    xfm = lps_to_ras @ xfm @ lps_to_ras
+
+    ITK_XFMS[reg_hash] = xfm
+
+    return xfm.copy()
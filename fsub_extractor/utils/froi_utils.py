@@ -1,7 +1,11 @@
 import os.path as op
 import os
+import numpy as np
 from fsub_extractor.utils.system_utils import *
 
+# Projection operators already loaded in this process, keyed by subject/hemi/projfrac/backend
+PROJECTION_OPERATORS = {}
+
 
 def project_roi(
     roi_in,
@@ -11,6 +15,7 @@ def project_roi(
     hemi,
     outdir,
     projfrac_params=[-1, 0, 0.05],
+    projection_backend="freesurfer",
     overwrite=True,
 ):
     """Makes volumetric file of ROI mapped on white matter surface
@@ -31,6 +36,12 @@ def project_roi(
             List containing strings of ['start','stop','delta'] parameters for projfrac
     outdir: str
             Path to output directory, including output prefix
+    projection_backend: str
+            "operator" projects surface ROIs with a cached per-subject, per-hemisphere projection operator (see get_projection_operator).
+            "native" does the same with an operator built in Python, and samples volumetric ROIs onto the surface in Python, so no FreeSurfer binaries are run.
+            "freesurfer" (default) runs mri_label2vol / mri_surf2vol for every ROI.
+            The operators fill each voxel from the last vertex projected into it (as mri_surf2vol does), so .label
+            ROIs can differ from mri_label2vol, which fills a voxel if any label vertex projects into it.
     overwrite: bool
             Whether to allow overwriting outputs
 
@@ -40,11 +51,15 @@ def project_roi(
     Image is saved out to "outdir/{subject}_rec-surf2vol/label2vol_space-FS_desc-{roi_name}.nii.gz"
     """
 
-    # Tell FreeSurfer where subject data are
-    os.environ["SUBJECTS_DIR"] = fs_dir
+    # Tell FreeSurfer where subject data are (without changing our own environment)
+    fs_env = dict(os.environ, SUBJECTS_DIR=fs_dir)
 
     # If starting with volume
-    if roi_in[-7:] == ".nii.gz":
+    if roi_in[-7:] == ".nii.gz" and projection_backend == "native":
+        print("Using volumetric ROI projection pipeline")
+        roi_surf = None
+        roi_values = sample_volume_on_surface(roi_in, fs_dir, subject, hemi)
+    elif roi_in[-7:] == ".nii.gz":
         print("Using volumetric ROI projection pipeline")
 
         # Define output name for surface file
@@ -67,11 +82,40 @@ def project_roi(
         ]
 
         ## Run the command
-        run_command(cmd_mri_vol2surf)
+        run_command(cmd_mri_vol2surf, env=fs_env)
 
     else:
         roi_surf = roi_in
 
+    # Project surface ROIs with a sparse mat-vec if using a projection operator
+    if projection_backend != "freesurfer":
+        print(f"Projecting surface ROI with {hemi} projection operator")
+        if roi_surf != None and roi_surf[-6:] == ".label":
+            rec_label = "label2vol"
+        else:
+            rec_label = "surf2vol"
+        roi_projected = op.join(
+            outdir, f"{subject}_rec-{rec_label}_space-FS_desc-{roi_name}.nii.gz"
+        )
+        if overwrite == False:
+            overwrite_check(roi_projected)
+        operator = get_projection_operator(
+            fs_dir,
+            subject,
+            hemi,
+            projfrac_params,
+            cache_dir=outdir,
+            backend=projection_backend,
+        )
+        if roi_surf != None:
+            roi_values = load_surface_roi(roi_surf, n_vertices=operator.shape[0])
+        return project_surface_values(
+            roi_values,
+            operator,
+            op.join(fs_dir, subject, "mri", "orig.mgz"),
+            roi_projected,
+        )
+
     # If starting with a .label
     if roi_surf[-6:] == ".label":
         print("Projecting FS .label file")
@@ -98,7 +142,7 @@ def project_roi(
             projfrac_params[2],
             "--identity",
         ]
-        run_command(cmd_mri_label2vol)
+        run_command(cmd_mri_label2vol, env=fs_env)
 
     # Go from surface to volume
     if roi_surf[-4:] == ".mgz" or roi_surf[-4:] == ".gii":
@@ -130,11 +174,209 @@ def project_roi(
             roi_projected,
         ]
 
-        run_command(cmd_mri_surf2vol)
+        run_command(cmd_mri_surf2vol, env=fs_env)
 
     return roi_projected
 
 
+def project_rois_batch(
+    rois,
+    fs_dir,
+    subject,
+    outdir,
+    atlas_name,
+    projfrac_params=[-1, 0, 0.05],
+    projection_backend="operator",
+    save_masks=False,
+    overwrite=True,
+):
+    """Projects many ROIs from both hemispheres into one integer-labelled volume in a single pass
+    Each hemisphere's ROIs are turned into one vertex labelling, which is projected with the
+    hemisphere's projection operator (see get_projection_operator). Hemispheres run concurrently,
+    and FreeSurfer tools (if any) get SUBJECTS_DIR without changing the parent environment.
+
+    Parameters
+    ==========
+    rois: dict
+            Maps 'lh' and/or 'rh' to either a list of ROI files (.label, .mgz, .gii, .nii.gz) or the path to an annotation (.annot)
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    outdir: str
+            Path to output directory
+    atlas_name: str
+            What to call the labelled volume in filenames
+    projfrac_params: list
+            List containing strings of ['start','stop','delta'] parameters for projfrac
+    projection_backend: str
+            "operator" or "native" (see project_roi)
+    save_masks: bool
+            Whether to also save a binary mask for each ROI
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns paths to the labelled volume and its label table
+    outdir/{subject}_rec-surf2vol_space-FS_desc-{atlas_name}_dseg.nii.gz is the labelled volume (0 outside ROIs)
+    outdir/{subject}_rec-surf2vol_space-FS_desc-{atlas_name}_dseg.tsv lists the index, name and hemisphere of each label
+    outdir/{subject}_rec-surf2vol_space-FS_desc-{name}.nii.gz are the ROI masks, if save_masks
+    """
+    import nibabel as nib
+    from concurrent.futures import ThreadPoolExecutor
+
+    if projection_backend == "freesurfer":
+        raise Exception(
+            "Batch ROI projection requires the 'operator' or 'native' projection backend."
+        )
+
+    dseg_out = op.join(
+        outdir, f"{subject}_rec-surf2vol_space-FS_desc-{atlas_name}_dseg.nii.gz"
+    )
+    dseg_table_out = dseg_out.replace(".nii.gz", ".tsv")
+    if overwrite == False:
+        overwrite_check(dseg_out)
+        overwrite_check(dseg_table_out)
+
+    # Number labels consecutively across hemispheres (lh first)
+    hemis = [hemi for hemi in ["lh", "rh"] if hemi in rois]
+    first_labels = {}
+    next_label = 1
+    hemi_rois = {}
+    for hemi in hemis:
+        hemi_rois[hemi] = surface_roi_names(rois[hemi])
+        first_labels[hemi] = next_label
+        next_label += len(hemi_rois[hemi])
+
+    def project_hemi(hemi):
+        operator = get_projection_operator(
+            fs_dir,
+            subject,
+            hemi,
+            projfrac_params,
+            cache_dir=outdir,
+            backend=projection_backend,
+        )
+        vertex_labels = surface_roi_labels(
+            rois[hemi], fs_dir, subject, hemi, n_vertices=operator.shape[0]
+        )
+        # Offset labels so they are unique across hemispheres
+        vertex_labels = np.where(
+            vertex_labels > 0, vertex_labels + first_labels[hemi] - 1, 0
+        )
+        # Each voxel is filled by one vertex, so the mat-vec carries its label over
+        return np.rint(operator.T @ vertex_labels).astype(np.int32)
+
+    with ThreadPoolExecutor(max_workers=len(hemis)) as executor:
+        hemi_volumes = list(executor.map(project_hemi, hemis))
+
+    # Where hemispheres overlap, keep the first one
+    labels = np.zeros_like(hemi_volumes[0])
+    for hemi_volume in hemi_volumes:
+        labels = np.where(labels == 0, hemi_volume, labels)
+
+    template_img = nib.load(op.join(fs_dir, subject, "mri", "orig.mgz"))
+    labels = labels.reshape(template_img.shape[:3])
+    nib.save(nib.Nifti1Image(labels, template_img.affine), dseg_out)
+
+    with open(dseg_table_out, "w") as f:
+        f.write("index\tname\themi\n")
+        for hemi in hemis:
+            for i, roi_name in enumerate(hemi_rois[hemi]):
+                label = first_labels[hemi] + i
+                f.write(f"{label}\t{roi_name}\t{hemi}\n")
+                if save_masks:
+                    mask_out = op.join(
+                        outdir,
+                        f"{subject}_rec-surf2vol_space-FS_desc-{roi_name}.nii.gz",
+                    )
+                    if overwrite == False:
+                        overwrite_check(mask_out)
+                    nib.save(
+                        nib.Nifti1Image(
+                            (labels == label).astype(np.float32), template_img.affine
+                        ),
+                        mask_out,
+                    )
+
+    return dseg_out, dseg_table_out
+
+
+def surface_roi_names(hemi_rois):
+    """Lists ROI names for one hemisphere's ROIs in project_rois_batch
+
+    Parameters
+    ==========
+    hemi_rois: list or str
+            List of ROI files, or the path to an annotation (.annot)
+
+    Outputs
+    =======
+    roi_names: list
+            Name of each ROI (file names or annotation label names, with non-alphanumeric characters removed)
+    """
+    import nibabel as nib
+
+    if isinstance(hemi_rois, str) and hemi_rois[-6:] == ".annot":
+        _, _, names = nib.freesurfer.read_annot(hemi_rois)
+        names = [name.decode() for name in names]
+        names = [name for name in names if name.lower() not in ["unknown", "???"]]
+    else:
+        names = []
+        for roi in hemi_rois:
+            # e.g. lh.V1_exvivo.label -> V1_exvivo
+            name_parts = op.basename(roi).split(".")
+            if name_parts[0] in ["lh", "rh"]:
+                name_parts = name_parts[1:]
+            names.append(name_parts[0])
+
+    return ["".join(char for char in name if char.isalnum()) for name in names]
+
+
+def surface_roi_labels(hemi_rois, fs_dir, subject, hemi, n_vertices):
+    """Combines one hemisphere's ROIs into a single vertex labelling (1, 2, ... in the order of surface_roi_names)
+
+    Parameters
+    ==========
+    hemi_rois: list or str
+            List of ROI files (.label, .mgz, .gii, .nii.gz), or the path to an annotation (.annot)
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    hemi: str
+            Hemisphere ('lh' or 'rh')
+    n_vertices: int
+            Number of vertices in the hemisphere's surface
+
+    Outputs
+    =======
+    vertex_labels: numpy.ndarray
+            Label of each vertex (0 outside all ROIs). Later ROIs take precedence where ROIs overlap.
+    """
+    import nibabel as nib
+
+    vertex_labels = np.zeros(n_vertices, dtype=np.float32)
+    if isinstance(hemi_rois, str) and hemi_rois[-6:] == ".annot":
+        annot_labels, _, names = nib.freesurfer.read_annot(hemi_rois)
+        label = 1
+        for annot_label, name in enumerate(names):
+            if name.decode().lower() in ["unknown", "???"]:
+                continue
+            vertex_labels[annot_labels == annot_label] = label
+            label += 1
+    else:
+        for label, roi in enumerate(hemi_rois, start=1):
+            if roi[-7:] == ".nii.gz":
+                roi_values = sample_volume_on_surface(roi, fs_dir, subject, hemi)
+            else:
+                roi_values = load_surface_roi(roi, n_vertices)
+            vertex_labels[roi_values > 0] = label
+
+    return vertex_labels
+
+
 def intersect_gmwmi(roi_in, roi_name, gmwmi, outpath_base, overwrite=True):
     """Intersects an input ROI file with the GMWMI
 
@@ -197,6 +439,7 @@ def merge_rois(roi1, roi2, out_file, overwrite=True):
     """Creates the input ROI atlas-like file to be passed into tck2connectome.
         Multiplies the second ROI file passed by 2, and merges this file with the first file.
         Returns the merged file
+        NIFTI ROIs are merged in-process within their bounding box; .mif ROIs are merged with mrcalc.
     Parameters
     ==========
     roi1: str
@@ -215,6 +458,30 @@ def merge_rois(roi1, roi2, out_file, overwrite=True):
 
     """
 
+    if ".mif" not in [op.splitext(roi)[-1] for roi in [roi1, roi2, out_file]]:
+        import nibabel as nib
+
+        if overwrite == False:
+            overwrite_check(out_file)
+
+        roi1_img = nib.load(roi1)
+        roi2_img = nib.load(roi2)
+        if roi1_img.shape[:3] != roi2_img.shape[:3] or not np.allclose(
+            roi1_img.affine, roi2_img.affine
+        ):
+            raise Exception(f"{roi1} and {roi2} are not on the same voxel grid.")
+        roi1_data = np.asanyarray(roi1_img.dataobj)
+        roi2_data = np.asanyarray(roi2_img.dataobj)
+
+        # Only the voxels around the ROIs can be nonzero
+        merged = np.zeros(roi1_img.shape[:3], dtype=np.float32)
+        bbox = union_bbox([mask_bbox(roi1_data), mask_bbox(roi2_data)])
+        if bbox != None:
+            merged[bbox] = roi1_data[bbox] + 2 * roi2_data[bbox]
+        nib.save(nib.Nifti1Image(merged, roi1_img.affine), out_file)
+
+        return out_file
+
     roi2_mult2 = roi2.removesuffix(".nii.gz") + "_mult-2.nii.gz"
 
     mrcalc = find_program("mrcalc")
@@ -227,7 +494,7 @@ def merge_rois(roi1, roi2, out_file, overwrite=True):
 
     # Abort if file already exists and overwriting not allowed
     if overwrite == False:
-        overwrite_check(labelled_roi2)
+        overwrite_check(roi2_mult2)
         overwrite_check(out_file)
     else:
         cmd_mrcalc_mult += ["-force"]
@@ -292,3 +559,835 @@ def register_to_dwi(
     run_command(cmd_mrtransform)
 
     return out_file
+
+
+def resample_roi_once(
+    roi_in,
+    roi_name,
+    outpath_base,
+    mrtrix_xfm=None,
+    invert=False,
+    gmwmi=None,
+    overwrite=True,
+):
+    """Registers an ROI to DWI space and intersects it with the GMWMI with a single nearest-neighbour resample
+    Replaces register_to_dwi followed by intersect_gmwmi. The registration is composed with the GMWMI grid,
+    so each GMWMI voxel looks up its ROI value directly, and only voxels inside the GMWMI are sampled.
+    Falls back to register_to_dwi / intersect_gmwmi (MRtrix) if any input is a .mif file.
+
+    Parameters
+    ==========
+    roi_in: str
+            Path to input ROI mask file in FreeSurfer space (.nii.gz). Should be binary (1 in ROI, 0 elsewhere).
+    roi_name: str
+            What to call the ROI in filenames
+    outpath_base: str
+            Path to output directory, including output prefix
+    mrtrix_xfm: str
+            Path to transform in mrtrix-readable format (None if the ROI is already in DWI space)
+    invert: bool
+            Whether to invert the transformation
+    gmwmi: str
+            Path to binarized gray-matter-white-matter-interface image in DWI space (None to skip the intersection)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns path to the resampled ROI.
+    If gmwmi is given, the ROI is saved out to "{outpath_base}_rec-intersected_desc-{roi_name}.nii.gz" on the GMWMI grid.
+    Otherwise only the image header is transformed (like mrtransform without -template), and the ROI is saved out to
+    roi_in with "space-FS" replaced by "space-DWI".
+    """
+    import nibabel as nib
+
+    if gmwmi != None:
+        out_file = f"{outpath_base}_rec-intersected_desc-{roi_name}.nii.gz"
+    else:
+        out_file = roi_in.replace("space-FS", "space-DWI")
+        if out_file == roi_in:
+            out_file = f"{outpath_base}_space-DWI_desc-{roi_name}.nii.gz"
+
+    # MRtrix images cannot be read here, so fall back to the MRtrix tools
+    if ".mif" in [op.splitext(file)[-1] for file in [roi_in, gmwmi] if file != None]:
+        if mrtrix_xfm != None:
+            roi_in = register_to_dwi(
+                roi_in,
+                roi_in.replace("space-FS", "space-DWI"),
+                mrtrix_xfm,
+                invert=invert,
+                interp="nearest",
+                overwrite=True,
+            )
+        if gmwmi != None:
+            roi_in = intersect_gmwmi(
+                roi_in=roi_in,
+                roi_name=roi_name,
+                gmwmi=gmwmi,
+                outpath_base=outpath_base,
+                overwrite=overwrite,
+            )
+        return roi_in
+
+    if overwrite == False:
+        overwrite_check(out_file)
+
+    # Maps DWI (output) scanner coordinates to FS (input) scanner coordinates
+    if mrtrix_xfm == None:
+        out2in = np.eye(4)
+    else:
+        out2in = dwi_to_fs_xfm(mrtrix_xfm, invert=invert)
+
+    roi_img = nib.load(roi_in)
+    if gmwmi == None:
+        # No target grid, so only move the image in space
+        nib.save(
+            nib.Nifti1Image(
+                np.asanyarray(roi_img.dataobj),
+                np.linalg.inv(out2in) @ roi_img.affine,
+                roi_img.header,
+            ),
+            out_file,
+        )
+        return out_file
+
+    roi_data = np.asanyarray(roi_img.dataobj)
+    gmwmi_img = nib.load(gmwmi)
+    out_data = np.zeros(gmwmi_img.shape[:3], dtype=np.float32)
+
+    # GMWMI voxels -> DWI scanner space -> FS scanner space -> ROI voxels, in one matrix
+    gmwmi_vox2roi_vox = np.linalg.inv(roi_img.affine) @ out2in @ gmwmi_img.affine
+
+    # Only work within the ROI's bounding box, and the part of the GMWMI grid that maps into it
+    roi_bbox = mask_bbox(roi_data)
+    if roi_bbox != None:
+        gmwmi_bbox = transform_bbox(
+            roi_bbox, np.linalg.inv(gmwmi_vox2roi_vox), gmwmi_img.shape[:3]
+        )
+    if roi_bbox != None and gmwmi_bbox != None:
+        roi_crop = roi_data[roi_bbox]
+        gmwmi_crop = np.asanyarray(gmwmi_img.dataobj[gmwmi_bbox])
+        out_crop = out_data[gmwmi_bbox]
+
+        gmwmi_voxels = np.argwhere(gmwmi_crop > 0)
+        roi_voxels = np.rint(
+            nib.affines.apply_affine(
+                gmwmi_vox2roi_vox, gmwmi_voxels + bbox_offset(gmwmi_bbox)
+            )
+        ).astype(np.int64) - bbox_offset(roi_bbox)
+        inside = np.all((roi_voxels >= 0) & (roi_voxels < roi_crop.shape[:3]), axis=1)
+
+        gmwmi_voxels = gmwmi_voxels[inside]
+        out_crop[tuple(gmwmi_voxels.T)] = (
+            roi_crop[tuple(roi_voxels[inside].T)] * gmwmi_crop[tuple(gmwmi_voxels.T)]
+        )
+
+    nib.save(nib.Nifti1Image(out_data, gmwmi_img.affine), out_file)
+
+    return out_file
+
+
+def mask_bbox(data, margin=1):
+    """Finds the bounding box of the nonzero voxels of a mask, padded by a margin
+
+    Parameters
+    ==========
+    data: numpy.ndarray
+            3D mask (nonzero inside)
+    margin: int
+            Number of voxels to pad the bounding box by on each side (clipped to the grid)
+
+    Outputs
+    =======
+    bbox: tuple
+            Tuple of 3 slices selecting the bounding box (None if the mask is empty)
+    """
+
+    bbox = []
+    for axis in range(3):
+        other_axes = tuple(other for other in range(data.ndim) if other != axis)
+        nonzero = np.flatnonzero(np.any(data, axis=other_axes))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(
+            slice(
+                max(nonzero[0] - margin, 0),
+                min(nonzero[-1] + margin + 1, data.shape[axis]),
+            )
+        )
+
+    return tuple(bbox)
+
+
+def union_bbox(bboxes):
+    """Finds the smallest bounding box containing all given bounding boxes (None entries are ignored)
+
+    Parameters
+    ==========
+    bboxes: list
+            Bounding boxes, as returned by mask_bbox
+
+    Outputs
+    =======
+    bbox: tuple
+            Tuple of 3 slices (None if all bounding boxes are None)
+    """
+
+    bboxes = [bbox for bbox in bboxes if bbox != None]
+    if len(bboxes) == 0:
+        return None
+
+    return tuple(
+        slice(
+            min(bbox[axis].start for bbox in bboxes),
+            max(bbox[axis].stop for bbox in bboxes),
+        )
+        for axis in range(3)
+    )
+
+
+def bbox_offset(bbox):
+    """Returns the voxel index of a bounding box's first corner, for going between cropped and full grids
+
+    Parameters
+    ==========
+    bbox: tuple
+            Bounding box, as returned by mask_bbox
+
+    Outputs
+    =======
+    offset: numpy.ndarray
+            (3,) voxel offset of the cropped array within the full grid
+    """
+
+    return np.array([axis.start for axis in bbox], dtype=np.int64)
+
+
+def transform_bbox(bbox, vox2vox, shape):
+    """Finds the bounding box, in another voxel grid, of every voxel that rounds into a bounding box
+
+    Parameters
+    ==========
+    bbox: tuple
+            Bounding box in the source grid, as returned by mask_bbox
+    vox2vox: numpy.ndarray
+            4x4 affine mapping source voxel indices to target voxel indices
+    shape: tuple
+            Shape of the target grid
+
+    Outputs
+    =======
+    bbox: tuple
+            Tuple of 3 slices in the target grid (None if the bounding box falls outside it)
+    """
+    import itertools
+    import nibabel as nib
+
+    # Edges of the voxels, not their centres, so nearest-neighbour lookups near the edge are kept
+    corners = np.array(
+        list(itertools.product(*[[axis.start - 0.5, axis.stop - 0.5] for axis in bbox]))
+    )
+    corners = nib.affines.apply_affine(vox2vox, corners)
+    lower = np.maximum(np.floor(corners.min(axis=0)).astype(np.int64), 0)
+    upper = np.minimum(np.ceil(corners.max(axis=0)).astype(np.int64) + 1, shape)
+    if np.any(lower >= upper):
+        return None
+
+    return tuple(slice(start, stop) for start, stop in zip(lower, upper))
+
+
+def load_mrtrix_xfm(mrtrix_xfm):
+    """Reads a linear transform in mrtrix-readable format (3x4 or 4x4 text, '#' comments)
+
+    Parameters
+    ==========
+    mrtrix_xfm: str
+            Path to transform in mrtrix-readable format
+
+    Outputs
+    =======
+    xfm: numpy.ndarray
+            4x4 affine matrix
+    """
+
+    xfm = np.loadtxt(mrtrix_xfm, comments="#", ndmin=2)
+    if xfm.shape == (3, 4):
+        xfm = np.vstack([xfm, [0, 0, 0, 1]])
+    elif xfm.shape != (4, 4):
+        raise Exception(
+            f"Could not read a 3x4 or 4x4 linear transform from {mrtrix_xfm}."
+        )
+
+    return xfm
+
+
+def dwi_to_fs_xfm(mrtrix_xfm, invert=False):
+    """Returns the affine mapping DWI scanner coordinates to FreeSurfer scanner coordinates
+    Follows the reverse convention of mrtransform -linear, where the transform passed to register_to_dwi
+    maps points in the registered (DWI) image to points in the input (FS) image.
+
+    Parameters
+    ==========
+    mrtrix_xfm: str
+            Path to transform in mrtrix-readable format
+    invert: bool
+            Whether the transform is inverted when registering to DWI space (i.e., it is a DWI-to-FS registration)
+
+    Outputs
+    =======
+    xfm: numpy.ndarray
+            4x4 affine matrix
+    """
+
+    xfm = load_mrtrix_xfm(mrtrix_xfm)
+    if invert:
+        xfm = np.linalg.inv(xfm)
+
+    return xfm
+
+
+def load_surface_roi(roi_surf, n_vertices):
+    """Loads a surface ROI as one value per vertex
+
+    Parameters
+    ==========
+    roi_surf: str
+            Path to surface ROI (.label, .mgz, .gii)
+    n_vertices: int
+            Number of vertices in the hemisphere's surface
+
+    Outputs
+    =======
+    roi_values: numpy.ndarray
+            ROI value at each vertex (1 for vertices of a .label, 0 elsewhere)
+    """
+    import nibabel as nib
+
+    if roi_surf[-6:] == ".label":
+        roi_values = np.zeros(n_vertices, dtype=np.float32)
+        roi_values[nib.freesurfer.read_label(roi_surf)] = 1
+    elif roi_surf[-4:] == ".gii":
+        roi_values = np.asarray(nib.load(roi_surf).darrays[0].data).ravel()
+    else:
+        roi_values = np.asarray(nib.load(roi_surf).dataobj).ravel()
+
+    if len(roi_values) != n_vertices:
+        raise Exception(
+            f"{roi_surf} has {len(roi_values)} values, but the surface has {n_vertices} vertices."
+        )
+
+    return roi_values.astype(np.float32)
+
+
+def project_surface_values(roi_values, operator, template, out_file):
+    """Projects per-vertex values into a volume with a projection operator
+
+    Parameters
+    ==========
+    roi_values: numpy.ndarray
+            Value at each vertex
+    operator: scipy.sparse matrix
+            (vertices x voxels) projection operator, as returned by get_projection_operator
+    template: str
+            Path to image defining the output grid (the subject's orig.mgz)
+    out_file: str
+            Path to save the projected volume (.nii.gz)
+
+    Outputs
+    =======
+    out_file: str
+            Path to the projected volume
+    """
+    import nibabel as nib
+
+    template_img = nib.load(template)
+    volume = (operator.T @ roi_values).astype(np.float32)
+    nib.save(
+        nib.Nifti1Image(volume.reshape(template_img.shape[:3]), template_img.affine),
+        out_file,
+    )
+
+    return out_file
+
+
+def get_projection_operator(
+    fs_dir, subject, hemi, projfrac_params, cache_dir, backend="operator"
+):
+    """Returns a sparse (vertices x voxels) operator that projects surface values into the orig.mgz volume
+    Each voxel filled by the projfrac projection is linked to the vertex that fills it. The operator is
+    built once per subject, hemisphere and projfrac_params, then reused from memory or from its cache
+    file, as long as the surface, thickness and orig.mgz files it was built from are unchanged.
+
+    Parameters
+    ==========
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    hemi: str
+            Hemisphere ('lh' or 'rh')
+    projfrac_params: list
+            List containing strings of ['start','stop','delta'] parameters for projfrac
+    cache_dir: str
+            Directory to save the operator (.npz) and its .json sidecar
+    backend: str
+            How to build the operator ("operator" runs mri_surf2vol once, "native" builds it in Python)
+
+    Outputs
+    =======
+    operator: scipy.sparse.csr_matrix
+            (vertices x voxels) projection operator
+    """
+    from scipy import sparse
+
+    key = (
+        fs_dir,
+        subject,
+        hemi,
+        tuple(str(param) for param in projfrac_params),
+        backend,
+    )
+    if key in PROJECTION_OPERATORS:
+        return PROJECTION_OPERATORS[key]
+
+    source_files = [
+        op.join(fs_dir, subject, "surf", f"{hemi}.white"),
+        op.join(fs_dir, subject, "surf", f"{hemi}.thickness"),
+        op.join(fs_dir, subject, "mri", "orig.mgz"),
+    ]
+    operator_info = {
+        "Subject": subject,
+        "Hemisphere": hemi,
+        "ProjfracParams": list(key[3]),
+        "Backend": backend,
+        "SourceHashes": {source: file_hash(source) for source in source_files},
+    }
+    operator_id = string_hash(str(sorted(operator_info.items())))[:8]
+    operator_file = op.join(
+        cache_dir, f"{subject}_hemi-{hemi}_space-FS_desc-proj{operator_id}_xfm.npz"
+    )
+    sidecar = operator_file.replace(".npz", ".json")
+
+    if op.exists(operator_file) and load_json(sidecar) == operator_info:
+        print(f"Using cached projection operator {operator_file}")
+        operator = sparse.load_npz(operator_file)
+    elif backend == "native":
+        operator = build_projection_operator_native(
+            fs_dir, subject, hemi, projfrac_params
+        )
+    else:
+        operator = build_projection_operator(
+            fs_dir, subject, hemi, projfrac_params, cache_dir
+        )
+    if load_json(sidecar) != operator_info:
+        sparse.save_npz(operator_file, operator)
+        save_json(operator_info, sidecar)
+
+    PROJECTION_OPERATORS[key] = operator
+
+    return operator
+
+
+def build_projection_operator(fs_dir, subject, hemi, projfrac_params, outdir):
+    """Builds a projection operator by running mri_surf2vol once, with vertex numbers as surface values
+    Voxels take the value of the (last) vertex projected into them, so projecting a vertex-number
+    overlay reveals which vertex fills each voxel.
+
+    Parameters
+    ==========
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    hemi: str
+            Hemisphere ('lh' or 'rh')
+    projfrac_params: list
+            List containing strings of ['start','stop','delta'] parameters for projfrac
+    outdir: str
+            Directory for intermediate files
+
+    Outputs
+    =======
+    operator: scipy.sparse.csr_matrix
+            (vertices x voxels) projection operator
+    """
+    import nibabel as nib
+    from scipy import sparse
+
+    # Write vertex numbers (plus one, so that 0 means no vertex) as a surface overlay
+    n_vertices = len(
+        nib.freesurfer.read_morph_data(
+            op.join(fs_dir, subject, "surf", f"{hemi}.thickness")
+        )
+    )
+    vertex_numbers = op.join(
+        outdir, f"{subject}_hemi-{hemi}_space-FS_desc-vertexnumbers.mgz"
+    )
+    nib.save(
+        nib.MGHImage(
+            np.arange(1, n_vertices + 1, dtype=np.float32).reshape(-1, 1, 1), np.eye(4)
+        ),
+        vertex_numbers,
+    )
+
+    vertex_volume = op.join(
+        outdir, f"{subject}_hemi-{hemi}_rec-surf2vol_space-FS_desc-vertexnumbers.nii.gz"
+    )
+    mri_surf2vol = find_program("mri_surf2vol")
+    cmd_mri_surf2vol = [
+        mri_surf2vol,
+        "--surfval",
+        vertex_numbers,
+        "--hemi",
+        hemi,
+        "--surf",
+        "white",
+        "--fill-projfrac",
+        str(projfrac_params[0]),
+        str(projfrac_params[1]),
+        str(projfrac_params[2]),
+        "--subject",
+        subject,
+        "--identity",
+        subject,
+        "--template",
+        op.join(fs_dir, subject, "mri", "orig.mgz"),
+        "--o",
+        vertex_volume,
+    ]
+    run_command(cmd_mri_surf2vol, env=dict(os.environ, SUBJECTS_DIR=fs_dir))
+
+    voxel_vertices = np.asarray(nib.load(vertex_volume).dataobj).ravel()
+    voxel_index = np.flatnonzero(voxel_vertices > 0)
+    vertex_index = np.rint(voxel_vertices[voxel_index]).astype(np.int64) - 1
+    os.remove(vertex_numbers)
+    os.remove(vertex_volume)
+
+    return sparse.csr_matrix(
+        (np.ones(len(voxel_index), dtype=np.float32), (vertex_index, voxel_index)),
+        shape=(n_vertices, len(voxel_vertices)),
+    )
+
+
+def build_projection_operator_native(fs_dir, subject, hemi, projfrac_params):
+    """Builds a projection operator in Python from the subject's FreeSurfer files
+    Reads the white surface, cortical thickness and the orig.mgz header, then calls projection_operator_from_mesh.
+
+    Parameters
+    ==========
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    hemi: str
+            Hemisphere ('lh' or 'rh')
+    projfrac_params: list
+            List containing strings of ['start','stop','delta'] parameters for projfrac
+
+    Outputs
+    =======
+    operator: scipy.sparse.csr_matrix
+            (vertices x voxels) projection operator
+    """
+    import nibabel as nib
+
+    vertices, faces = nib.freesurfer.read_geometry(
+        op.join(fs_dir, subject, "surf", f"{hemi}.white")
+    )
+    thickness = nib.freesurfer.read_morph_data(
+        op.join(fs_dir, subject, "surf", f"{hemi}.thickness")
+    )
+    orig = nib.load(op.join(fs_dir, subject, "mri", "orig.mgz"))
+
+    return projection_operator_from_mesh(
+        vertices,
+        faces,
+        thickness,
+        orig.header.get_vox2ras_tkr(),
+        orig.shape[:3],
+        projfrac_params,
+    )
+
+
+def vertex_normals(vertices, faces):
+    """Computes outward-facing unit normals at each vertex of a closed triangle mesh
+
+    Parameters
+    ==========
+    vertices: numpy.ndarray
+            (V, 3) vertex coordinates
+    faces: numpy.ndarray
+            (F, 3) vertex indices of each triangle
+
+    Outputs
+    =======
+    normals: numpy.ndarray
+            (V, 3) unit normals (area-weighted average of the adjacent faces' normals)
+    """
+    triangles = vertices[faces]
+    face_normals = np.cross(
+        triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    )
+    normals = np.zeros_like(vertices, dtype=np.float64)
+    for corner in range(3):
+        np.add.at(normals, faces[:, corner], face_normals)
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+    # Flip if the winding order makes normals point inwards
+    if np.sum(normals * (vertices - vertices.mean(axis=0))) < 0:
+        normals = -normals
+
+    return normals
+
+
+def projection_operator_from_mesh(
+    vertices, faces, thickness, vox2ras_tkr, shape, projfrac_params
+):
+    """Builds a projection operator by stepping each vertex along its normal (like mri_surf2vol --fill-projfrac)
+    For each fraction from start to stop (inclusive) in steps of delta, every vertex is moved by
+    fraction * thickness along its normal and the voxel it lands in is filled with that vertex.
+    When several vertices land in the same voxel, the last one wins.
+
+    Parameters
+    ==========
+    vertices: numpy.ndarray
+            (V, 3) vertex coordinates in FreeSurfer surface (tkregister) space
+    faces: numpy.ndarray
+            (F, 3) vertex indices of each triangle
+    thickness: numpy.ndarray
+            Cortical thickness at each vertex
+    vox2ras_tkr: numpy.ndarray
+            Voxel-to-surface-space affine of the output grid (e.g., from orig.mgz)
+    shape: tuple
+            Shape of the output grid
+    projfrac_params: list
+            ['start','stop','delta'] parameters for projfrac
+
+    Outputs
+    =======
+    operator: scipy.sparse.csr_matrix
+            (vertices x voxels) projection operator
+    """
+    from scipy import sparse
+
+    start, stop, delta = [float(param) for param in projfrac_params]
+    fractions = start + delta * np.arange(
+        int(np.floor((stop - start) / delta + 1e-6)) + 1
+    )
+    normals = vertex_normals(vertices, faces)
+    ras2vox = np.linalg.inv(vox2ras_tkr)
+
+    # Voxel hit by each vertex at each fraction, in fill order (fraction-major)
+    steps = fractions[:, np.newaxis, np.newaxis] * (thickness[:, np.newaxis] * normals)
+    points = (vertices[np.newaxis] + steps).reshape(-1, 3)
+    voxels = np.rint(points @ ras2vox[:3, :3].T + ras2vox[:3, 3]).astype(np.int64)
+    vertex_index = np.tile(np.arange(len(vertices)), len(fractions))
+    inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+    voxel_index = np.ravel_multi_index(voxels[inside].T, shape)
+    vertex_index = vertex_index[inside]
+
+    # Keep the last vertex written to each voxel
+    voxel_index, last = np.unique(voxel_index[::-1], return_index=True)
+    vertex_index = vertex_index[::-1][last]
+
+    return sparse.csr_matrix(
+        (np.ones(len(voxel_index), dtype=np.float32), (vertex_index, voxel_index)),
+        shape=(len(vertices), int(np.prod(shape))),
+    )
+
+
+def sample_volume_on_surface(roi_in, fs_dir, subject, hemi):
+    """Samples a volume at each white surface vertex (like mri_vol2surf --regheader, nearest neighbour)
+
+    Parameters
+    ==========
+    roi_in: str
+            Path to volume (.nii.gz) aligned with the subject's FreeSurfer anatomy (by scanner coordinates)
+    fs_dir: str
+            Path to FreeSurfer subjects folder
+    subject: str
+            Subject name. Must match folder name in fs_dir.
+    hemi: str
+            Hemisphere ('lh' or 'rh')
+
+    Outputs
+    =======
+    roi_values: numpy.ndarray
+            Volume value at each vertex (0 for vertices outside the volume)
+    """
+    import nibabel as nib
+
+    vertices, _ = nib.freesurfer.read_geometry(
+        op.join(fs_dir, subject, "surf", f"{hemi}.white")
+    )
+    orig = nib.load(op.join(fs_dir, subject, "mri", "orig.mgz"))
+    roi_img = nib.load(roi_in)
+    roi_data = np.asanyarray(roi_img.dataobj)
+
+    # Surface (tkregister) space -> scanner space -> ROI voxels
+    tkr2vox = (
+        np.linalg.inv(roi_img.affine)
+        @ orig.affine
+        @ np.linalg.inv(orig.header.get_vox2ras_tkr())
+    )
+    voxels = np.rint(nib.affines.apply_affine(tkr2vox, vertices)).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < roi_data.shape[:3]), axis=1)
+    roi_values = np.zeros(len(vertices), dtype=np.float32)
+    roi_values[inside] = roi_data[tuple(voxels[inside].T)]
+
+    return roi_values
+
+
+class ROI:
+    """Sparse ROI (or atlas of ROIs) on a voxel grid, stored as sorted linear voxel indices with a label per voxel
+    Memory scales with the number of ROI voxels rather than with the grid, and set operations and lookups
+    work on the index lists (np.searchsorted) instead of dense volumes.
+
+    Parameters
+    ==========
+    indices: array-like
+            Linear (C-order) indices of the ROI voxels
+    shape: tuple
+            Shape of the voxel grid
+    affine: numpy.ndarray
+            4x4 voxel-to-scanner affine of the grid
+    labels: array-like
+            Integer label of each voxel (all 1 if not supplied). Where indices repeat, the first label is kept.
+    """
+
+    def __init__(self, indices, shape, affine, labels=None):
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if labels is None:
+            labels = np.ones(len(indices), dtype=np.int32)
+        labels = np.asarray(labels, dtype=np.int32).ravel()
+        if len(labels) != len(indices):
+            raise Exception("ROI indices and labels must have the same length.")
+
+        self.shape = tuple(int(size) for size in shape[:3])
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.indices, first = np.unique(indices, return_index=True)
+        self.labels = labels[first]
+
+    @classmethod
+    def from_array(cls, data, affine, labelled=False):
+        """Makes an ROI from a dense volume (nonzero voxels are in the ROI; with labelled, values are rounded to labels)"""
+        data = np.asanyarray(data).reshape(np.shape(data)[:3])
+        indices = np.flatnonzero(data)
+        if labelled:
+            labels = np.rint(data.ravel()[indices])
+        else:
+            labels = None
+
+        return cls(indices, data.shape, affine, labels=labels)
+
+    @classmethod
+    def from_nifti(cls, roi_file, labelled=False):
+        """Loads an ROI from a NIFTI image (see from_array)"""
+        import nibabel as nib
+
+        roi_img = nib.load(roi_file)
+
+        return cls.from_array(roi_img.dataobj, roi_img.affine, labelled=labelled)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def voxels(self):
+        """Returns the (N, 3) voxel coordinates of the ROI, in index order"""
+        return np.stack(np.unravel_index(self.indices, self.shape), axis=1)
+
+    def to_array(self, dtype=np.float32):
+        """Returns the ROI as a dense volume holding each voxel's label (0 outside)"""
+        data = np.zeros(int(np.prod(self.shape)), dtype=dtype)
+        data[self.indices] = self.labels
+
+        return data.reshape(self.shape)
+
+    def to_nifti(self, out_file, overwrite=True):
+        """Saves the ROI as a NIFTI image holding each voxel's label, and returns its path"""
+        import nibabel as nib
+
+        if overwrite == False:
+            overwrite_check(out_file)
+        nib.save(nib.Nifti1Image(self.to_array(), self.affine), out_file)
+
+        return out_file
+
+    def check_grid(self, other):
+        """Raises an Exception if another ROI is not on the same voxel grid"""
+        if self.shape != other.shape or not np.allclose(self.affine, other.affine):
+            raise Exception("ROIs are not on the same voxel grid.")
+
+    def relabel(self, label):
+        """Returns a copy of the ROI with every voxel set to one label"""
+        return ROI(
+            self.indices,
+            self.shape,
+            self.affine,
+            labels=np.full(len(self), label, dtype=np.int32),
+        )
+
+    def union(self, other):
+        """Returns the voxels in either ROI (labels of this ROI take precedence where they overlap)"""
+        self.check_grid(other)
+
+        return ROI(
+            np.concatenate([self.indices, other.indices]),
+            self.shape,
+            self.affine,
+            labels=np.concatenate([self.labels, other.labels]),
+        )
+
+    def intersection(self, other):
+        """Returns the voxels in both ROIs (with the labels of this ROI)"""
+        self.check_grid(other)
+        inside = np.isin(self.indices, other.indices, assume_unique=True)
+
+        return ROI(
+            self.indices[inside], self.shape, self.affine, labels=self.labels[inside]
+        )
+
+    def difference(self, other):
+        """Returns the voxels of this ROI that are not in the other"""
+        self.check_grid(other)
+        outside = ~np.isin(self.indices, other.indices, assume_unique=True)
+
+        return ROI(
+            self.indices[outside],
+            self.shape,
+            self.affine,
+            labels=self.labels[outside],
+        )
+
+    def select_labels(self, labels):
+        """Returns the voxels whose label is in labels"""
+        inside = np.isin(self.labels, labels)
+
+        return ROI(
+            self.indices[inside], self.shape, self.affine, labels=self.labels[inside]
+        )
+
+    def lookup_voxels(self, voxels):
+        """Returns the label at each (N, 3) integer voxel coordinate (0 outside the ROI or the grid)"""
+        voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+        inside_grid = np.all((voxels >= 0) & (voxels < self.shape), axis=1)
+        labels = np.zeros(len(voxels), dtype=np.int32)
+        if len(self) == 0 or not np.any(inside_grid):
+            return labels
+
+        indices = np.ravel_multi_index(tuple(voxels[inside_grid].T), self.shape)
+        position = np.minimum(np.searchsorted(self.indices, indices), len(self) - 1)
+        found = self.indices[position] == indices
+        labels[np.flatnonzero(inside_grid)[found]] = self.labels[position[found]]
+
+        return labels
+
+    def lookup_points(self, points):
+        """Returns the label at each (N, 3) scanner-space point (nearest voxel, 0 outside)"""
+        import nibabel as nib
+
+        voxels = np.rint(
+            nib.affines.apply_affine(np.linalg.inv(self.affine), points)
+        ).astype(np.int64)
+
+        return self.lookup_voxels(voxels)
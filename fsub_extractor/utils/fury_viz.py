@@ -4,6 +4,7 @@ from fury import actor, window, colormap as cmap
 from os.path import exists
 import nibabel as nib
 import numpy as np
+from fsub_extractor.utils.streamline_utils import load_virtual_streamlines
 
 
 def visualize_sub_bundles(
@@ -30,7 +31,7 @@ def visualize_sub_bundles(
 
     Parameters
     ==========
-    fsub_bundle: Sub bundle output (.tck)
+    fsub_bundle: Sub bundle output (.tck, or virtual sub-bundle .npz)
     ref_anat: Reference anatomy (.nii.gz)
     fig_path = Path to save the figure
     fname = filename (.png)
@@ -59,8 +60,7 @@ def visualize_sub_bundles(
     reference_anatomy = nib.load(ref_anat)
 
     # Load in streamlines
-    fsub_streamlines = load_tck(fsub_bundle, reference_anatomy)
-    fsub_streamlines = fsub_streamlines.streamlines
+    fsub_streamlines = load_bundle_streamlines(fsub_bundle, reference_anatomy)
 
     # Repeat the color matrix for each streamline (fsub)
     n_fsub_streamlines = np.shape(fsub_streamlines)[0]
@@ -84,8 +84,7 @@ def visualize_sub_bundles(
 
     # Load in original streamlines if specified (e.g., extractor workflow, not generator)
     if orig_bundle != None:
-        orig_streamlines = load_tck(orig_bundle, reference_anatomy)
-        orig_streamlines = orig_streamlines.streamlines
+        orig_streamlines = load_bundle_streamlines(orig_bundle, reference_anatomy)
 
         # Repeat the color matrix for each streamline (orig)
         n_orig_streamlines = np.shape(orig_streamlines)[0]
@@ -156,7 +155,7 @@ def define_streamline_actor(tck, reference_anatomy, color):
     """Takes in tck reference anatomy files and outputs a fury streamline actor.
     Parameters
     ==========
-    tck: streamline to plot (.tck)
+    tck: streamline to plot (.tck, or virtual sub-bundle .npz)
     reference_anatomy: Reference anatomy (.nii.gz)
     color = color to plot streamlines as ([R,B,G])
 
@@ -168,8 +167,7 @@ def define_streamline_actor(tck, reference_anatomy, color):
     reference_anatomy = nib.load(reference_anatomy)
 
     # read in streamlines
-    streamlines = load_tck(tck, reference_anatomy)
-    streamlines = streamlines.streamlines
+    streamlines = load_bundle_streamlines(tck, reference_anatomy)
 
     # get number of streamlines in order to make them the same color
     n_streamlines = np.shape(streamlines)[0]
@@ -184,6 +182,22 @@ def define_streamline_actor(tck, reference_anatomy, color):
     return streamlines_actor
 
 
+def load_bundle_streamlines(bundle, reference_anatomy):
+    """Loads the streamlines of a .tck file, or of a virtual sub-bundle (.npz) directly from its parent tractogram
+    Parameters
+    ==========
+    bundle: streamlines to load (.tck, or virtual sub-bundle .npz)
+    reference_anatomy: Reference anatomy (nibabel image)
+
+    Outputs
+    =======
+    streamlines in RAS mm
+    """
+    if bundle[-4:] == ".npz":
+        return load_virtual_streamlines(bundle)
+    return load_tck(bundle, reference_anatomy).streamlines
+
+
 def define_roi_actor(roi_path, color, opacity=1, roi_val=1):
     """Takes in roi file and outputs a fury roi actor.
     Parameters
@@ -1,36 +1,2798 @@
 import os.path as op
 import os
+import random
+import time
+import warnings
+import numpy as np
 from fsub_extractor.utils.system_utils import *
 
+# Map MRtrix .tck datatypes to numpy dtypes
+TCK_DTYPES = {
+    "Float32LE": "<f4",
+    "Float32BE": ">f4",
+    "Float64LE": "<f8",
+    "Float64BE": ">f8",
+}
+
+# Number of seeds in a tckgen pilot run, if not specified
+PILOT_SEEDS_DEFAULT = 10000
+# Cap the main tckgen run at this multiple of the seeds expected from the pilot acceptance rate
+PILOT_SEED_MARGIN = 2
+# If the pilot accepts nothing, cap the main run at this multiple of the pilot seeds
+PILOT_ZERO_ACCEPTANCE_FACTOR = 10
+
 
 def trk_to_tck(trk_file, out_dir=os.getcwd(), overwrite=True):
     """Converts a .trk file to .tck using DIPY
     Parameters
     ==========
-    trk_file: str
-            Path to .trk file
-    ref: str
-            Path to image (.nii.gz) in same space as streamlines
-    out_dir: str
-            Path to output directory
+    trk_file: str
+            Path to .trk file
+    ref: str
+            Path to image (.nii.gz) in same space as streamlines
+    out_dir: str
+            Path to output directory
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    tck_file: str
+            Path to output .tck file
+    """
+    from dipy.io.streamline import load_tractogram, save_tractogram
+    import nibabel.filebasedimages
+
+    # trk_loaded = load_tractogram(trk_file, ref)
+    trk_loaded = load_tractogram(trk_file, "same")
+    filename = op.basename(trk_file).replace(".trk", ".tck")
+    tck_file = op.join(out_dir, filename)
+    save_tractogram(trk_loaded, tck_file)
+
+    return tck_file
+
+
+def read_tck_header(tck_file):
+    """Reads the text header of a .tck file
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+
+    Outputs
+    =======
+    header: dict
+            Header key/value pairs (values of repeated keys are joined with newlines).
+            The data offset from the 'file' entry is stored as an int under 'offset'.
+    """
+    header = {}
+    with open(tck_file, "rb") as f:
+        if f.readline().strip() != b"mrtrix tracks":
+            raise Exception(f"{tck_file} is not a valid MRtrix .tck file.")
+        for line in f:
+            line = line.decode("latin-1").rstrip("\n")
+            if line == "END":
+                break
+            key, _, value = line.partition(": ")
+            if key in header:
+                header[key] += "\n" + value
+            else:
+                header[key] = value
+        else:
+            raise Exception(f"Header of {tck_file} is not terminated by END.")
+
+    header["offset"] = int(header["file"].split()[-1])
+    if header.get("datatype") not in TCK_DTYPES:
+        raise Exception(f"Unsupported datatype {header.get('datatype')} in {tck_file}.")
+
+    return header
+
+
+def write_tck_header(f, header, count, total_count=None):
+    """Writes a .tck header at the start of an open binary file
+    Parameters
+    ==========
+    f: file object
+            File opened for binary writing
+    header: dict
+            Header key/value pairs, as returned by read_tck_header
+    count: int
+            Number of streamlines that will be written after the header
+    total_count: int
+            Number of streamlines generated (e.g. by tckgen), if known
+
+    Outputs
+    =======
+    offset: int
+            Byte offset at which streamline data should be written
+    """
+    lines = ["mrtrix tracks"]
+    for key, value in header.items():
+        if key in ["file", "offset", "datatype", "count", "total_count"]:
+            continue
+        lines += [f"{key}: {v}" for v in str(value).split("\n")]
+    lines += [f"datatype: {header.get('datatype', 'Float32LE')}"]
+    # Zero-pad the count so it can be updated in place later
+    lines += [f"count: {count:010d}"]
+    if total_count != None:
+        lines += [f"total_count: {total_count}"]
+    text = "\n".join(lines) + "\n"
+
+    # The offset is part of the header, so iterate until its length is stable
+    offset = 0
+    while len(text) + len(f"file: . {offset}\nEND\n") != offset:
+        offset = len(text) + len(f"file: . {offset}\nEND\n")
+    f.write((text + f"file: . {offset}\nEND\n").encode("latin-1"))
+
+    return offset
+
+
+def tck_data_range(tck_file, header=None):
+    """Finds the byte range holding streamline points (without the end-of-file triplet)
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    header: dict
+            Header of tck_file, read if not supplied
+
+    Outputs
+    =======
+    (start, stop): tuple
+            Byte offsets of the first and one-past-last bytes of point data
+    """
+    if header == None:
+        header = read_tck_header(tck_file)
+    dtype = np.dtype(TCK_DTYPES[header["datatype"]])
+    triplet_size = 3 * dtype.itemsize
+    start = header["offset"]
+    stop = op.getsize(tck_file)
+    stop -= (stop - start) % triplet_size
+    if stop - start >= triplet_size:
+        with open(tck_file, "rb") as f:
+            f.seek(stop - triplet_size)
+            if np.all(np.isinf(np.frombuffer(f.read(triplet_size), dtype=dtype))):
+                stop -= triplet_size
+
+    return start, stop
+
+
+def concatenate_tck(tck_files, outfile, overwrite=True, chunk_size=2**24):
+    """Concatenates .tck files by streaming their point data into one output file
+    Parameters
+    ==========
+    tck_files: list
+            Paths to .tck files to concatenate, in order. Must share a datatype.
+    outfile: str
+            Path to output .tck file
+    overwrite: bool
+            Whether to allow overwriting outputs
+    chunk_size: int
+            Number of bytes to copy at a time
+
+    Outputs
+    =======
+    outfile: str
+            Path to concatenated .tck file
+    """
+    if overwrite == False:
+        overwrite_check(outfile)
+
+    headers = [read_tck_header(tck_file) for tck_file in tck_files]
+    datatype = headers[0]["datatype"]
+    if any(header["datatype"] != datatype for header in headers):
+        raise Exception("Cannot concatenate .tck files with different datatypes.")
+
+    count = sum(int(header.get("count", 0)) for header in headers)
+    if all("total_count" in header for header in headers):
+        total_count = sum(int(header["total_count"]) for header in headers)
+    else:
+        total_count = None
+
+    with open(outfile, "wb") as f_out:
+        write_tck_header(f_out, headers[0], count, total_count=total_count)
+        for tck_file, header in zip(tck_files, headers):
+            start, stop = tck_data_range(tck_file, header)
+            with open(tck_file, "rb") as f_in:
+                f_in.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f_in.read(min(chunk_size, remaining))
+                    if len(chunk) == 0:
+                        break
+                    f_out.write(chunk)
+                    remaining -= len(chunk)
+        f_out.write(np.full(3, np.inf, dtype=TCK_DTYPES[datatype]).tobytes())
+
+    return outfile
+
+
+def append_tck(tck_file, new_tck_files, chunk_size=2**24):
+    """Appends the streamlines of other .tck files to a .tck file in place, without rewriting the existing streamlines
+    The counts in the header are updated in place; if they have no room for the new counts, the file is rewritten with
+    concatenate_tck instead.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file to append to
+    new_tck_files: list
+            Paths to .tck files to append, in order. Must share tck_file's datatype.
+    chunk_size: int
+            Number of bytes to copy at a time
+
+    Outputs
+    =======
+    tck_file: str
+            Path to the appended .tck file
+    """
+    header = read_tck_header(tck_file)
+    new_headers = [read_tck_header(new_tck_file) for new_tck_file in new_tck_files]
+    if any(new_header["datatype"] != header["datatype"] for new_header in new_headers):
+        raise Exception("Cannot append .tck files with different datatypes.")
+
+    counts = {
+        "count": int(header.get("count", 0))
+        + sum(int(new_header.get("count", 0)) for new_header in new_headers)
+    }
+    if all("total_count" in h for h in [header] + new_headers):
+        counts["total_count"] = sum(
+            int(h["total_count"]) for h in [header] + new_headers
+        )
+
+    # Find where each count is written, and whether the new value fits there
+    with open(tck_file, "rb") as f:
+        header_text = f.read(header["offset"])
+    count_positions = {}
+    for key, count in counts.items():
+        start = header_text.find(f"\n{key}: ".encode("latin-1"))
+        if start < 0:
+            break
+        start += len(f"\n{key}: ")
+        stop = header_text.index(b"\n", start)
+        if len(str(count)) > stop - start:
+            break
+        count_positions[key] = (start, stop)
+    if len(count_positions) < len(counts):
+        merged_file = op.splitext(tck_file)[0] + "_desc-merging.tck"
+        concatenate_tck([tck_file] + list(new_tck_files), merged_file)
+        os.replace(merged_file, tck_file)
+        return tck_file
+
+    # Overwrite the end-of-file triplet with the new streamlines, then end the file again
+    start, stop = tck_data_range(tck_file, header)
+    with open(tck_file, "r+b") as f_out:
+        f_out.seek(stop)
+        for new_tck_file, new_header in zip(new_tck_files, new_headers):
+            new_start, new_stop = tck_data_range(new_tck_file, new_header)
+            with open(new_tck_file, "rb") as f_in:
+                f_in.seek(new_start)
+                remaining = new_stop - new_start
+                while remaining > 0:
+                    chunk = f_in.read(min(chunk_size, remaining))
+                    if len(chunk) == 0:
+                        break
+                    f_out.write(chunk)
+                    remaining -= len(chunk)
+        f_out.write(np.full(3, np.inf, dtype=TCK_DTYPES[header["datatype"]]).tobytes())
+        f_out.truncate()
+        for key, (start, stop) in count_positions.items():
+            f_out.seek(start)
+            f_out.write(f"{counts[key]:0{stop - start}d}".encode("latin-1"))
+
+    return tck_file
+
+
+def transform_tck(tck_file, outfile, xfm, overwrite=True, chunk_size=2**22):
+    """Applies a linear transform to every point of a .tck file, streaming the points in chunks
+    Parameters
+    ==========
+    tck_file: str
+            Path to input .tck file
+    outfile: str
+            Path to output .tck file
+    xfm: numpy.ndarray
+            4x4 affine mapping input scanner coordinates to output scanner coordinates
+    overwrite: bool
+            Whether to allow overwriting outputs
+    chunk_size: int
+            Number of points to transform at a time
+
+    Outputs
+    =======
+    outfile: str
+            Path to transformed .tck file (same streamlines, in the same order)
+    """
+    if overwrite == False:
+        overwrite_check(outfile)
+
+    header = read_tck_header(tck_file)
+    start, stop = tck_data_range(tck_file, header)
+    dtype = np.dtype(TCK_DTYPES[header["datatype"]])
+    n_points = (stop - start) // (3 * dtype.itemsize)
+    rotation = np.asarray(xfm[:3, :3], dtype=np.float32).T
+    translation = np.asarray(xfm[:3, 3], dtype=np.float32)
+
+    with open(outfile, "wb") as f:
+        write_tck_header(
+            f,
+            header,
+            int(header.get("count", 0)),
+            total_count=header.get("total_count"),
+        )
+        if n_points > 0:
+            points = np.memmap(
+                tck_file, dtype=dtype, mode="r", offset=start, shape=(n_points, 3)
+            )
+            # NaN delimiters stay NaN under the transform, so no need to locate them
+            for i in range(0, n_points, chunk_size):
+                chunk = points[i : i + chunk_size].astype(np.float32) @ rotation
+                chunk += translation
+                f.write(chunk.astype(dtype).tobytes())
+        f.write(np.full(3, np.inf, dtype=dtype).tobytes())
+
+    return outfile
+
+
+def tck_point_count(tck_file):
+    """Counts the points stored in a .tck file (including delimiters) from its size, without reading them
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+
+    Outputs
+    =======
+    n_points: int
+            Number of point triplets in the file
+    """
+    header = read_tck_header(tck_file)
+    start, stop = tck_data_range(tck_file, header)
+
+    return (stop - start) // (3 * np.dtype(TCK_DTYPES[header["datatype"]]).itemsize)
+
+
+def memmap_tck_points(tck_file):
+    """Memory-maps the points of a .tck file (including NaN delimiters), without scanning them
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+
+    Outputs
+    =======
+    points: numpy.memmap
+            (P, 3) array of all points in the file (an empty array if there are none)
+    """
+    header = read_tck_header(tck_file)
+    start, stop = tck_data_range(tck_file, header)
+    dtype = np.dtype(TCK_DTYPES[header["datatype"]])
+    n_points = (stop - start) // (3 * dtype.itemsize)
+    if n_points == 0:
+        return np.zeros((0, 3), dtype=dtype)
+
+    return np.memmap(tck_file, dtype=dtype, mode="r", offset=start, shape=(n_points, 3))
+
+
+def read_tck_points(tck_file, chunk_size=2**24):
+    """Memory-maps the points of a .tck file and indexes where each streamline starts
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    chunk_size: int
+            Number of points to scan at a time when locating streamline delimiters
+
+    Outputs
+    =======
+    points: numpy.memmap
+            (P, 3) array of all points in the file, including the NaN delimiters between streamlines
+    starts: numpy.ndarray
+            Index into points of the first point of each streamline
+    lengths: numpy.ndarray
+            Number of points in each streamline
+    """
+    points = memmap_tck_points(tck_file)
+    n_points = len(points)
+    if n_points == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return points, empty, empty
+
+    # Streamlines are separated by NaN triplets
+    delimiters = [
+        np.flatnonzero(np.isnan(points[i : i + chunk_size, 0])) + i
+        for i in range(0, n_points, chunk_size)
+    ]
+    delimiters = np.concatenate(delimiters).astype(np.int64)
+    if len(delimiters) == 0 or delimiters[-1] != n_points - 1:
+        delimiters = np.append(delimiters, n_points)
+    starts = np.concatenate([[0], delimiters[:-1] + 1]).astype(np.int64)
+    lengths = delimiters - starts
+
+    return points, starts, lengths
+
+
+def tck_endpoints(points, starts, lengths):
+    """Gathers the first and last point of each streamline
+    Parameters
+    ==========
+    points, starts, lengths:
+            Outputs of read_tck_points
+
+    Outputs
+    =======
+    endpoints: numpy.ndarray
+            (S, 2, 3) float32 array of streamline endpoints
+    """
+    endpoints = np.empty((len(starts), 2, 3), dtype=np.float32)
+    endpoints[:, 0] = points[starts]
+    endpoints[:, 1] = points[starts + np.maximum(lengths, 1) - 1]
+
+    return endpoints
+
+
+def endpoint_density(tck_file, reference, first_streamline=0):
+    """Counts streamline endpoints per voxel of a reference image grid
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    reference: str
+            Path to image (.nii.gz) defining the voxel grid
+    first_streamline: int
+            Only count streamlines from this index on (e.g., those appended since the last count)
+
+    Outputs
+    =======
+    counts: numpy.ndarray
+            Flattened endpoint counts, one per voxel of the reference grid
+    """
+    import nibabel as nib
+
+    reference_img = nib.load(reference)
+    shape = reference_img.shape[:3]
+    points, starts, lengths = read_tck_points(tck_file)
+    endpoints = tck_endpoints(
+        points, starts[first_streamline:], lengths[first_streamline:]
+    ).reshape(-1, 3)
+
+    # Map endpoints to voxels, ignoring any that fall outside the grid
+    voxels = np.rint(
+        nib.affines.apply_affine(np.linalg.inv(reference_img.affine), endpoints)
+    ).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+    linear_index = np.ravel_multi_index(voxels[inside].T, shape)
+
+    return np.bincount(linear_index, minlength=int(np.prod(shape)))
+
+
+def tck_fingerprint(tck_file, sample_size=2**20, include_mtime=True):
+    """Identifies the contents of a .tck file without reading all of it
+    Combines the file size and modification time with a hash of its first and last bytes.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    sample_size: int
+            Number of bytes to hash from each end of the file
+    include_mtime: bool
+            Whether the modification time is part of the fingerprint (leave out to survive copies of the file)
+
+    Outputs
+    =======
+    fingerprint: str
+            Fingerprint of the file
+    """
+    import hashlib
+
+    size = op.getsize(tck_file)
+    sha1 = hashlib.sha1()
+    with open(tck_file, "rb") as f:
+        sha1.update(f.read(sample_size))
+        f.seek(max(size - sample_size, 0))
+        sha1.update(f.read(sample_size))
+
+    if include_mtime:
+        return f"{size}-{os.stat(tck_file).st_mtime_ns}-{sha1.hexdigest()}"
+    return f"{size}-{sha1.hexdigest()}"
+
+
+def build_endpoint_index(tck_file, index_file, cell_size=2.0, overwrite=True):
+    """Scans a tractogram once and saves an index of its streamline endpoints
+    The index holds each streamline's endpoints (float32), where each streamline starts and how long it is,
+    and a hash of endpoints into cubic cells, so later queries need neither a tractogram scan nor a search
+    over all endpoints.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    index_file: str
+            Path to save the index (.npz)
+    cell_size: float
+            Edge length (mm) of the hash cells
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    index: dict
+            The index, as returned by load_endpoint_index
+    """
+    if overwrite == False:
+        overwrite_check(index_file)
+
+    fingerprint = tck_fingerprint(tck_file)
+    points, starts, lengths = read_tck_points(tck_file)
+    endpoints = tck_endpoints(points, starts, lengths)
+
+    # Sort endpoints by cell, so a cell's endpoints are a contiguous run
+    flat_endpoints = endpoints.reshape(-1, 3)
+    if len(flat_endpoints) > 0:
+        origin = np.floor(flat_endpoints.min(axis=0))
+        cells = np.floor((flat_endpoints - origin) / cell_size).astype(np.int64)
+        grid_shape = cells.max(axis=0) + 1
+        cell_keys = np.ravel_multi_index(tuple(cells.T), tuple(grid_shape))
+    else:
+        origin = np.zeros(3)
+        grid_shape = np.ones(3, dtype=np.int64)
+        cell_keys = np.zeros(0, dtype=np.int64)
+    order = np.argsort(cell_keys, kind="stable")
+
+    index = dict(
+        fingerprint=np.array(fingerprint),
+        endpoints=endpoints,
+        starts=starts,
+        lengths=lengths,
+        cell_size=np.array(cell_size),
+        origin=origin,
+        grid_shape=grid_shape,
+        cell_keys=cell_keys[order],
+        cell_order=order.astype(np.int64),
+    )
+    # Write through a file object so numpy does not append .npz to the name
+    with open(index_file, "wb") as f:
+        np.savez(f, **index)
+
+    return index
+
+
+def load_endpoint_index(tck_file, index_file, cell_size=2.0):
+    """Loads the endpoint index of a tractogram, (re)building it if it is missing or out of date
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to .tck file
+    index_file: str
+            Path to the index (.npz)
+    cell_size: float
+            Edge length (mm) of the hash cells, if the index must be built
+
+    Outputs
+    =======
+    index: dict
+            Arrays of the index: 'endpoints' ((S, 2, 3) float32), 'starts' and 'lengths' (as from read_tck_points),
+            and the cell hash ('cell_size', 'origin', 'grid_shape', 'cell_keys', 'cell_order') used by query_endpoint_index
+    """
+    if op.exists(index_file):
+        with np.load(index_file) as saved:
+            index = {key: saved[key] for key in saved.files}
+        if str(index["fingerprint"]) == tck_fingerprint(tck_file):
+            return index
+        print(f"\n Endpoint index {index_file} is out of date, rebuilding it \n")
+
+    return build_endpoint_index(tck_file, index_file, cell_size=cell_size)
+
+
+def query_endpoint_index(index, lower, upper):
+    """Finds the endpoints that lie within a box, using the cell hash of an endpoint index
+
+    Parameters
+    ==========
+    index: dict
+            Endpoint index, as returned by load_endpoint_index
+    lower, upper: numpy.ndarray
+            Opposite corners (scanner space, mm) of the box
+
+    Outputs
+    =======
+    inside: numpy.ndarray
+            (S, 2) boolean array that is True for each endpoint inside the box
+    """
+    endpoints = index["endpoints"]
+    inside = np.zeros(endpoints.shape[:2], dtype=bool)
+    grid_shape = index["grid_shape"]
+
+    # Cells overlapping the box, clipped to the grid
+    first_cell = np.floor((lower - index["origin"]) / index["cell_size"])
+    last_cell = np.floor((upper - index["origin"]) / index["cell_size"])
+    first_cell = np.maximum(first_cell, 0).astype(np.int64)
+    last_cell = np.minimum(last_cell, grid_shape - 1).astype(np.int64)
+    if len(index["cell_keys"]) == 0 or np.any(first_cell > last_cell):
+        return inside
+    cells = np.stack(
+        np.meshgrid(
+            *[np.arange(first, last + 1) for first, last in zip(first_cell, last_cell)],
+            indexing="ij",
+        ),
+        axis=-1,
+    ).reshape(-1, 3)
+    keys = np.ravel_multi_index(tuple(cells.T), tuple(grid_shape))
+
+    # Gather the runs of endpoints in those cells, then test them exactly
+    run_starts = np.searchsorted(index["cell_keys"], keys, side="left")
+    run_lengths = np.searchsorted(index["cell_keys"], keys, side="right") - run_starts
+    run_offsets = np.cumsum(run_lengths) - run_lengths
+    positions = np.arange(run_lengths.sum(), dtype=np.int64) + np.repeat(
+        run_starts - run_offsets, run_lengths
+    )
+    candidates = index["cell_order"][positions]
+    candidate_points = endpoints.reshape(-1, 3)[candidates]
+    hits = candidates[
+        np.all((candidate_points >= lower) & (candidate_points <= upper), axis=1)
+    ]
+    inside.reshape(-1)[hits] = True
+
+    return inside
+
+
+def gather_streamlines(points, starts, lengths):
+    """Gathers the points of a set of streamlines into one contiguous array
+    Parameters
+    ==========
+    points: numpy.ndarray
+            (P, 3) array of points, as returned by read_tck_points
+    starts: numpy.ndarray
+            Index into points of the first point of each streamline to gather
+    lengths: numpy.ndarray
+            Number of points in each streamline to gather
+
+    Outputs
+    =======
+    gathered: numpy.ndarray
+            (sum(lengths), 3) float32 array of the streamlines' points, without delimiters
+    """
+    segment_starts = np.cumsum(lengths) - lengths
+    index = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(
+        starts - segment_starts, lengths
+    )
+
+    return np.asarray(points[index], dtype=np.float32)
+
+
+def streamline_chunks(lengths, max_points=2**22):
+    """Splits consecutive streamlines into chunks of bounded size
+    Parameters
+    ==========
+    lengths: numpy.ndarray
+            Number of points in each streamline
+    max_points: int
+            Maximum number of points per chunk (a longer streamline gets a chunk of its own)
+
+    Outputs
+    =======
+    Function yields slices over the streamlines, one per chunk
+    """
+    ends = np.cumsum(lengths)
+    first = 0
+    while first < len(lengths):
+        offset = ends[first - 1] if first > 0 else 0
+        last = max(
+            int(np.searchsorted(ends, offset + max_points, side="right")), first + 1
+        )
+        yield slice(first, last)
+        first = last
+
+
+def write_tck(outfile, chunks, header=None, overwrite=True):
+    """Writes streamlines to a .tck file, one chunk at a time
+    Parameters
+    ==========
+    outfile: str
+            Path to output .tck file
+    chunks: iterable
+            Yields (points, lengths) tuples, where points holds the streamlines' points without delimiters
+    header: dict
+            Header key/value pairs to copy into the output (e.g., from read_tck_header)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    count: int
+            Number of streamlines written
+    """
+    if overwrite == False:
+        overwrite_check(outfile)
+    if header == None:
+        header = {}
+
+    dtype = np.dtype(TCK_DTYPES[header.get("datatype", "Float32LE")])
+    count = 0
+    with open(outfile, "w+b") as f:
+        offset = write_tck_header(f, header, count)
+        for points, lengths in chunks:
+            f.write(delimit_streamlines(points, lengths, dtype).tobytes())
+            count += len(lengths)
+        finish_tck(f, offset, count, dtype)
+
+    return count
+
+
+def delimit_streamlines(points, lengths, dtype=np.float32):
+    """Lays out streamlines as .tck point data, with a NaN delimiter after each streamline
+    Parameters
+    ==========
+    points: numpy.ndarray
+            (sum(lengths), 3) points of the streamlines, without delimiters
+    lengths: numpy.ndarray
+            Number of points in each streamline
+    dtype: numpy.dtype
+            Data type of the output
+
+    Outputs
+    =======
+    data: numpy.ndarray
+            (sum(lengths) + len(lengths), 3) array to write after a .tck header
+    """
+    data = np.full((len(points) + len(lengths), 3), np.nan, dtype=dtype)
+    data[np.arange(len(points)) + np.repeat(np.arange(len(lengths)), lengths)] = points
+
+    return data
+
+
+def finish_tck(f, offset, count, dtype=np.float32):
+    """Ends a .tck file written with write_tck_header and fills in its final streamline count
+    Parameters
+    ==========
+    f: file object
+            File opened for binary reading and writing, positioned at the end of the point data
+    offset: int
+            Byte offset of the point data, as returned by write_tck_header
+    count: int
+            Number of streamlines written
+    dtype: numpy.dtype
+            Data type of the points
+    """
+    f.write(np.full(3, np.inf, dtype=dtype).tobytes())
+
+    # The header leaves room for the count
+    f.seek(0)
+    header_text = f.read(offset)
+    count_position = header_text.index(b"\ncount: ") + len(b"\ncount: ")
+    f.seek(count_position)
+    f.write(f"{count:010d}".encode("latin-1"))
+
+
+def write_tck_subset(tck_file, outfile, indices, tck_points=None, overwrite=True):
+    """Writes a subset of the streamlines of a .tck file, in the given order
+    Parameters
+    ==========
+    tck_file: str
+            Path to input .tck file
+    outfile: str
+            Path to output .tck file
+    indices: numpy.ndarray
+            Indices of the streamlines to write
+    tck_points: tuple
+            (points, starts, lengths) of tck_file, as returned by read_tck_points, if already read
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output .tck file
+    """
+    if tck_points == None:
+        tck_points = read_tck_points(tck_file)
+    points, starts, lengths = tck_points
+    subset_starts = starts[indices]
+    subset_lengths = lengths[indices]
+    write_tck(
+        outfile,
+        (
+            (
+                gather_streamlines(points, subset_starts[chunk], subset_lengths[chunk]),
+                subset_lengths[chunk],
+            )
+            for chunk in streamline_chunks(subset_lengths)
+        ),
+        header=read_tck_header(tck_file),
+        overwrite=overwrite,
+    )
+
+    return outfile
+
+
+def save_virtual_tck(
+    parent_tck, indices, outfile, starts=None, lengths=None, overwrite=True
+):
+    """Saves a sub-bundle as a selection of the streamlines of its parent tractogram, instead of copying their geometry
+    The selection is stored as a bitset or as int32 indices (whichever is smaller), along with the starts and lengths
+    of the selected streamlines in the parent, so they can be read without scanning the parent.
+
+    Parameters
+    ==========
+    parent_tck: str
+            Path to the parent tractography file (.tck)
+    indices: numpy.ndarray
+            Indices of the selected streamlines in the parent, in increasing order
+    outfile: str
+            Path to output virtual sub-bundle (.npz)
+    starts: numpy.ndarray
+            Index into the parent's points of the first point of each selected streamline. Default scans the parent.
+    lengths: numpy.ndarray
+            Number of points in each selected streamline. Default scans the parent.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output virtual sub-bundle
+    """
+    if overwrite == False:
+        overwrite_check(outfile)
+
+    indices = np.asarray(indices, dtype=np.int64)
+    n_streamlines = int(read_tck_header(parent_tck).get("count", 0))
+    if len(indices) > 0:
+        n_streamlines = max(n_streamlines, int(indices.max()) + 1)
+    if starts is None or lengths is None:
+        points, parent_starts, parent_lengths = read_tck_points(parent_tck)
+        n_streamlines = len(parent_starts)
+        starts = parent_starts[indices]
+        lengths = parent_lengths[indices]
+
+    selection = {}
+    if n_streamlines >= 2**31 or (n_streamlines + 7) // 8 < 4 * len(indices):
+        bitset = np.zeros(n_streamlines, dtype=bool)
+        bitset[indices] = True
+        selection["bitset"] = np.packbits(bitset)
+    else:
+        selection["indices"] = indices.astype(np.int32)
+
+    with open(outfile, "wb") as f:
+        np.savez_compressed(
+            f,
+            parent=op.abspath(parent_tck),
+            fingerprint=tck_fingerprint(parent_tck, include_mtime=False),
+            n_streamlines=n_streamlines,
+            starts=np.asarray(starts, dtype=np.int64),
+            lengths=np.asarray(lengths, dtype=np.int32),
+            **selection,
+        )
+    print(
+        f"Saved a selection of {len(indices)} streamlines of {parent_tck} to {outfile}"
+    )
+
+    return outfile
+
+
+def load_virtual_tck(virtual_file):
+    """Loads a virtual sub-bundle saved by save_virtual_tck, and checks that its parent tractogram is unchanged
+    Parameters
+    ==========
+    virtual_file: str
+            Path to virtual sub-bundle (.npz)
+
+    Outputs
+    =======
+    virtual: dict
+            Parent path ('parent'), selected streamline indices ('indices'), and their starts and lengths in the parent
+    """
+    with np.load(virtual_file) as data:
+        virtual = {key: data[key] for key in data.files}
+    parent = str(virtual["parent"])
+    if op.exists(parent) == False:
+        raise Exception(
+            f"Parent tractogram {parent} of virtual sub-bundle {virtual_file} is not found on the system."
+        )
+    if tck_fingerprint(parent, include_mtime=False) != str(virtual["fingerprint"]):
+        raise Exception(
+            f"Parent tractogram {parent} has changed since virtual sub-bundle {virtual_file} was saved. Please re-extract it."
+        )
+
+    if "bitset" in virtual:
+        virtual["indices"] = np.flatnonzero(
+            np.unpackbits(virtual.pop("bitset"), count=int(virtual["n_streamlines"]))
+        )
+    virtual["parent"] = parent
+    virtual["indices"] = virtual["indices"].astype(np.int64)
+    virtual["lengths"] = virtual["lengths"].astype(np.int64)
+
+    return virtual
+
+
+def read_virtual_streamlines(virtual_file):
+    """Reads the points of the streamlines of a virtual sub-bundle directly from its parent tractogram
+    Parameters
+    ==========
+    virtual_file: str
+            Path to virtual sub-bundle (.npz)
+
+    Outputs
+    =======
+    points: numpy.ndarray
+            (sum(lengths), 3) float32 array of the streamlines' points (RAS mm), without delimiters
+    lengths: numpy.ndarray
+            Number of points in each streamline
+    """
+    virtual = load_virtual_tck(virtual_file)
+
+    return (
+        gather_streamlines(
+            memmap_tck_points(virtual["parent"]), virtual["starts"], virtual["lengths"]
+        ),
+        virtual["lengths"],
+    )
+
+
+def load_virtual_streamlines(virtual_file):
+    """Loads the streamlines of a virtual sub-bundle as a nibabel ArraySequence (as in dipy's StatefulTractogram.streamlines)
+    Parameters
+    ==========
+    virtual_file: str
+            Path to virtual sub-bundle (.npz)
+
+    Outputs
+    =======
+    streamlines: nibabel.streamlines.ArraySequence
+            Streamlines of the sub-bundle, in RAS mm
+    """
+    from nibabel.streamlines import ArraySequence
+
+    points, lengths = read_virtual_streamlines(virtual_file)
+
+    return ArraySequence(np.split(points, np.cumsum(lengths)[:-1]))
+
+
+def materialize_virtual_tck(virtual_file, outfile=None, overwrite=True):
+    """Writes the streamlines of a virtual sub-bundle to a .tck file, unless an up-to-date one already exists
+    Parameters
+    ==========
+    virtual_file: str
+            Path to virtual sub-bundle (.npz)
+    outfile: str
+            Path to output .tck file. Default replaces '_selection.npz' in virtual_file with '.tck'.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output .tck file
+    """
+    if outfile == None:
+        if virtual_file.endswith("_selection.npz"):
+            outfile = virtual_file[: -len("_selection.npz")] + ".tck"
+        else:
+            outfile = op.splitext(virtual_file)[0] + ".tck"
+    if op.exists(outfile) and op.getmtime(outfile) >= op.getmtime(virtual_file):
+        return outfile
+
+    virtual = load_virtual_tck(virtual_file)
+    write_tck_subset(
+        virtual["parent"],
+        outfile,
+        np.arange(len(virtual["starts"])),
+        tck_points=(
+            memmap_tck_points(virtual["parent"]),
+            virtual["starts"],
+            virtual["lengths"],
+        ),
+        overwrite=overwrite,
+    )
+    print(f"Materialized virtual sub-bundle {virtual_file} to {outfile}")
+
+    return outfile
+
+
+def rebase_virtual_tck(virtual_file, parent_tck, outfile, overwrite=True):
+    """Saves a virtual sub-bundle as a selection of another parent tractogram holding the same streamlines in the same order
+    (e.g., the parent transformed into another space)
+    Parameters
+    ==========
+    virtual_file: str
+            Path to virtual sub-bundle (.npz)
+    parent_tck: str
+            Path to the new parent tractography file (.tck)
+    outfile: str
+            Path to output virtual sub-bundle (.npz)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output virtual sub-bundle
+    """
+    virtual = load_virtual_tck(virtual_file)
+
+    # Transforming points does not move them in the file, so the starts and lengths carry over
+    return save_virtual_tck(
+        parent_tck,
+        virtual["indices"],
+        outfile,
+        starts=virtual["starts"],
+        lengths=virtual["lengths"],
+        overwrite=overwrite,
+    )
+
+
+def load_mask(mask_file):
+    """Loads a mask image (.nii.gz, .nii) as a boolean array
+    Parameters
+    ==========
+    mask_file: str
+            Path to mask image
+
+    Outputs
+    =======
+    (mask, affine): tuple
+            Boolean array that is True where the image is nonzero, and the image's voxel-to-world affine
+    """
+    import nibabel as nib
+
+    img = nib.load(mask_file)
+
+    return np.asanyarray(img.dataobj) > 0, img.affine
+
+
+def lookup_mask(points, mask, affine):
+    """Checks which points fall inside a mask, using the voxel that contains each point
+    Parameters
+    ==========
+    points: numpy.ndarray
+            (P, 3) array of points in world (scanner) coordinates
+    mask: numpy.ndarray
+            Boolean mask array
+    affine: numpy.ndarray
+            Voxel-to-world affine of the mask
+
+    Outputs
+    =======
+    inside: numpy.ndarray
+            Boolean array, True for points inside the mask
+    """
+    inverse = np.linalg.inv(affine)
+    voxels = np.rint(points @ inverse[:3, :3].T + inverse[:3, 3]).astype(np.int64)
+    in_grid = np.all((voxels >= 0) & (voxels < mask.shape[:3]), axis=1)
+    inside = np.zeros(len(points), dtype=bool)
+    inside[in_grid] = mask[tuple(voxels[in_grid].T)]
+
+    return inside
+
+
+def segment_any(flags, lengths):
+    """Checks whether any point of each streamline is flagged (segmented logical OR)
+    Parameters
+    ==========
+    flags: numpy.ndarray
+            Boolean value for each point of consecutive streamlines
+    lengths: numpy.ndarray
+            Number of points in each streamline
+
+    Outputs
+    =======
+    hits: numpy.ndarray
+            Boolean array, True for streamlines with at least one flagged point
+    """
+    hits = np.zeros(len(lengths), dtype=bool)
+    nonempty = lengths > 0
+    if nonempty.any():
+        segment_starts = np.cumsum(lengths) - lengths
+        hits[nonempty] = np.logical_or.reduceat(flags, segment_starts[nonempty])
+
+    return hits
+
+
+def filter_streamlines(
+    points, lengths, include_masks=None, exclude_masks=None, streamline_mask=None
+):
+    """Applies tckedit-style masking to a chunk of streamlines
+    Parameters
+    ==========
+    points: numpy.ndarray
+            (P, 3) points of consecutive streamlines, without delimiters
+    lengths: numpy.ndarray
+            Number of points in each streamline
+    include_masks: list
+            (mask, affine) tuples (see load_mask). Streamlines must intersect each of these to be kept
+    exclude_masks: list
+            (mask, affine) tuples. Streamlines entering any of these are discarded
+    streamline_mask: tuple
+            (mask, affine). Streamlines are truncated where they first leave this mask
+
+    Outputs
+    =======
+    (points, lengths, keep): tuple
+            Points and lengths after truncation, and whether each streamline is kept
+    """
+    if include_masks == None:
+        include_masks = []
+    if exclude_masks == None:
+        exclude_masks = []
+
+    if streamline_mask != None:
+        inside = lookup_mask(points, *streamline_mask)
+        segment_starts = np.cumsum(lengths) - lengths
+        point_index = np.arange(len(points)) - np.repeat(segment_starts, lengths)
+        # New length is the index of the first point outside the mask
+        new_lengths = lengths.copy()
+        nonempty = lengths > 0
+        if nonempty.any():
+            new_lengths[nonempty] = np.minimum.reduceat(
+                np.where(inside, np.repeat(lengths, lengths), point_index),
+                segment_starts[nonempty],
+            )
+        points = points[point_index < np.repeat(new_lengths, lengths)]
+        lengths = new_lengths
+
+    keep = lengths > 0
+    for include_mask in include_masks:
+        keep &= segment_any(lookup_mask(points, *include_mask), lengths)
+    for exclude_mask in exclude_masks:
+        keep &= ~segment_any(lookup_mask(points, *exclude_mask), lengths)
+
+    return points, lengths, keep
+
+
+def read_assignments(assignments_file, mmap=False):
+    """Reads streamline-to-node assignments, as written by tck2connectome (.txt) or save_assignments (.txt or .npy)
+    Parameters
+    ==========
+    assignments_file: str
+            Path to assignments file (.txt, or binary .npy)
+    mmap: bool
+            Memory-map a binary file as stored (int16 or int32), instead of reading it into an int64 array
+
+    Outputs
+    =======
+    assignments: numpy.ndarray
+            (S, 2) integer array with the nodes assigned to the endpoints of each streamline
+    """
+    if assignments_file[-4:] == ".npy":
+        assignments = np.load(assignments_file, mmap_mode="r" if mmap else None)
+        if mmap:
+            return assignments
+        return assignments.astype(np.int64)
+
+    # Parsing the whole text at once is much faster than parsing it line by line
+    import re
+
+    with open(assignments_file) as f:
+        text = f.read()
+    if "#" in text:
+        text = re.sub(r"(?m)^\s*#.*$", "", text)
+
+    # -assignment_all_voxels lists every node a streamline passes through, so lines are not pairs.
+    # Count the tokens on each line by finding where tokens start.
+    chars = np.frombuffer(text.encode("latin-1"), dtype=np.uint8)
+    newlines = chars == ord("\n")
+    blanks = newlines | np.isin(chars, [ord(" "), ord("\t"), ord("\r")])
+    token_starts = ~blanks
+    token_starts[1:] &= blanks[:-1]
+    tokens_per_line = np.bincount(np.cumsum(newlines)[token_starts])
+    if np.any((tokens_per_line != 0) & (tokens_per_line != 2)):
+        raise Exception(
+            f"{assignments_file} does not assign exactly two nodes to each streamline (e.g., it was made with search type 'all'), which is not supported."
+        )
+
+    return np.fromstring(text, dtype=np.int64, sep=" ").reshape(-1, 2)
+
+
+def save_assignments(assignments, assignments_out):
+    """Saves streamline-to-node assignments as text (like tck2connectome), or as a compact binary .npy file
+    Parameters
+    ==========
+    assignments: numpy.ndarray
+            (S, 2) integer array with the nodes assigned to the endpoints of each streamline
+    assignments_out: str
+            Path to output assignments file. A .npy path saves int16 (or int32, for over 32767 nodes) pairs.
+
+    Outputs
+    =======
+    assignments_out: str
+            Path to output assignments file
+    """
+    if assignments_out[-4:] == ".npy":
+        if len(assignments) == 0 or np.max(assignments) <= np.iinfo(np.int16).max:
+            dtype = np.int16
+        else:
+            dtype = np.int32
+        np.save(assignments_out, np.asarray(assignments, dtype=dtype).reshape(-1, 2))
+    else:
+        np.savetxt(assignments_out, assignments, fmt="%d")
+
+    return assignments_out
+
+
+def read_connectome(connectome_file):
+    """Reads a node-by-node connectome, as written by tck2connectome (.txt) or save_connectome (.txt or .npy)
+    Parameters
+    ==========
+    connectome_file: str
+            Path to connectome file (.txt, or binary .npy)
+
+    Outputs
+    =======
+    connectome: numpy.ndarray
+            (N, N) connectome
+    """
+    if connectome_file[-4:] == ".npy":
+        return np.load(connectome_file)
+
+    return np.loadtxt(connectome_file, comments="#", ndmin=2)
+
+
+def save_connectome(connectome, connectome_out):
+    """Saves a node-by-node connectome as text (like tck2connectome), or as a binary .npy file
+    Parameters
+    ==========
+    connectome: numpy.ndarray
+            (N, N) connectome
+    connectome_out: str
+            Path to output connectome file (.txt, or .npy)
+
+    Outputs
+    =======
+    connectome_out: str
+            Path to output connectome file
+    """
+    if connectome_out[-4:] == ".npy":
+        np.save(connectome_out, connectome)
+    else:
+        np.savetxt(connectome_out, connectome, fmt="%.9g")
+
+    return connectome_out
+
+
+def load_sift2_weights(weights_file, cache=True):
+    """Loads SIFT2 weights as a float32 array, caching them in binary form
+    The text file is parsed once and cached as a .npy file next to it. Later calls memory-map the
+    cache instead of parsing the text again, as long as the cache is newer than the text file.
+
+    Parameters
+    ==========
+    weights_file: str
+            Path to SIFT2 weights file (.csv, .txt, or an already-binary .npy)
+    cache: bool
+            Whether to read and write the .npy cache
+
+    Outputs
+    =======
+    weights: numpy.ndarray
+            One weight per streamline
+    """
+    if weights_file[-4:] == ".npy":
+        return np.load(weights_file, mmap_mode="r")
+
+    cache_file = op.splitext(weights_file)[0] + ".npy"
+    if (
+        cache
+        and op.exists(cache_file)
+        and op.getmtime(cache_file) >= op.getmtime(weights_file)
+    ):
+        return np.load(cache_file, mmap_mode="r")
+
+    # MRtrix writes weights space- or newline-delimited, with optional comment lines
+    with open(weights_file) as f:
+        values = " ".join(line for line in f if line.lstrip()[:1] != "#").split()
+    weights = np.array(values, dtype=np.float32)
+
+    if cache:
+        try:
+            np.save(cache_file, weights)
+        except OSError:
+            warnings.warn(f"Could not cache SIFT2 weights at {cache_file}.")
+
+    return weights
+
+
+def save_sift2_weights(weights, weights_file, overwrite=True):
+    """Saves SIFT2 weights as MRtrix-readable text, along with a .npy copy for fast reloading
+    Parameters
+    ==========
+    weights: numpy.ndarray
+            One weight per streamline
+    weights_file: str
+            Path to output weights file (.csv or .txt)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    weights_file: str
+            Path to output weights file
+    """
+    if overwrite == False:
+        overwrite_check(weights_file)
+
+    np.savetxt(weights_file, np.asarray(weights)[np.newaxis], fmt="%.9g", delimiter=" ")
+    np.save(
+        op.splitext(weights_file)[0] + ".npy", np.asarray(weights, dtype=np.float32)
+    )
+
+    return weights_file
+
+
+def membership_bitsets(assignments, labels):
+    """Packs, for each label, which streamlines have an endpoint assigned to it into a bitset
+    Parameters
+    ==========
+    assignments: numpy.ndarray
+            (S, 2) streamline-to-node assignments, as returned by read_assignments
+    labels: list
+            Node labels to make bitsets for
+
+    Outputs
+    =======
+    bitsets: numpy.ndarray
+            (len(labels), ceil(S / 8)) uint8 array, one bit per streamline (as with numpy.packbits)
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    n_streamlines = len(assignments)
+    bitsets = np.zeros((len(labels), (n_streamlines + 7) // 8), dtype=np.uint8)
+
+    # Map node labels to rows, then set one bit per (row, streamline) pair
+    order = np.argsort(labels)
+    for end in range(assignments.shape[1]):
+        nodes = assignments[:, end]
+        positions = np.minimum(np.searchsorted(labels[order], nodes), len(labels) - 1)
+        found = np.flatnonzero(labels[order][positions] == nodes)
+        if len(found) == 0:
+            continue
+        np.bitwise_or.at(
+            bitsets,
+            (order[positions[found]], found >> 3),
+            (128 >> (found & 7)).astype(np.uint8),
+        )
+
+    return bitsets
+
+
+def save_membership(parent_tck, assignments, outfile, node_names=None, overwrite=True):
+    """Saves which streamlines of a tractogram reach each node, as bitsets that can be combined with query_membership
+    Parameters
+    ==========
+    parent_tck: str
+            Path to the tractography file (.tck) that the assignments describe
+    assignments: str
+            Path to streamline-to-node assignments of every streamline of parent_tck
+    outfile: str
+            Path to output membership file (.npz)
+    node_names: dict
+            Maps node labels to names that queries can use. Default is to use the labels.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output membership file
+    """
+    if overwrite == False:
+        overwrite_check(outfile)
+
+    assignments = read_assignments(assignments)
+    labels = np.unique(assignments)
+    labels = labels[labels > 0]
+    if node_names == None:
+        node_names = {}
+    names = [str(node_names.get(int(label), int(label))) for label in labels]
+
+    with open(outfile, "wb") as f:
+        np.savez_compressed(
+            f,
+            parent=op.abspath(parent_tck),
+            fingerprint=tck_fingerprint(parent_tck, include_mtime=False),
+            n_streamlines=len(assignments),
+            labels=labels,
+            names=np.array(names),
+            bitsets=membership_bitsets(assignments, labels),
+        )
+    print(f"Saved node membership of {len(assignments)} streamlines to {outfile}")
+
+    return outfile
+
+
+def load_membership(membership_file):
+    """Loads node membership bitsets saved by save_membership, and checks that their tractogram is unchanged
+    Parameters
+    ==========
+    membership_file: str
+            Path to membership file (.npz)
+
+    Outputs
+    =======
+    membership: dict
+            Parent tractogram ('parent'), number of streamlines, node labels and names, and one bitset per node ('bitsets')
+    """
+    with np.load(membership_file) as data:
+        membership = {key: data[key] for key in data.files}
+    parent = str(membership["parent"])
+    if op.exists(parent) == False:
+        raise Exception(
+            f"Tractogram {parent} of membership file {membership_file} is not found on the system."
+        )
+    if tck_fingerprint(parent, include_mtime=False) != str(membership["fingerprint"]):
+        raise Exception(
+            f"Tractogram {parent} has changed since membership file {membership_file} was saved. Please re-extract it."
+        )
+    membership["parent"] = parent
+    membership["n_streamlines"] = int(membership["n_streamlines"])
+
+    return membership
+
+
+def query_membership(membership, expression):
+    """Combines node membership bitsets with AND (&), OR (|) and NOT (~), e.g. 'V1 & MT & ~FEF' or '(1 | 2) & 3'
+    Nodes are given by name or label; ~ binds tightest, then &, then |, and parentheses group.
+
+    Parameters
+    ==========
+    membership: dict
+            Node membership, as returned by load_membership
+    expression: str
+            Combination of nodes to select
+
+    Outputs
+    =======
+    indices: numpy.ndarray
+            Indices of the streamlines selected by the expression, in increasing order
+    """
+    import re
+
+    tokens = re.findall(r"[()&|~]|[^\s()&|~]+", expression)
+    rows = {str(label): row for row, label in enumerate(membership["labels"])}
+    rows.update({str(name): row for row, name in enumerate(membership["names"])})
+    n_bytes = membership["bitsets"].shape[1]
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal position
+        token = peek()
+        if token == None or (expected != None and token != expected):
+            raise Exception(
+                f"Could not parse membership query '{expression}': expected {expected or 'a node'}, found {token}."
+            )
+        position += 1
+        return token
+
+    def parse_or():
+        bits = parse_and()
+        while peek() == "|":
+            take("|")
+            bits = bits | parse_and()
+        return bits
+
+    def parse_and():
+        bits = parse_not()
+        while peek() == "&":
+            take("&")
+            bits = bits & parse_not()
+        return bits
+
+    def parse_not():
+        if peek() == "~":
+            take("~")
+            return ~parse_not()
+        if peek() == "(":
+            take("(")
+            bits = parse_or()
+            take(")")
+            return bits
+        token = take()
+        if token in ["&", "|", ")"]:
+            raise Exception(
+                f"Could not parse membership query '{expression}': unexpected {token}."
+            )
+        if token in rows:
+            return membership["bitsets"][rows[token]]
+        # Nodes that no streamline reaches have no bitset
+        if token.isdigit():
+            return np.zeros(n_bytes, dtype=np.uint8)
+        raise Exception(f"Node {token} is not in the membership file.")
+
+    bits = parse_or()
+    if peek() != None:
+        raise Exception(
+            f"Could not parse membership query '{expression}': unexpected {peek()}."
+        )
+
+    # Padding bits past the last streamline are dropped here
+    return np.flatnonzero(np.unpackbits(bits, count=membership["n_streamlines"]))
+
+
+def extract_membership_query(
+    membership_file, expression, outfile, sift2_weights=None, overwrite=True
+):
+    """Extracts the streamlines selected by a membership query (see query_membership) from their tractogram
+    Parameters
+    ==========
+    membership_file: str
+            Path to membership file (.npz) saved by save_membership
+    expression: str
+            Combination of nodes to select, e.g. 'V1 & MT & ~FEF'
+    outfile: str
+            Path to output sub-bundle. A .npz path saves a virtual sub-bundle (see save_virtual_tck) instead of a .tck file.
+    sift2_weights: str
+            Path to SIFT2 weights CSV file for the tractogram. The selected streamlines' weights are saved next to outfile.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    outfile: str
+            Path to output sub-bundle
+    """
+    membership = load_membership(membership_file)
+    indices = query_membership(membership, expression)
+    print(f"Query '{expression}' selected {len(indices)} streamlines")
+
+    if outfile[-4:] == ".npz":
+        save_virtual_tck(membership["parent"], indices, outfile, overwrite=overwrite)
+    else:
+        write_tck_subset(membership["parent"], outfile, indices, overwrite=overwrite)
+
+    if sift2_weights != None:
+        weights = load_sift2_weights(sift2_weights)
+        if len(weights) != membership["n_streamlines"]:
+            raise Exception(
+                f"Number of SIFT2 weights ({len(weights)}) does not match number of streamlines in {membership['parent']} ({membership['n_streamlines']})."
+            )
+        save_sift2_weights(
+            weights[indices],
+            op.splitext(outfile)[0].removesuffix("_selection") + "SIFT2weights.csv",
+            overwrite=overwrite,
+        )
+
+    return outfile
+
+
+def select_streamlines(
+    points, starts, lengths, selected, masks, outfile, header=None, overwrite=True
+):
+    """Filters selected streamlines with masks, chunk by chunk, and writes those that pass to a .tck file
+    Parameters
+    ==========
+    points, starts, lengths:
+            Outputs of read_tck_points
+    selected: numpy.ndarray
+            Indices of the streamlines to consider, in increasing order
+    masks: dict
+            Loaded include_masks, exclude_masks and streamline_mask, as passed to filter_streamlines
+    outfile: str
+            Path to output .tck file, or None to only find the streamlines that pass
+    header: dict
+            Header fields for the output file (e.g., from read_tck_header of the input)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    kept: numpy.ndarray
+            Indices of the selected streamlines that pass the masks
+    """
+    kept = []
+
+    def filtered_chunks():
+        for chunk in streamline_chunks(lengths[selected]):
+            index = selected[chunk]
+            chunk_points, chunk_lengths, keep = filter_streamlines(
+                gather_streamlines(points, starts[index], lengths[index]),
+                lengths[index],
+                **masks,
+            )
+            kept.append(index[keep])
+            yield chunk_points[np.repeat(keep, chunk_lengths)], chunk_lengths[keep]
+
+    if outfile == None:
+        # Without masks, the selection is final and no geometry needs to be read
+        if len(masks["include_masks"]) > 0 or len(masks["exclude_masks"]) > 0:
+            for chunk in filtered_chunks():
+                pass
+        else:
+            kept.append(selected)
+    else:
+        count = write_tck(
+            outfile, filtered_chunks(), header=header, overwrite=overwrite
+        )
+        print(f"Selected {count} streamlines into {outfile}")
+
+    return np.concatenate(kept) if len(kept) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def select_tck_native(
+    tck_file,
+    assignments,
+    nodes,
+    outfile,
+    sift2_weights=None,
+    weights_out=None,
+    exclude_mask=None,
+    include_mask=None,
+    streamline_mask=None,
+    virtual=False,
+    parent=None,
+    overwrite=True,
+):
+    """Selects and masks the streamlines connecting two nodes in a single pass over a tractogram
+    An in-process equivalent of 'connectome2tck -exclusive -files single' followed by 'tckedit'
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    assignments: str
+            Path to streamline-to-node assignments from tck2connectome
+    nodes: list
+            The two nodes that selected streamlines must connect (e.g., [1, 2], or [0, 1] for one ROI)
+    outfile: str
+            Path to output .tck file
+    sift2_weights: str
+            Path to SIFT2 weights CSV file for the input tractogram
+    weights_out: str
+            Path to save the SIFT2 weights of the output streamlines (a .npy copy is saved next to it)
+    exclude_mask: str
+            Path to streamline exclusion mask (.nii.gz). Streamlines entering this mask will be discarded
+    include_mask: str
+            Path to streamline inclusion mask (.nii.gz). Streamlines must intersect this mask to be kept
+    streamline_mask: str
+            Path to streamline mask (.nii.gz). Streamlines leaving this mask are truncated
+    virtual: bool
+            Save the selection as a virtual sub-bundle (see save_virtual_tck) to outfile (.npz) instead of writing a .tck file.
+            Not possible with a streamline_mask, which changes the streamlines.
+    parent: tuple
+            (parent_tck, indices, starts) if tck_file is a subset of another tractogram (e.g., culled candidates), giving each
+            streamline's index and first point in parent_tck. A virtual selection then refers to parent_tck.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns the path of the output tck file (or virtual sub-bundle)
+    """
+    if virtual and streamline_mask != None:
+        raise Exception(
+            "Streamlines truncated by a streamline mask cannot be saved as a virtual sub-bundle."
+        )
+    if overwrite == False and sift2_weights != None and weights_out != None:
+        overwrite_check(weights_out)
+
+    # Pick streamlines whose endpoints are assigned to exactly the two nodes
+    assignments = read_assignments(assignments)
+    assignments.sort(axis=1)
+    selected = np.flatnonzero(
+        (assignments[:, 0] == min(nodes)) & (assignments[:, 1] == max(nodes))
+    )
+
+    points, starts, lengths = read_tck_points(tck_file)
+    if len(assignments) != len(starts):
+        raise Exception(
+            f"Number of assignments ({len(assignments)}) does not match number of streamlines in {tck_file} ({len(starts)})."
+        )
+    if sift2_weights != None:
+        weights = load_sift2_weights(sift2_weights)
+        if len(weights) != len(starts):
+            raise Exception(
+                f"Number of SIFT2 weights ({len(weights)}) does not match number of streamlines in {tck_file} ({len(starts)})."
+            )
+    masks = dict(
+        include_masks=[] if include_mask == None else [load_mask(include_mask)],
+        exclude_masks=[] if exclude_mask == None else [load_mask(exclude_mask)],
+        streamline_mask=None if streamline_mask == None else load_mask(streamline_mask),
+    )
+
+    kept = select_streamlines(
+        points,
+        starts,
+        lengths,
+        selected,
+        masks,
+        None if virtual else outfile,
+        header=read_tck_header(tck_file),
+        overwrite=overwrite,
+    )
+
+    if virtual:
+        if parent == None:
+            save_virtual_tck(
+                tck_file,
+                kept,
+                outfile,
+                starts=starts[kept],
+                lengths=lengths[kept],
+                overwrite=overwrite,
+            )
+        else:
+            parent_tck, parent_indices, parent_starts = parent
+            save_virtual_tck(
+                parent_tck,
+                parent_indices[kept],
+                outfile,
+                starts=parent_starts[kept],
+                lengths=lengths[kept],
+                overwrite=overwrite,
+            )
+
+    # Subset the weights alongside the streamlines and write them out once
+    if sift2_weights != None:
+        kept_weights = weights[kept]
+        print(f"Sum of SIFT2 weights of selected streamlines: {kept_weights.sum()}")
+        if weights_out != None:
+            save_sift2_weights(kept_weights, weights_out, overwrite=overwrite)
+
+    return outfile
+
+
+def roi_bbox_world(rois_in, labels=None, margin=0):
+    """Finds the scanner-space bounding box of each labelled ROI, expanded by a margin
+    Parameters
+    ==========
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing the ROIs, each with a different intensity
+    labels: list
+            ROI intensities to find bounding boxes for. Default is every nonzero intensity in rois_in.
+    margin: float
+            Distance (mm) to expand each bounding box by
+
+    Outputs
+    =======
+    bboxes: list
+            (lower, upper) corners of each ROI's bounding box (None for empty ROIs). Boxes cover the
+            full extent of the ROI voxels, not just their centres.
+    """
+    import itertools
+    import nibabel as nib
+
+    rois_img = nib.load(rois_in)
+    rois_data = np.rint(np.asanyarray(rois_img.dataobj)).astype(np.int64)
+    if labels == None:
+        labels = [label for label in np.unique(rois_data) if label != 0]
+    bboxes = []
+    for label in labels:
+        voxels = np.argwhere(rois_data == label)
+        if len(voxels) == 0:
+            bboxes.append(None)
+            continue
+        corners = np.array(
+            list(
+                itertools.product(
+                    *zip(voxels.min(axis=0) - 0.5, voxels.max(axis=0) + 0.5)
+                )
+            )
+        )
+        corners = nib.affines.apply_affine(rois_img.affine, corners)
+        bboxes.append((corners.min(axis=0) - margin, corners.max(axis=0) + margin))
+
+    return bboxes
+
+
+def assign_endpoints(
+    endpoints, rois, search_dist=2.0, search_type="radial", workers=-1
+):
+    """Assigns streamline endpoints to ROIs, like tck2connectome -assignment_radial_search / -assignment_end_voxels
+    For end voxel search, an endpoint takes the label of the voxel it lies in. For radial search, it takes the label
+    of the nearest ROI voxel centre closer than search_dist (found with a KD-tree over all ROI voxels), so like
+    tck2connectome, even an endpoint inside an ROI voxel is unassigned if it is search_dist or more from the centre.
+
+    Parameters
+    ==========
+    endpoints: numpy.ndarray
+            (N, 3) endpoint coordinates (scanner space, mm)
+    rois: fsub_extractor.utils.froi_utils.ROI
+            Labelled ROIs
+    search_dist: float
+            Radius of the search, in mm
+    search_type: string
+            'radial' or 'end'
+    workers: int
+            Number of threads for the KD-tree query (-1 for all CPUs)
+
+    Outputs
+    =======
+    labels: numpy.ndarray
+            Node assigned to each endpoint (0 if unassigned)
+    """
+    if search_type not in ["radial", "end"]:
+        raise Exception(
+            f"Search type '{search_type}' is not supported for native assignment (use 'radial' or 'end')."
+        )
+
+    labels, nearest_labels, distances = nearest_roi_labels(
+        endpoints,
+        rois,
+        max_dist=float(search_dist) if search_type == "radial" else 0,
+        workers=workers,
+    )
+    if search_type == "end":
+        return labels
+
+    return nearest_labels
+
+
+def nearest_roi_labels(endpoints, rois, max_dist=np.inf, workers=-1):
+    """Finds the ROI voxel each endpoint lies in, and the nearest ROI voxel centre to each endpoint and its distance
+    End voxel assignments follow from the first, and radial search assignments for any radius up to max_dist from the
+    others (see assign_endpoints_sweep).
+
+    Parameters
+    ==========
+    endpoints: numpy.ndarray
+            (N, 3) endpoint coordinates (scanner space, mm)
+    rois: fsub_extractor.utils.froi_utils.ROI
+            Labelled ROIs
+    max_dist: float
+            Only look for ROI voxels closer than this, in mm (0 to skip the search)
+    workers: int
+            Number of threads for the KD-tree query (-1 for all CPUs)
+
+    Outputs
+    =======
+    labels: numpy.ndarray
+            Label of the ROI voxel each endpoint lies in (0 if none)
+    nearest_labels: numpy.ndarray
+            Label of the nearest ROI voxel centre closer than max_dist (0 if there is none)
+    distances: numpy.ndarray
+            Distance to that voxel centre, in mm (infinite if there is none in range)
+    """
+    from scipy.spatial import cKDTree
+
+    labels = rois.lookup_points(endpoints)
+    nearest_labels = np.zeros_like(labels)
+    distances = np.full(len(labels), np.inf)
+    if max_dist > 0 and len(rois) > 0:
+        import nibabel as nib
+
+        # The voxel an endpoint lies in is searched like any other, so it is only used if its centre is in range
+        tree = cKDTree(nib.affines.apply_affine(rois.affine, rois.voxels()))
+        distances, nearest = tree.query(
+            endpoints,
+            k=1,
+            distance_upper_bound=float(max_dist),
+            workers=workers,
+        )
+        # Endpoints with no ROI voxel in range get an infinite distance
+        found = np.isfinite(distances)
+        nearest_labels[found] = rois.labels[nearest[found]]
+
+    return labels, nearest_labels, distances
+
+
+def assign_endpoints_sweep(endpoints, rois, search_settings, workers=-1):
+    """Assigns streamline endpoints to ROIs for several search settings, with a single nearest-ROI search
+    Parameters
+    ==========
+    endpoints: numpy.ndarray
+            (N, 3) endpoint coordinates (scanner space, mm)
+    rois: fsub_extractor.utils.froi_utils.ROI
+            Labelled ROIs
+    search_settings: list
+            (search_type, search_dist) pairs, with search_type 'radial' or 'end'
+    workers: int
+            Number of threads for the KD-tree query (-1 for all CPUs)
+
+    Outputs
+    =======
+    assignments: dict
+            Maps each search setting to the node assigned to each endpoint (0 if unassigned), as from assign_endpoints
+    """
+    for search_type, search_dist in search_settings:
+        if search_type not in ["radial", "end"]:
+            raise Exception(
+                f"Search type '{search_type}' is not supported for native assignment (use 'radial' or 'end')."
+            )
+    radial_dists = [
+        float(search_dist)
+        for search_type, search_dist in search_settings
+        if search_type == "radial"
+    ]
+    labels, nearest_labels, distances = nearest_roi_labels(
+        endpoints, rois, max_dist=max(radial_dists + [0]), workers=workers
+    )
+
+    # The KD-tree only returns voxels strictly closer than the search distance
+    assignments = {}
+    for search_type, search_dist in search_settings:
+        if search_type == "radial":
+            assignments[(search_type, search_dist)] = np.where(
+                distances < float(search_dist), nearest_labels, 0
+            )
+        else:
+            assignments[(search_type, search_dist)] = labels
+
+    return assignments
+
+
+def assign_streamlines_native(
+    tck_file,
+    rois_in,
+    assignments_out,
+    connectome_out,
+    search_dist=2.0,
+    search_type="radial",
+    sift2_weights=None,
+    overwrite=True,
+):
+    """Assigns streamlines to ROIs in-process, writing the same outputs as tck2connectome -out_assignments
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing all ROIs, each with different intensities
+    assignments_out: str
+            Path to save the streamline-to-node assignments (.txt, or binary .npy)
+    connectome_out: str
+            Path to save the (upper triangular) node-by-node connectome (.txt, or binary .npy)
+    search_dist: float
+            How far to search from endpoints for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines ('radial' or 'end')
+    sift2_weights: str
+            Path to SIFT2 weights CSV file, to weight the connectome
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    assignments: numpy.ndarray
+            (S, 2) integer array with the nodes assigned to the endpoints of each streamline
+    """
+    from fsub_extractor.utils.froi_utils import ROI
+
+    if overwrite == False:
+        overwrite_check(assignments_out)
+        overwrite_check(connectome_out)
+
+    rois = ROI.from_nifti(rois_in, labelled=True)
+    points, starts, lengths = read_tck_points(tck_file)
+    endpoints = tck_endpoints(points, starts, lengths).reshape(-1, 3)
+    assignments = assign_endpoints(
+        endpoints, rois, search_dist=search_dist, search_type=search_type
+    ).reshape(-1, 2)
+    save_assignments(assignments, assignments_out)
+
+    n_nodes = int(rois.labels.max()) if len(rois) > 0 else 0
+    if sift2_weights != None:
+        weights = load_sift2_weights(sift2_weights)
+    else:
+        weights = None
+    save_connectome(
+        assignments_connectome(assignments, n_nodes, weights=weights), connectome_out
+    )
+
+    return assignments
+
+
+def assignments_connectome(assignments, n_nodes, weights=None):
+    """Counts (or sums the weights of) streamlines per pair of nodes, like the connectome of tck2connectome
+    Parameters
+    ==========
+    assignments: numpy.ndarray
+            (S, 2) integer array with the nodes assigned to the endpoints of each streamline
+    n_nodes: int
+            Number of nodes (the highest node label)
+    weights: numpy.ndarray
+            One weight per streamline. Default counts streamlines.
+
+    Outputs
+    =======
+    connectome: numpy.ndarray
+            (n_nodes, n_nodes) upper triangular connectome, ignoring unassigned endpoints
+    """
+    connectome = np.zeros((n_nodes, n_nodes))
+    assigned = np.all(assignments > 0, axis=1)
+    if weights is not None:
+        weights = np.asarray(weights)[assigned]
+    else:
+        weights = 1
+    edges = np.sort(assignments[assigned], axis=1) - 1
+    np.add.at(connectome, (edges[:, 0], edges[:, 1]), weights)
+
+    return connectome
+
+
+def assign_streamlines(
+    tck_file,
+    rois_in,
+    assignments_out,
+    connectome_out,
+    search_dist=2.0,
+    search_type="radial",
+    sift2_weights=None,
+    native=False,
+    overwrite=True,
+):
+    """Assigns streamline endpoints to ROIs with tck2connectome, or in-process (see assign_streamlines_native)
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii., .mif) containing all ROIs, each with different intensities
+    assignments_out: str
+            Path to save the streamline-to-node assignments (.txt, or binary .npy)
+    connectome_out: str
+            Path to save the node-by-node connectome (.txt, or binary .npy)
+    search_dist: float
+            How far to search ahead of streamlines for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines (forward, reverse, radial, end, or all).
+    sift2_weights: str
+            Path to SIFT2 weights CSV file
+    native: bool
+            Assign in-process, if the search type ('radial' or 'end') and ROI format (NIFTI) allow it
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns the path to the assignments file
+    """
+    if (
+        native
+        and search_type in ["radial", "end"]
+        and op.splitext(rois_in)[-1] != ".mif"
+    ):
+        assign_streamlines_native(
+            tck_file,
+            rois_in,
+            assignments_out,
+            connectome_out,
+            search_dist=search_dist,
+            search_type=search_type,
+            sift2_weights=sift2_weights,
+            overwrite=overwrite,
+        )
+        return assignments_out
+
+    # tck2connectome only writes text, so binary outputs are converted afterwards
+    if overwrite == False:
+        overwrite_check(assignments_out)
+        overwrite_check(connectome_out)
+    binary_outputs = [
+        (out, op.splitext(out)[0] + ".txt")
+        for out in [assignments_out, connectome_out]
+        if out[-4:] == ".npy"
+    ]
+    text_outputs = dict(binary_outputs)
+
+    tck2connectome = find_program("tck2connectome")
+    cmd_tck2connectome = [
+        tck2connectome,
+        tck_file,
+        rois_in,
+        text_outputs.get(connectome_out, connectome_out),
+        # "-assignment_" + search_type + "_search",
+        # search_dist,
+        "-out_assignments",
+        text_outputs.get(assignments_out, assignments_out),
+    ]
+    if search_type == "end" or search_type == "all":
+        cmd_tck2connectome += [f"-assignment_{search_type}_voxels"]
+    else:
+        cmd_tck2connectome += [f"-assignment_{search_type}_search", str(search_dist)]
+
+    if overwrite == False:
+        for binary_out, text_out in binary_outputs:
+            overwrite_check(text_out)
+    else:
+        cmd_tck2connectome += ["-force"]
+    if sift2_weights != None:
+        cmd_tck2connectome += ["-tck_weights_in", sift2_weights]
+    run_command(cmd_tck2connectome)
+
+    for binary_out, text_out in binary_outputs:
+        if binary_out == assignments_out:
+            save_assignments(read_assignments(text_out), binary_out)
+        else:
+            save_connectome(read_connectome(text_out), binary_out)
+        os.remove(text_out)
+
+    return assignments_out
+
+
+def validate_native_assignment(
+    tck_file, rois_in, outpath_base, search_dist=2.0, search_type="radial"
+):
+    """Compares native streamline assignment (assign_streamlines_native) with tck2connectome on the same inputs
+    Parameters
+    ==========
+    tck_file: str
+            Path to the tractography file (.tck), e.g. synthetic streamlines
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing all ROIs, each with different intensities
+    outpath_base: str
+            Path to output directory, including output prefix
+    search_dist: float
+            How far to search from endpoints for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines ('radial' or 'end')
+
+    Outputs
+    =======
+    agreement: float
+            Fraction of streamlines assigned the same nodes by both methods
+    outpath_base + _desc-mrtrix_assignments.txt / _desc-native_assignments.txt are the two sets of assignments
+    """
+    mrtrix_assignments_out = outpath_base + "_desc-mrtrix_assignments.txt"
+    tck2connectome = find_program("tck2connectome")
+    cmd_tck2connectome = [
+        tck2connectome,
+        tck_file,
+        rois_in,
+        outpath_base + "_desc-mrtrix_connectome.txt",
+        "-out_assignments",
+        mrtrix_assignments_out,
+        "-force",
+    ]
+    if search_type == "end":
+        cmd_tck2connectome += ["-assignment_end_voxels"]
+    else:
+        cmd_tck2connectome += ["-assignment_radial_search", str(search_dist)]
+    run_command(cmd_tck2connectome)
+
+    native_assignments = assign_streamlines_native(
+        tck_file,
+        rois_in,
+        outpath_base + "_desc-native_assignments.txt",
+        outpath_base + "_desc-native_connectome.txt",
+        search_dist=search_dist,
+        search_type=search_type,
+    )
+    mrtrix_assignments = read_assignments(mrtrix_assignments_out)
+
+    agree = np.all(mrtrix_assignments == native_assignments, axis=1)
+    print(
+        f"\n Native and MRtrix assignments agree for {agree.sum()} of {len(agree)} streamlines \n"
+    )
+    if not np.all(agree):
+        warnings.warn(
+            f"Assignments differ for streamlines {np.flatnonzero(~agree)[:10].tolist()} (first 10 shown)."
+        )
+
+    return agree.mean() if len(agree) > 0 else 1.0
+
+
+def extract_tck_shard(
+    tck_file,
+    connectome_tck,
+    rois_in,
+    nodes,
+    starts,
+    lengths,
+    search_dist=2.0,
+    search_type="radial",
+    exclude_mask=None,
+    include_mask=None,
+    streamline_mask=None,
+    outfile=None,
+    header=None,
+):
+    """Assigns and selects the streamlines of one contiguous shard of a tractogram (see extract_tck_sharded)
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck), to select streamlines from
+    connectome_tck: str
+            Tractogram used to assign streamlines to the ROIs (same streamlines and layout as tck_file)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing all ROIs, each with different intensities
+    nodes: list
+            The two nodes that selected streamlines must connect (e.g., [1, 2], or [0, 1] for one ROI)
+    starts: numpy.ndarray
+            Index into the points of tck_file of the first point of each streamline in the shard
+    lengths: numpy.ndarray
+            Number of points in each streamline in the shard
+    search_dist: float
+            How far to search from endpoints for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines ('radial' or 'end')
+    exclude_mask, include_mask, streamline_mask: str
+            Paths to streamline masks (.nii.gz), as in select_tck_native
+    outfile: str
+            Path to save the shard's selected streamlines (.tck), or None to only find them
+    header: dict
+            Header fields for outfile
+
+    Outputs
+    =======
+    assignments: numpy.ndarray
+            (S, 2) nodes assigned to the endpoints of each streamline in the shard
+    kept: numpy.ndarray
+            Indices (within the shard) of the selected streamlines that pass the masks
+    n_nodes: int
+            Highest ROI label
+    """
+    from fsub_extractor.utils.froi_utils import ROI
+
+    # The shards already run in parallel, so each one queries with a single thread
+    rois = ROI.from_nifti(rois_in, labelled=True)
+    endpoints = tck_endpoints(memmap_tck_points(connectome_tck), starts, lengths)
+    assignments = assign_endpoints(
+        endpoints.reshape(-1, 3),
+        rois,
+        search_dist=search_dist,
+        search_type=search_type,
+        workers=1,
+    ).reshape(-1, 2)
+
+    sorted_assignments = np.sort(assignments, axis=1)
+    selected = np.flatnonzero(
+        (sorted_assignments[:, 0] == min(nodes))
+        & (sorted_assignments[:, 1] == max(nodes))
+    )
+    masks = dict(
+        include_masks=[] if include_mask == None else [load_mask(include_mask)],
+        exclude_masks=[] if exclude_mask == None else [load_mask(exclude_mask)],
+        streamline_mask=None if streamline_mask == None else load_mask(streamline_mask),
+    )
+    kept = select_streamlines(
+        memmap_tck_points(tck_file),
+        starts,
+        lengths,
+        selected,
+        masks,
+        outfile,
+        header=header,
+    )
+
+    return assignments, kept, int(rois.labels.max()) if len(rois) > 0 else 0
+
+
+def extract_tck_sharded(
+    tck_file,
+    rois_in,
+    nodes,
+    outfile,
+    assignments_out,
+    connectome_out,
+    n_shards,
+    connectome_tck=None,
+    search_dist=2.0,
+    search_type="radial",
+    sift2_weights=None,
+    weights_out=None,
+    exclude_mask=None,
+    include_mask=None,
+    streamline_mask=None,
+    virtual=False,
+    overwrite=True,
+):
+    """Assigns and selects streamlines in contiguous shards of a tractogram in parallel processes, then merges them in order
+    Each shard assigns its streamlines in-process (see assign_endpoints) and writes its selected streamlines to a
+    partial .tck file. Assignments, the connectome, the sub-bundle and its weights are then merged in the original
+    streamline order, so the outputs match those of an unsharded native extraction.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing all ROIs, each with different intensities
+    nodes: list
+            The two nodes that selected streamlines must connect (e.g., [1, 2], or [0, 1] for one ROI)
+    outfile: str
+            Path to output .tck file (or virtual sub-bundle .npz, if virtual)
+    assignments_out: str
+            Path to save the streamline-to-node assignments (.txt, or binary .npy)
+    connectome_out: str
+            Path to save the node-by-node connectome (.txt, or binary .npy)
+    n_shards: int
+            Number of shards (and worker processes)
+    connectome_tck: str
+            Tractogram used to assign streamlines to the ROIs, if different from tck_file (see extract_tck_mrtrix)
+    search_dist: float
+            How far to search from endpoints for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines ('radial' or 'end')
+    sift2_weights: str
+            Path to SIFT2 weights CSV file for the input tractogram
+    weights_out: str
+            Path to save the SIFT2 weights of the output streamlines
+    exclude_mask, include_mask, streamline_mask: str
+            Paths to streamline masks (.nii.gz), as in select_tck_native
+    virtual: bool
+            Save the selection as a virtual sub-bundle (see save_virtual_tck) instead of writing a .tck file
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns the path of the output tck file (or virtual sub-bundle)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if virtual and streamline_mask != None:
+        raise Exception(
+            "Streamlines truncated by a streamline mask cannot be saved as a virtual sub-bundle."
+        )
+    if overwrite == False:
+        overwrite_check(outfile)
+        overwrite_check(assignments_out)
+        overwrite_check(connectome_out)
+        if sift2_weights != None and weights_out != None:
+            overwrite_check(weights_out)
+    if connectome_tck == None:
+        connectome_tck = tck_file
+
+    points, starts, lengths = read_tck_points(tck_file)
+    if sift2_weights != None:
+        weights = load_sift2_weights(sift2_weights)
+        if len(weights) != len(starts):
+            raise Exception(
+                f"Number of SIFT2 weights ({len(weights)}) does not match number of streamlines in {tck_file} ({len(starts)})."
+            )
+    else:
+        weights = None
+
+    # Split the streamlines into contiguous shards with about the same number of points
+    n_shards = max(1, min(n_shards, len(starts)))
+    bounds = np.searchsorted(
+        np.cumsum(lengths), np.linspace(0, lengths.sum(), n_shards + 1)[1:-1]
+    )
+    shard_firsts = np.concatenate([[0], bounds]).astype(np.int64)
+    shard_lasts = np.concatenate([bounds, [len(starts)]]).astype(np.int64)
+    if virtual:
+        shard_outfiles = [None] * n_shards
+    else:
+        shard_outfiles = [
+            op.splitext(outfile)[0] + f"_shard-{i}.tck" for i in range(n_shards)
+        ]
+    print(f"Extracting from {len(starts)} streamlines in {n_shards} shard(s)")
+
+    header = read_tck_header(tck_file)
+    with ProcessPoolExecutor(max_workers=n_shards) as executor:
+        futures = [
+            executor.submit(
+                extract_tck_shard,
+                tck_file,
+                connectome_tck,
+                rois_in,
+                nodes,
+                starts[first:last],
+                lengths[first:last],
+                search_dist=search_dist,
+                search_type=search_type,
+                exclude_mask=exclude_mask,
+                include_mask=include_mask,
+                streamline_mask=streamline_mask,
+                outfile=shard_outfile,
+                header=header,
+            )
+            for first, last, shard_outfile in zip(
+                shard_firsts, shard_lasts, shard_outfiles
+            )
+        ]
+        results = [future.result() for future in futures]
+
+    # Merge the shards in their original order
+    assignments = np.concatenate(
+        [result[0] for result in results] + [np.zeros((0, 2), dtype=np.int64)]
+    )
+    kept = np.concatenate(
+        [result[1] + first for result, first in zip(results, shard_firsts)]
+        + [np.zeros(0, dtype=np.int64)]
+    )
+    n_nodes = max([result[2] for result in results] + [0])
+    save_assignments(assignments, assignments_out)
+    save_connectome(
+        assignments_connectome(assignments, n_nodes, weights=weights), connectome_out
+    )
+
+    if virtual:
+        save_virtual_tck(
+            tck_file,
+            kept,
+            outfile,
+            starts=starts[kept],
+            lengths=lengths[kept],
+            overwrite=overwrite,
+        )
+    else:
+        concatenate_tck(shard_outfiles, outfile, overwrite=overwrite)
+        for shard_outfile in shard_outfiles:
+            os.remove(shard_outfile)
+        print(f"Selected {len(kept)} streamlines into {outfile}")
+
+    if weights is not None:
+        kept_weights = weights[kept]
+        print(f"Sum of SIFT2 weights of selected streamlines: {kept_weights.sum()}")
+        if weights_out != None:
+            save_sift2_weights(kept_weights, weights_out, overwrite=overwrite)
+
+    return outfile
+
+
+def cull_tck(
+    tck_file,
+    rois_in,
+    outpath_base,
+    search_dist=2.0,
+    search_type="radial",
+    connectome_tck=None,
+    sift2_weights=None,
+    endpoint_index=None,
+    overwrite=True,
+):
+    """Keeps only the streamlines with an endpoint near any ROI, as candidates for tck2connectome
+    Assignment searches never reach further than search_dist from an endpoint, so streamlines without an endpoint in
+    any ROI bounding box (expanded by search_dist) are unassigned (node 0 at both ends). Culling them changes neither
+    the extracted streamlines nor the assignments (once culled streamlines are filled back in as 0 0) and connectome.
+    Only endpoints are tested, so nothing is culled for search_type 'all'.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii) containing all ROIs, each with different intensities
+    outpath_base: str
+            Path to output directory, including output prefix
+    search_dist: float
+            How far to search ahead of streamlines for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines (forward, reverse, radial, end, or all).
+    connectome_tck: str
+            Tractogram in the space of rois_in, if tck_file is not (see extract_tck_mrtrix)
+    sift2_weights: str
+            Path to SIFT2 weights CSV file
+    endpoint_index: str
+            Path to a persistent endpoint index of connectome_tck (.npz, built if missing or out of date). If given,
+            endpoints are looked up in the index instead of scanning the tractogram.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns None if no streamlines can be culled (or the ROIs cannot be read), otherwise a tuple of
+    (candidate tck file, candidate connectome tck file, candidate SIFT2 weights file, candidate indices, number of streamlines,
+    index of the first point of each candidate in tck_file)
+    outpath_base + _desc-candidates.tck holds the candidate streamlines, in their original order
+    outpath_base + _desc-candidates_space-ROI.tck holds the candidates of connectome_tck (if given)
+    outpath_base + _desc-candidatesSIFT2weights.csv/.npy hold the candidates' SIFT2 weights (if given)
+    These are intermediate files for the caller to remove.
+    """
+    if search_type == "all" or op.splitext(rois_in)[-1] == ".mif":
+        return None
+
+    if connectome_tck == None:
+        connectome_tck = tck_file
+    if search_type == "end":
+        margin = 0
+    else:
+        margin = float(search_dist)
+    bboxes = roi_bbox_world(rois_in, margin=margin)
+
+    if endpoint_index != None:
+        index = load_endpoint_index(connectome_tck, endpoint_index)
+        # Only the candidates' geometry is read later, so skip the delimiter scan
+        points, starts, lengths = (
+            memmap_tck_points(connectome_tck),
+            index["starts"],
+            index["lengths"],
+        )
+        n_streamlines = len(starts)
+    else:
+        points, starts, lengths = read_tck_points(connectome_tck)
+        endpoints = tck_endpoints(points, starts, lengths)
+        n_streamlines = len(endpoints)
+
+    def near(bbox):
+        if bbox == None:
+            return np.zeros((n_streamlines, 2), dtype=bool)
+        lower, upper = bbox
+        if endpoint_index != None:
+            return query_endpoint_index(index, lower, upper)
+        return np.all((endpoints >= lower) & (endpoints <= upper), axis=2)
+
+    # Keeping streamlines near any ROI, not just those that could connect the extracted nodes, keeps the
+    # assignments of one-ended streamlines and self-connections (e.g., for membership and the connectome)
+    keep = np.zeros(n_streamlines, dtype=bool)
+    for bbox in bboxes:
+        keep |= np.any(near(bbox), axis=1)
+    if np.all(keep):
+        return None
+    candidates = np.flatnonzero(keep)
+    print(f"\n Kept {len(candidates)} of {len(keep)} streamlines near the ROIs \n")
+
+    if connectome_tck == tck_file:
+        candidate_tck = write_tck_subset(
+            tck_file,
+            outpath_base + "_desc-candidates.tck",
+            candidates,
+            tck_points=(points, starts, lengths),
+            overwrite=overwrite,
+        )
+        candidate_connectome_tck = candidate_tck
+    else:
+        candidate_connectome_tck = write_tck_subset(
+            connectome_tck,
+            outpath_base + "_desc-candidates_space-ROI.tck",
+            candidates,
+            tck_points=(points, starts, lengths),
+            overwrite=overwrite,
+        )
+        # Both tractograms hold the same streamlines, so they are laid out the same way
+        candidate_tck = write_tck_subset(
+            tck_file,
+            outpath_base + "_desc-candidates.tck",
+            candidates,
+            tck_points=(memmap_tck_points(tck_file), starts, lengths),
+            overwrite=overwrite,
+        )
+
+    if sift2_weights != None:
+        candidate_weights = save_sift2_weights(
+            load_sift2_weights(sift2_weights)[candidates],
+            outpath_base + "_desc-candidatesSIFT2weights.csv",
+            overwrite=overwrite,
+        )
+    else:
+        candidate_weights = None
+
+    return (
+        candidate_tck,
+        candidate_connectome_tck,
+        candidate_weights,
+        candidates,
+        len(keep),
+        starts[candidates],
+    )
+
+
+def fsub_output_names(outpath_base, masked=False, virtual=False):
+    """Names the sub-bundle and SIFT2 weights written by native extraction
+    Parameters
+    ==========
+    outpath_base: str
+            Path to output directory, including output prefix
+    masked: bool
+            Whether streamline masks are applied
+    virtual: bool
+            Whether the sub-bundle is saved as a virtual selection (see save_virtual_tck)
+
+    Outputs
+    =======
+    fsub_out: str
+            Path to the sub-bundle (.tck, or _selection.npz)
+    weights_out: str
+            Path to the sub-bundle's SIFT2 weights (.csv)
+    """
+    if masked:
+        fsub_out = outpath_base + "_desc-fsub_desc-masked.tck"
+        weights_out = outpath_base + "desc-fsubSIFT2weights_desc-masked.csv"
+    else:
+        fsub_out = outpath_base + "_desc-fsub.tck"
+        weights_out = outpath_base + "desc-fsubSIFT2weights.csv"
+    if virtual:
+        fsub_out = fsub_out.replace(".tck", "_selection.npz")
+
+    return fsub_out, weights_out
+
+
+def search_setting_label(search_type, search_dist):
+    """Labels a search setting for file names, e.g. 'radial2mm', 'radial2p5mm' or 'end'
+    Parameters
+    ==========
+    search_type: str
+            Method of searching for streamlines (forward, reverse, radial, end, or all)
+    search_dist: float
+            How far to search for ROIs, in mm (ignored for 'end' and 'all')
+
+    Outputs
+    =======
+    label: str
+            Label of the search setting
+    """
+    if search_type in ["end", "all"]:
+        return search_type
+    return f"{search_type}{float(search_dist):g}mm".replace(".", "p")
+
+
+def search_settings(search_types, search_dists):
+    """Combines search types and distances into distinct search settings ('end' and 'all' ignore the distance)
+    Parameters
+    ==========
+    search_types: list
+            Methods of searching for streamlines
+    search_dists: list
+            Search distances, in mm
+
+    Outputs
+    =======
+    settings: list
+            Distinct (search_type, search_dist) pairs, in the order given
+    """
+    settings = []
+    for search_type in search_types:
+        for search_dist in search_dists:
+            if search_type in ["end", "all"]:
+                search_dist = search_dists[0]
+            if (search_type, search_dist) not in settings:
+                settings += [(search_type, search_dist)]
+
+    return settings
+
+
+def extract_tck_sweep(
+    tck_file,
+    rois_in,
+    outpath_base,
+    two_rois,
+    settings,
+    sift2_weights=None,
+    exclude_mask=None,
+    include_mask=None,
+    streamline_mask=None,
+    connectome_tck=None,
+    binary_assignments=False,
+    virtual=False,
+    membership=False,
+    node_names=None,
+    overwrite=True,
+    **extract_kwargs,
+):
+    """Extracts the sub-bundle for several search settings, assigning endpoints for all radii in one pass
+    Endpoints are read once, and the nearest ROI voxel to each is found once (see nearest_roi_labels); the assignments
+    for each 'radial' distance and for 'end' follow from those. Other search types fall back to extract_tck_mrtrix.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    rois_in: str
+            Atlas-like image (.nii.gz, .nii., .mif) containing all ROIs, each with different intensities
+    outpath_base: str
+            Path to output directory, including output prefix. Each setting's outputs get a _desc-{setting} label.
+    two_rois: bool
+            True if two ROIs in rois_in, False, if one ROI in rois_in
+    settings: list
+            (search_type, search_dist) pairs, e.g. from search_settings
+    sift2_weights: str
+            Path to SIFT2 weights CSV file
+    exclude_mask, include_mask, streamline_mask: str
+            Paths to streamline masks (.nii.gz), as in extract_tck_mrtrix
+    connectome_tck: str
+            Tractogram used to assign streamlines to the ROIs, if different from tck_file (see extract_tck_mrtrix)
+    binary_assignments: bool
+            Save the assignments and connectome as binary .npy files instead of text
+    virtual: bool
+            Save the sub-bundles as virtual selections (see save_virtual_tck)
+    membership: bool
+            Save which streamlines of tck_file reach each ROI for each setting (see save_membership)
+    node_names: dict
+            Maps ROI labels to names used in the membership files. Default is to use the labels.
     overwrite: bool
             Whether to allow overwriting outputs
+    extract_kwargs:
+            Other arguments passed to extract_tck_mrtrix for settings it handles (e.g., native, cull)
 
     Outputs
     =======
-    tck_file: str
-            Path to output .tck file
+    Function returns a dict mapping each search setting to its extracted tck file (or virtual sub-bundle)
+    outpath_base + _desc-{setting}_desc-membership.npz holds each setting's membership bitsets (if membership is True)
     """
-    from dipy.io.streamline import load_tractogram, save_tractogram
-    import nibabel.filebasedimages
+    from fsub_extractor.utils.froi_utils import ROI
 
-    # trk_loaded = load_tractogram(trk_file, ref)
-    trk_loaded = load_tractogram(trk_file, "same")
-    filename = op.basename(trk_file).replace(".trk", ".tck")
-    tck_file = op.join(out_dir, filename)
-    save_tractogram(trk_loaded, tck_file)
+    # As with tckedit, a streamline mask is only applied along with an exclusion or inclusion mask
+    if streamline_mask != None and exclude_mask == None and include_mask == None:
+        warnings.warn(
+            "A streamline mask is only applied along with an exclusion or inclusion mask; ignoring it."
+        )
+        streamline_mask = None
+    if virtual and streamline_mask != None:
+        warnings.warn(
+            "Streamlines truncated by a streamline mask cannot be saved as a virtual sub-bundle; writing .tck files instead."
+        )
+        virtual = False
+    if binary_assignments:
+        assignments_ext = ".npy"
+    else:
+        assignments_ext = ".txt"
+    nodes = [1, 2] if two_rois else [0, 1]
+    masked = exclude_mask != None or include_mask != None or streamline_mask != None
 
-    return tck_file
+    mask_args = dict(
+        exclude_mask=exclude_mask,
+        include_mask=include_mask,
+        streamline_mask=streamline_mask,
+    )
+    native_settings = [
+        setting
+        for setting in settings
+        if setting[0] in ["radial", "end"]
+        and op.splitext(rois_in)[-1] != ".mif"
+        and all(mask == None or mask[-4:] != ".mif" for mask in mask_args.values())
+    ]
+    fsub_files = {}
+
+    ### Settings tck2connectome handles one at a time
+    for search_type, search_dist in settings:
+        if (search_type, search_dist) in native_settings:
+            continue
+        fsub_files[(search_type, search_dist)] = extract_tck_mrtrix(
+            tck_file,
+            rois_in,
+            outpath_base + f"_desc-{search_setting_label(search_type, search_dist)}",
+            two_rois,
+            search_dist=search_dist,
+            search_type=search_type,
+            sift2_weights=sift2_weights,
+            connectome_tck=connectome_tck,
+            binary_assignments=binary_assignments,
+            virtual=virtual,
+            membership=membership,
+            node_names=node_names,
+            overwrite=overwrite,
+            **mask_args,
+            **extract_kwargs,
+        )
+
+    ### One nearest-ROI search for all the other settings
+    if len(native_settings) > 0:
+        if connectome_tck == None:
+            connectome_tck = tck_file
+        rois = ROI.from_nifti(rois_in, labelled=True)
+        points, starts, lengths = read_tck_points(connectome_tck)
+        all_assignments = assign_endpoints_sweep(
+            tck_endpoints(points, starts, lengths).reshape(-1, 3),
+            rois,
+            native_settings,
+        )
+        n_nodes = int(rois.labels.max()) if len(rois) > 0 else 0
+        if sift2_weights != None:
+            weights = load_sift2_weights(sift2_weights)
+        else:
+            weights = None
+
+        for setting, labels in all_assignments.items():
+            setting_base = outpath_base + f"_desc-{search_setting_label(*setting)}"
+            assignments_out = setting_base + "_desc-assignments" + assignments_ext
+            connectome_out = setting_base + "_desc-connectome" + assignments_ext
+            if overwrite == False:
+                overwrite_check(assignments_out)
+                overwrite_check(connectome_out)
+            assignments = labels.reshape(-1, 2)
+            save_assignments(assignments, assignments_out)
+            save_connectome(
+                assignments_connectome(assignments, n_nodes, weights=weights),
+                connectome_out,
+            )
+            if membership:
+                save_membership(
+                    tck_file,
+                    assignments_out,
+                    setting_base + "_desc-membership.npz",
+                    node_names=node_names,
+                    overwrite=overwrite,
+                )
+
+            fsub_out, weights_out = fsub_output_names(
+                setting_base, masked=masked, virtual=virtual
+            )
+            fsub_files[setting] = select_tck_native(
+                tck_file,
+                assignments_out,
+                nodes,
+                fsub_out,
+                sift2_weights=sift2_weights,
+                weights_out=weights_out,
+                virtual=virtual,
+                overwrite=overwrite,
+                **mask_args,
+            )
+
+    return {setting: fsub_files[setting] for setting in settings}
 
 
 def extract_tck_mrtrix(
@@ -44,6 +2806,16 @@ def extract_tck_mrtrix(
     exclude_mask=None,
     include_mask=None,
     streamline_mask=None,
+    native=False,
+    connectome_tck=None,
+    cull=False,
+    endpoint_index=None,
+    native_assignment=False,
+    virtual=False,
+    membership=False,
+    node_names=None,
+    binary_assignments=False,
+    n_shards=1,
     overwrite=True,
 ):
     """Uses MRtrix tools to extract the TCK file that connects to the ROI(s)
@@ -71,59 +2843,228 @@ def extract_tck_mrtrix(
     include_mask: str
             Path to streamline inclusion mask (.nii.gz). Streamlines must intersect this mask to be kept
     streamline_mask: str
-            Path to streamline mask (.nii.gz). Streamlines leaving this mask are truncated
+            Path to streamline mask (.nii.gz). Streamlines leaving this mask are truncated. Only applied along with
+            exclude_mask or include_mask.
+    native: bool
+            Select and mask streamlines in-process, in one pass over the tractogram, instead of with connectome2tck and tckedit
+    connectome_tck: str
+            Tractogram used to assign streamlines to the ROIs, if different from tck_file (e.g., tck_file transformed into
+            the space of rois_in). Must hold the same streamlines in the same order. Streamlines are still extracted from tck_file.
+    cull: bool
+            Drop streamlines without an endpoint near any ROI before running tck2connectome (see cull_tck). Does not
+            change the sub-bundle, assignments, connectome or membership. The candidate files are removed once the
+            sub-bundle is extracted.
+    endpoint_index: str
+            Path to a persistent endpoint index of the tractogram used for culling (.npz, built if missing or out of date).
+            Implies cull.
+    native_assignment: bool
+            Assign streamlines to ROIs in-process (see assign_streamlines_native) instead of with tck2connectome.
+            Only for 'radial' and 'end' search types and NIFTI ROIs; other cases still use tck2connectome.
+    virtual: bool
+            Save the sub-bundle as a selection of the streamlines of tck_file (see save_virtual_tck) instead of a copy of them.
+            Implies native selection. Not possible with a streamline_mask, which truncates streamlines.
+    membership: bool
+            Save which streamlines of tck_file reach each ROI (see save_membership), for later queries with query_membership
+    node_names: dict
+            Maps ROI labels to names used in the membership file. Default is to use the labels.
+    binary_assignments: bool
+            Save the assignments and connectome as binary .npy files instead of text (see save_assignments).
+            Implies native selection, as connectome2tck only reads text assignments.
+    n_shards: int
+            Assign and select streamlines in this many contiguous shards of the tractogram, in parallel processes
+            (see extract_tck_sharded). Only for 'radial' and 'end' search types and NIFTI ROIs and masks.
     overwrite: bool
             Whether to allow overwriting outputs
 
     Outputs
     =======
-    Function returns the path of the extracted tck file
-    outpath_base + assignments.txt/connectome.txt describe the streamline-to-node assignments
+    Function returns the path of the extracted tck file (or virtual sub-bundle)
+    outpath_base + assignments.txt/connectome.txt describe the streamline-to-node assignments (.npy if binary_assignments)
+    outpath_base + _desc-membership.npz holds a bitset of the streamlines reaching each ROI (if membership is True)
     outpath_base + extracted.tck is the extracted sub-bundle
     outpath_base + extracted_masked.tck is the extracted bundle after applying exclusion masking (if masking is done)
     *_weights.csv files are the SIFT2 weights for the extracted and masked bundles
     """
 
-    ### tck2connectome
-    tck2connectome = find_program("tck2connectome")
-    tck2connectome_connectome_out = outpath_base + "_desc-connectome.txt"
-    tck2connectome_assignments_out = outpath_base + "_desc-assignments.txt"
-    cmd_tck2connectome = [
-        tck2connectome,
-        tck_file,
-        rois_in,
-        tck2connectome_connectome_out,
-        # "-assignment_" + search_type + "_search",
-        # search_dist,
-        "-out_assignments",
-        tck2connectome_assignments_out,
-    ]
-    if search_type == "end" or search_type == "all":
-        cmd_tck2connectome += [f"-assignment_{search_type}_voxels"]
+    # Change connectome2tck arguments based on single node or pairwise nodes
+    if two_rois:
+        nodes = "1,2"
+    else:
+        nodes = "0,1"
+
+    # As with tckedit, a streamline mask is only applied along with an exclusion or inclusion mask
+    if streamline_mask != None and exclude_mask == None and include_mask == None:
+        warnings.warn(
+            "A streamline mask is only applied along with an exclusion or inclusion mask; ignoring it."
+        )
+        streamline_mask = None
+    if virtual and streamline_mask != None:
+        warnings.warn(
+            "Streamlines truncated by a streamline mask cannot be saved as a virtual sub-bundle; writing a .tck file instead."
+        )
+        virtual = False
+    if virtual or binary_assignments:
+        native = True
+    # Search type 'all' assigns any number of nodes to a streamline, which only connectome2tck can select from
+    if search_type == "all" and (native or membership):
+        raise Exception(
+            "Search type 'all' cannot be used with native extraction, virtual outputs, binary assignments or membership."
+        )
+    if binary_assignments:
+        assignments_ext = ".npy"
+    else:
+        assignments_ext = ".txt"
+    fsub_out, weights_out = fsub_output_names(
+        outpath_base,
+        masked=exclude_mask != None or include_mask != None or streamline_mask != None,
+        virtual=virtual,
+    )
+
+    ### Assign and select in parallel shards of the tractogram
+    if n_shards > 1:
+        if search_type not in ["radial", "end"] or any(
+            image != None and image[-4:] == ".mif"
+            for image in [rois_in, exclude_mask, include_mask, streamline_mask]
+        ):
+            warnings.warn(
+                "Sharded extraction needs the 'radial' or 'end' search type and NIFTI images; extracting without shards."
+            )
+        else:
+            extract_tck_sharded(
+                tck_file,
+                rois_in,
+                [int(node) for node in nodes.split(",")],
+                fsub_out,
+                outpath_base + "_desc-assignments" + assignments_ext,
+                outpath_base + "_desc-connectome" + assignments_ext,
+                n_shards,
+                connectome_tck=connectome_tck,
+                search_dist=search_dist,
+                search_type=search_type,
+                sift2_weights=sift2_weights,
+                weights_out=weights_out,
+                exclude_mask=exclude_mask,
+                include_mask=include_mask,
+                streamline_mask=streamline_mask,
+                virtual=virtual,
+                overwrite=overwrite,
+            )
+            if membership:
+                save_membership(
+                    tck_file,
+                    outpath_base + "_desc-assignments" + assignments_ext,
+                    outpath_base + "_desc-membership.npz",
+                    node_names=node_names,
+                    overwrite=overwrite,
+                )
+            return fsub_out
+
+    ### Only pass streamlines that can reach the ROIs on to tck2connectome
+    if connectome_tck == None:
+        connectome_tck = tck_file
+    parent_tck = tck_file
+    parent = None
+    tck2connectome_assignments_out = (
+        outpath_base + "_desc-assignments" + assignments_ext
+    )
+    candidates = None
+    if cull or endpoint_index != None:
+        candidates = cull_tck(
+            tck_file,
+            rois_in,
+            outpath_base,
+            search_dist=search_dist,
+            search_type=search_type,
+            connectome_tck=connectome_tck,
+            sift2_weights=sift2_weights,
+            endpoint_index=endpoint_index,
+            overwrite=overwrite,
+        )
+    if candidates != None:
+        parent = (tck_file, candidates[3], candidates[5])
+        (
+            tck_file,
+            connectome_tck,
+            sift2_weights,
+            candidate_indices,
+            n_streamlines,
+            candidate_starts,
+        ) = candidates
+        # Assignments of the candidates; expanded to all streamlines afterwards
+        assignments = (
+            outpath_base + "_desc-candidates_desc-assignments" + assignments_ext
+        )
+        candidate_files = [tck_file, connectome_tck, assignments]
+        if sift2_weights != None:
+            candidate_files += [sift2_weights, op.splitext(sift2_weights)[0] + ".npy"]
     else:
-        cmd_tck2connectome += [f"-assignment_{search_type}_search", search_dist]
+        assignments = tck2connectome_assignments_out
 
+    ### tck2connectome
+    tck2connectome_connectome_out = outpath_base + "_desc-connectome" + assignments_ext
     if overwrite == False:
+        overwrite_check(assignments)
         overwrite_check(tck2connectome_assignments_out)
         overwrite_check(tck2connectome_connectome_out)
-    else:
-        cmd_tck2connectome += ["-force"]
-    if sift2_weights != None:
-        cmd_tck2connectome += ["-tck_weights_in", sift2_weights]
-    run_command(cmd_tck2connectome)
+
+    assign_streamlines(
+        connectome_tck,
+        rois_in,
+        assignments,
+        tck2connectome_connectome_out,
+        search_dist=search_dist,
+        search_type=search_type,
+        sift2_weights=sift2_weights,
+        native=native_assignment,
+    )
+
+    # Culled streamlines are unassigned (node 0 at both ends)
+    if candidates != None:
+        full_assignments = np.zeros((n_streamlines, 2), dtype=np.int64)
+        full_assignments[candidate_indices] = read_assignments(assignments)
+        save_assignments(full_assignments, tck2connectome_assignments_out)
+
+    if membership:
+        save_membership(
+            parent_tck,
+            tck2connectome_assignments_out,
+            outpath_base + "_desc-membership.npz",
+            node_names=node_names,
+            overwrite=overwrite,
+        )
+
+    def remove_candidates():
+        if candidates != None:
+            for candidate_file in set(candidate_files):
+                if op.exists(candidate_file):
+                    os.remove(candidate_file)
+
+    ### Select and mask streamlines in one pass
+    if native:
+        fsub_out = select_tck_native(
+            tck_file,
+            assignments,
+            [int(node) for node in nodes.split(",")],
+            fsub_out,
+            sift2_weights=sift2_weights,
+            weights_out=weights_out,
+            exclude_mask=exclude_mask,
+            include_mask=include_mask,
+            streamline_mask=streamline_mask,
+            virtual=virtual,
+            parent=parent,
+            overwrite=overwrite,
+        )
+        remove_candidates()
+        return fsub_out
 
     ### connectome2tck
     connectome2tck = find_program("connectome2tck")
     connectome2tck_out = outpath_base + "_desc-fsub.tck"
-    # Change connectome2tck arguments based on single node or pairwise nodes
-    if two_rois:
-        nodes = "1,2"
-    else:
-        nodes = "0,1"
     cmd_connectome2tck = [
         connectome2tck,
         tck_file,
-        tck2connectome_assignments_out,
+        assignments,
         connectome2tck_out,
         "-nodes",
         nodes,
@@ -144,6 +3085,7 @@ def extract_tck_mrtrix(
             sift2_weights_extracted,
         ]
     run_command(cmd_connectome2tck)
+    remove_candidates()
 
     # Mask streamlines if requested
     if exclude_mask != None or include_mask != None:
@@ -193,6 +3135,11 @@ def generate_tck_mrtrix(
     include_mask=None,
     streamline_mask=None,
     tckgen_params=None,
+    n_shards=1,
+    nthreads=None,
+    seed=None,
+    pilot_seeds=None,
+    time_budget=None,
     overwrite=True,
 ):
     """Uses MRtrix tools to generate a TCK file that connects to the ROI(s)
@@ -221,6 +3168,16 @@ def generate_tck_mrtrix(
             Path to streamline mask (.nii.gz). Streamlines leaving this mask are truncated
     tckgen_params: str
             Path to txt file with additional tckgen params
+    n_shards: int
+            Number of tckgen processes to split generation across. Shards run concurrently and are concatenated.
+    nthreads: int
+            Total number of threads to use, split evenly across shards. Default (None) splits the available cores across shards.
+    seed: int
+            Random seed for tckgen. Shard i is seeded with seed + i. Default (None) draws a random seed.
+    pilot_seeds: int
+            If set, first run a pilot with this many seeds to estimate the acceptance rate, and cap the seeds of the main run accordingly
+    time_budget: float
+            Maximum time (in seconds) for the main run, enforced as a seed cap extrapolated from the pilot. Implies a pilot run.
     overwrite: bool
             Whether to allow overwriting outputs
 
@@ -228,6 +3185,8 @@ def generate_tck_mrtrix(
     =======
     Function returns the path of the extracted tck file
     Function saves out tractogram to outfile
+    A .json sidecar next to outfile records the tckgen command, input file signatures, seeds, achieved count and acceptance rate.
+    If a compatible output with fewer streamlines exists, only the missing streamlines are generated and appended.
     """
 
     ### tckgen
@@ -235,7 +3194,6 @@ def generate_tck_mrtrix(
     cmd_tckgen = [
         tckgen,
         wmfod,
-        outfile,
         "-seeds",
         "0",
         "-seed_gmwmi",
@@ -247,8 +3205,6 @@ def generate_tck_mrtrix(
         fivett,
         "-backtrack",
         "-crop_at_gmwmi",
-        "-select",
-        str(n_streamlines),
     ]
     if roi_end != None:
         cmd_tckgen += ["-include", roi_end]
@@ -261,16 +3217,632 @@ def generate_tck_mrtrix(
     if streamline_mask != None:
         cmd_tckgen += ["-mask", streamline_mask]
     if tckgen_params != None:
-        with open(tckgen_parmas) as f:
+        with open(tckgen_params) as f:
             params_str = f.readlines()[0]
-            params_list = params_str.split(" ")
+            params_list = params_str.split()
             f.close()
         cmd_tckgen += params_list
-    if overwrite == False:
+
+    # Describe this generation so that a later, larger request can top up the output
+    sidecar = op.splitext(outfile)[0] + ".json"
+    input_files = sorted(set(arg for arg in cmd_tckgen[1:] if op.isfile(arg)))
+    generation_info = {
+        "TckgenCommand": cmd_tckgen[1:],
+        "InputSignatures": {file: file_signature(file) for file in input_files},
+    }
+
+    # Check for a compatible existing output (same command, and unchanged inputs)
+    n_existing = 0
+    previous_info = load_json(sidecar)
+    previous_signatures = previous_info.get("InputSignatures", {})
+    if (
+        op.exists(outfile)
+        and previous_info.get("TckgenCommand") == generation_info["TckgenCommand"]
+        and sorted(previous_signatures) == input_files
+        and all(
+            signature_matches(file, signature)
+            for file, signature in previous_signatures.items()
+        )
+    ):
+        n_existing = int(read_tck_header(outfile).get("count", 0))
+    if n_existing == n_streamlines:
+        print(f"Reusing {n_existing} previously generated streamlines in {outfile}")
+        return outfile
+    elif n_existing > n_streamlines:
+        n_existing = 0
+
+    # A compatible existing output is extended rather than overwritten
+    if overwrite == True:
+        cmd_tckgen += ["-force"]
+    elif n_existing == 0:
         overwrite_check(outfile)
+
+    # Seeds used for the existing streamlines must not be reused
+    if n_existing > 0:
+        print(f"Topping up {n_existing} existing streamlines in {outfile}")
+        previous_seeds = previous_info.get("RandomSeeds", [])
     else:
-        cmd_tckgen += ["-force"]
+        previous_seeds = []
+    if seed == None:
+        # The pilot and the shards use seed..seed + n_shards
+        seed = random.randrange(2**31 - n_shards - 1)
+        while any(seed <= prev <= seed + n_shards for prev in previous_seeds):
+            seed = random.randrange(2**31 - n_shards - 1)
+    else:
+        seed = max([seed - 1] + previous_seeds) + 1
+
+    n_needed = n_streamlines - n_existing
+    new_outfiles = []
+    seeds = []
+    max_seeds = None
+
+    # Estimate the acceptance rate from a short pilot run and cap the main run
+    if pilot_seeds == None and time_budget != None:
+        pilot_seeds = PILOT_SEEDS_DEFAULT
+    if pilot_seeds != None:
+        pilot_outfile = op.splitext(outfile)[0] + "_desc-pilot.tck"
+        budget_info = estimate_tckgen_budget(
+            cmd_tckgen,
+            n_needed,
+            pilot_outfile,
+            pilot_seeds=pilot_seeds,
+            time_budget=time_budget,
+            nthreads=nthreads,
+            seed=seed,
+        )
+        generation_info["Budget"] = budget_info
+        max_seeds = budget_info["MaxSeeds"]
+        n_needed -= budget_info["PilotCount"]
+        new_outfiles += [pilot_outfile]
+        seeds += [seed]
+        seed += 1
+
+    if n_needed > 0 and (max_seeds == None or max_seeds > 0):
+        if n_existing == 0 and len(new_outfiles) == 0:
+            main_outfile = outfile
+        else:
+            main_outfile = op.splitext(outfile)[0] + "_desc-topup.tck"
+        seeds += run_tckgen(
+            cmd_tckgen,
+            n_needed,
+            main_outfile,
+            n_shards=n_shards,
+            nthreads=nthreads,
+            seed=seed,
+            max_seeds=max_seeds,
+            overwrite=overwrite,
+        )
+        new_outfiles += [main_outfile]
+
+    # Append the new streamlines to any existing ones, without rewriting those
+    if n_existing > 0:
+        append_tck(outfile, new_outfiles)
+    elif new_outfiles != [outfile]:
+        concatenate_tck(new_outfiles, outfile)
+    for new_outfile in new_outfiles:
+        if new_outfile != outfile:
+            os.remove(new_outfile)
+
+    header = read_tck_header(outfile)
+    generation_info["RandomSeeds"] = previous_seeds + seeds
+    generation_info["Count"] = int(header.get("count", 0))
+    if "total_count" in header and int(header["total_count"]) > 0:
+        generation_info["AcceptanceRate"] = generation_info["Count"] / int(
+            header["total_count"]
+        )
+    if generation_info["Count"] < n_streamlines:
+        warnings.warn(
+            f"Only {generation_info['Count']} of {n_streamlines} requested streamlines were generated for {outfile}."
+        )
+    save_json(generation_info, sidecar)
+
+    return outfile
+
+
+def estimate_tckgen_budget(
+    cmd_tckgen,
+    n_streamlines,
+    pilot_outfile,
+    pilot_seeds=PILOT_SEEDS_DEFAULT,
+    time_budget=None,
+    nthreads=None,
+    seed=None,
+):
+    """Runs a short seeded tckgen pilot to estimate the acceptance rate and a seed cap for the main run
+
+    Parameters
+    ==========
+    cmd_tckgen: list
+            tckgen command without the output file or -select, -nthreads options
+    n_streamlines: int
+            Number of streamlines the main run should select
+    pilot_outfile: str
+            Path to save the pilot streamlines (they count towards n_streamlines)
+    pilot_seeds: int
+            Number of seeds to attempt in the pilot
+    time_budget: float
+            Maximum time (in seconds) the main run should take. Default (None) only caps by the expected number of seeds.
+    nthreads: int
+            Number of threads to use
+    seed: int
+            Random seed for the pilot
+
+    Outputs
+    =======
+    budget_info: dict
+            Pilot count and acceptance rate, expected runtime and the seed cap ('MaxSeeds') for the main run
+    """
+
+    cmd_pilot = list(cmd_tckgen)
+    cmd_pilot[cmd_pilot.index("-seeds") + 1] = str(pilot_seeds)
+    cmd_pilot += ["-select", str(n_streamlines), pilot_outfile]
+    if nthreads != None:
+        cmd_pilot += ["-nthreads", str(nthreads)]
+    env = None if seed == None else dict(os.environ, MRTRIX_RNG_SEED=str(seed))
+
+    start_time = time.time()
+    run_command(cmd_pilot, env=env)
+    elapsed = max(time.time() - start_time, 1e-3)
+
+    header = read_tck_header(pilot_outfile)
+    pilot_count = int(header.get("count", 0))
+    pilot_attempts = max(int(header.get("total_count", pilot_seeds)), 1)
+    acceptance_rate = pilot_count / pilot_attempts
+    seeds_per_second = pilot_attempts / elapsed
+
+    n_remaining = n_streamlines - pilot_count
+    if acceptance_rate > 0:
+        expected_seeds = int(np.ceil(n_remaining / acceptance_rate))
+        max_seeds = int(np.ceil(PILOT_SEED_MARGIN * expected_seeds))
+        expected_runtime = expected_seeds / seeds_per_second
+    else:
+        warnings.warn(
+            f"No streamlines were accepted in a pilot of {pilot_attempts} seeds; capping the main run at {PILOT_ZERO_ACCEPTANCE_FACTOR} times the pilot."
+        )
+        max_seeds = PILOT_ZERO_ACCEPTANCE_FACTOR * pilot_attempts
+        expected_runtime = None
+    if time_budget != None:
+        max_seeds = min(max_seeds, int(time_budget * seeds_per_second))
+    if n_remaining <= 0:
+        max_seeds = 0
+
+    print(
+        f"Pilot accepted {pilot_count} of {pilot_attempts} seeds (rate {acceptance_rate:.2e}); capping main run at {max_seeds} seeds"
+    )
+
+    return {
+        "Requested": n_streamlines,
+        "PilotSeeds": pilot_attempts,
+        "PilotCount": pilot_count,
+        "PilotAcceptanceRate": acceptance_rate,
+        "PilotRuntime": elapsed,
+        "ExpectedRuntime": expected_runtime,
+        "TimeBudget": time_budget,
+        "MaxSeeds": max_seeds,
+    }
+
+
+def run_tckgen(
+    cmd_tckgen,
+    n_streamlines,
+    outfile,
+    n_shards=1,
+    nthreads=None,
+    seed=None,
+    max_seeds=None,
+    overwrite=True,
+):
+    """Runs a tckgen command, optionally split into concurrent shards with distinct seeds
+
+    Parameters
+    ==========
+    cmd_tckgen: list
+            tckgen command without the output file or -select, -nthreads options
+    n_streamlines: int
+            Number of streamlines to select
+    outfile: str
+            Path to save output file
+    n_shards: int
+            Number of tckgen processes to split generation across. Shards run concurrently and are concatenated.
+    nthreads: int
+            Total number of threads to use, split evenly across shards. Default (None) splits the available cores
+            across shards (or lets MRtrix decide for a single shard).
+    seed: int
+            Random seed for tckgen. Shard i is seeded with seed + i. Default (None) draws a random seed.
+    max_seeds: int
+            Maximum number of seeds to attempt across all shards. Default (None) is unlimited.
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    seeds: list
+            Random seed used for each shard
+    """
+
+    # Split the requested streamlines as evenly as possible across shards
+    n_shards = max(1, min(n_shards, n_streamlines))
+    shard_selects = [
+        n_streamlines // n_shards + (i < n_streamlines % n_shards)
+        for i in range(n_shards)
+    ]
+    if seed == None:
+        seed = random.randrange(2**31 - n_shards)
+    seeds = [seed + i for i in range(n_shards)]
+    print(f"Generating {n_streamlines} streamlines in {n_shards} shard(s), seed {seed}")
+
+    if n_shards == 1:
+        shard_outfiles = [outfile]
+    else:
+        shard_outfiles = [
+            op.splitext(outfile)[0] + f"_shard-{i}.tck" for i in range(n_shards)
+        ]
+
+    cmd_shards = []
+    env_shards = []
+    for i in range(n_shards):
+        cmd_shard = cmd_tckgen + ["-select", str(shard_selects[i]), shard_outfiles[i]]
+        if max_seeds != None:
+            cmd_shard[cmd_shard.index("-seeds") + 1] = str(
+                max(1, int(np.ceil(max_seeds / n_shards)))
+            )
+        if nthreads != None:
+            cmd_shard += ["-nthreads", str(max(1, nthreads // n_shards))]
+        elif n_shards > 1:
+            cmd_shard += ["-nthreads", str(max(1, (os.cpu_count() or 1) // n_shards))]
+        if overwrite == False:
+            overwrite_check(shard_outfiles[i])
+        cmd_shards += [cmd_shard]
+        env_shards += [dict(os.environ, MRTRIX_RNG_SEED=str(seeds[i]))]
+    run_commands_parallel(cmd_shards, envs=env_shards)
+
+    # Merge shards into the final output
+    if n_shards > 1:
+        concatenate_tck(shard_outfiles, outfile, overwrite=overwrite)
+        for shard_outfile in shard_outfiles:
+            os.remove(shard_outfile)
+
+    return seeds
+
+
+def generate_tck_adaptive(
+    roi_begin,
+    wmfod,
+    fivett,
+    n_streamlines,
+    outfile,
+    increment=500,
+    tolerance=0.05,
+    overwrite=True,
+    **generate_kwargs,
+):
+    """Generates a TCK file in increments until its endpoint distribution is stable
+    Increments alternate between two independent halves of the streamlines. The total variation distance between the
+    endpoint distributions of the halves (over the voxels of roi_begin's grid) measures their sampling noise, and is
+    scaled to estimate the error of the distribution of all streamlines. Generation stops once that estimate falls
+    below the tolerance, or n_streamlines is reached.
+
+    Parameters
+    ==========
+    roi_begin: str
+            Path to seeding ROI (.nii.gz). Also defines the grid for the endpoint distribution.
+    wmfod: str
+            Path to wmfod image (.nii.gz, .nii, .mif)
+    fivett: str
+            Path to 5TT image (.nii.gz, .mif)
+    n_streamlines: int
+            Maximum number of streamlines for final FSuB
+    outfile: str
+            Path to save output file
+    increment: int
+            Number of streamlines to add per increment
+    tolerance: float
+            Estimated total variation distance (0-1) between the endpoint distribution and its limit below which to stop
+    overwrite: bool
+            Whether to allow overwriting outputs
+    generate_kwargs:
+            Other arguments passed to generate_tck_mrtrix (e.g., roi_end, masks, n_shards)
+
+    Outputs
+    =======
+    Function returns the path of the generated tck file
+    The convergence history is added to the .json sidecar written by generate_tck_mrtrix
+    """
 
-    run_command(cmd_tckgen)
+    # The first increment sets up the output, its sidecar and any pilot run
+    n_first = min(increment, n_streamlines)
+    generate_tck_mrtrix(
+        roi_begin=roi_begin,
+        wmfod=wmfod,
+        fivett=fivett,
+        n_streamlines=n_first,
+        outfile=outfile,
+        overwrite=overwrite,
+        **generate_kwargs,
+    )
+    sidecar = op.splitext(outfile)[0] + ".json"
+    generation_info = load_json(sidecar)
+    n_generated = generation_info["Count"]
+    half_counts = [endpoint_density(outfile, roi_begin), 0]
+    half_sizes = [n_generated, 0]
+
+    # Later increments run the same tckgen command into a small file, which is then appended
+    cmd_tckgen = (
+        [find_program("tckgen")] + generation_info["TckgenCommand"] + ["-force"]
+    )
+    increment_outfile = op.splitext(outfile)[0] + "_desc-increment.tck"
+    acceptance_rate = generation_info.get("Budget", {}).get("PilotAcceptanceRate", 0)
+    if acceptance_rate > 0:
+        max_seeds = int(np.ceil(PILOT_SEED_MARGIN * increment / acceptance_rate))
+    else:
+        max_seeds = None
+
+    history = []
+    n_increments = 1
+    capped = n_generated < n_first
+    while n_generated < n_streamlines and capped == False:
+        n_increment = min(increment, n_streamlines - n_generated)
+        generation_info["RandomSeeds"] += run_tckgen(
+            cmd_tckgen,
+            n_increment,
+            increment_outfile,
+            n_shards=generate_kwargs.get("n_shards", 1),
+            nthreads=generate_kwargs.get("nthreads"),
+            seed=max(generation_info["RandomSeeds"] + [-1]) + 1,
+            max_seeds=max_seeds,
+        )
+        n_new = int(read_tck_header(increment_outfile).get("count", 0))
+        half = n_increments % 2
+        half_counts[half] = half_counts[half] + endpoint_density(
+            increment_outfile, roi_begin
+        )
+        half_sizes[half] += n_new
+        append_tck(outfile, [increment_outfile])
+        os.remove(increment_outfile)
+        n_generated += n_new
+        n_increments += 1
+        # tckgen could not reach the target (e.g., capped by a pilot budget)
+        capped = n_new < n_increment
+
+        if half_sizes[1] > 0:
+            distributions = [counts / max(counts.sum(), 1) for counts in half_counts]
+            noise = 0.5 * np.abs(distributions[0] - distributions[1]).sum()
+            # The pooled distribution's error shrinks with the total size relative to the halves'
+            error = noise * np.sqrt(half_sizes[0] * half_sizes[1]) / sum(half_sizes)
+            history += [{"Count": n_generated, "Error": float(error)}]
+            print(
+                f"Estimated endpoint distribution error is {error:.4f} at {n_generated} streamlines"
+            )
+            if error < tolerance:
+                print(f"Converged at {n_generated} streamlines (tolerance {tolerance})")
+                break
+
+    header = read_tck_header(outfile)
+    generation_info["Count"] = int(header.get("count", 0))
+    if "total_count" in header and int(header["total_count"]) > 0:
+        generation_info["AcceptanceRate"] = generation_info["Count"] / int(
+            header["total_count"]
+        )
+    generation_info["Convergence"] = {"Tolerance": tolerance, "History": history}
+    save_json(generation_info, sidecar)
 
     return outfile
+
+
+def extract_connectome(
+    tck_file,
+    atlas,
+    outpath_base,
+    edges=None,
+    node_names=None,
+    search_dist=2.0,
+    search_type="radial",
+    sift2_weights=None,
+    native_assignment=True,
+    include_self=False,
+    max_open_files=64,
+    membership=False,
+    binary_assignments=False,
+    overwrite=True,
+):
+    """Extracts the sub-bundle of every edge of a labelled atlas, with one assignment pass and one pass over the tractogram
+    Like tck2connectome followed by connectome2tck -files per_edge. Streamlines are read in file order and appended to
+    their edge's file. At most max_open_files output files are open at once (the least recently used one is closed
+    when another is needed), and each file's streamline count is filled in once it is complete.
+
+    Parameters
+    ==========
+    tck_file: str
+            Path to the input tractography file (.tck)
+    atlas: str
+            Atlas-like image (.nii.gz, .nii, .mif) with integer labels 1..N (0 is background)
+    outpath_base: str
+            Path to output directory, including output prefix
+    edges: list
+            (node, node) pairs to extract. Default is every pair connected by at least one streamline.
+    node_names: dict
+            Maps node labels to names used in filenames. Default is to use the labels.
+    search_dist: float
+            How far to search ahead of streamlines for ROIs, in mm
+    search_type: string
+            Method of searching for streamlines (forward, reverse, radial, end, or all).
+    sift2_weights: str
+            Path to SIFT2 weights CSV file
+    native_assignment: bool
+            Assign streamlines in-process where possible (see assign_streamlines)
+    include_self: bool
+            Whether to include edges from a node to itself in the default edges
+    max_open_files: int
+            Maximum number of edge files to keep open at once
+    membership: bool
+            Save which streamlines reach each node (see save_membership), so other combinations of nodes can be queried later
+    binary_assignments: bool
+            Save the assignments and connectome as binary .npy files instead of text (see save_assignments)
+    overwrite: bool
+            Whether to allow overwriting outputs
+
+    Outputs
+    =======
+    Function returns a dict mapping each extracted edge to its .tck file
+    outpath_base + _desc-assignments.txt / _desc-connectome.txt are the streamline-to-node assignments and connectome (.npy if binary_assignments)
+    outpath_base + _from-{node}_to-{node}_desc-fsub.tck are the sub-bundles (and _desc-fsubSIFT2weights.csv their weights)
+    outpath_base + _desc-counts_connectome.npy is the (symmetric) streamline count between each pair of nodes
+    outpath_base + _desc-SIFT2weights_connectome.npy is the (symmetric) sum of SIFT2 weights between each pair of nodes
+    outpath_base + _desc-membership.npz holds a bitset of the streamlines reaching each node (if membership is True)
+    """
+    from collections import OrderedDict
+
+    ### One assignment pass over the whole atlas
+    if binary_assignments:
+        assignments_ext = ".npy"
+    else:
+        assignments_ext = ".txt"
+    connectome_out = outpath_base + "_desc-connectome" + assignments_ext
+    assignments_out = assign_streamlines(
+        tck_file,
+        atlas,
+        outpath_base + "_desc-assignments" + assignments_ext,
+        connectome_out,
+        search_dist=search_dist,
+        search_type=search_type,
+        sift2_weights=sift2_weights,
+        native=native_assignment,
+        overwrite=overwrite,
+    )
+    if membership:
+        save_membership(
+            tck_file,
+            assignments_out,
+            outpath_base + "_desc-membership.npz",
+            node_names=node_names,
+            overwrite=overwrite,
+        )
+    assignments = np.sort(read_assignments(assignments_out), axis=1)
+    if sift2_weights != None:
+        weights = load_sift2_weights(sift2_weights)
+    else:
+        weights = None
+
+    # Counts and weights between every pair of nodes (the connectome has a row per atlas label)
+    n_nodes = len(read_connectome(connectome_out))
+    if len(assignments) > 0:
+        n_nodes = max(n_nodes, int(assignments.max()))
+    if edges != None:
+        n_nodes = max(n_nodes, int(np.max(edges)))
+    assigned = assignments[:, 0] > 0
+    counts = np.zeros((n_nodes + 1, n_nodes + 1), dtype=np.int64)
+    np.add.at(counts, (assignments[assigned, 0], assignments[assigned, 1]), 1)
+    counts = counts + np.triu(counts, 1).T
+    np.save(outpath_base + "_desc-counts_connectome.npy", counts[1:, 1:])
+    if weights is not None:
+        weight_sums = np.zeros((n_nodes + 1, n_nodes + 1))
+        np.add.at(
+            weight_sums,
+            (assignments[assigned, 0], assignments[assigned, 1]),
+            weights[assigned],
+        )
+        weight_sums = weight_sums + np.triu(weight_sums, 1).T
+        np.save(outpath_base + "_desc-SIFT2weights_connectome.npy", weight_sums[1:, 1:])
+
+    ### Pick the streamlines of the requested edges
+    if edges == None:
+        edge_pairs = np.unique(assignments[assigned], axis=0)
+        if not include_self:
+            edge_pairs = edge_pairs[edge_pairs[:, 0] != edge_pairs[:, 1]]
+    else:
+        edge_pairs = np.sort(np.array(edges, dtype=np.int64).reshape(-1, 2), axis=1)
+    edge_keys = assignments[:, 0] * (n_nodes + 1) + assignments[:, 1]
+    requested_keys = edge_pairs[:, 0] * (n_nodes + 1) + edge_pairs[:, 1]
+    selected = np.flatnonzero(np.isin(edge_keys, requested_keys) & assigned)
+
+    if node_names == None:
+        node_names = {}
+    edge_files = {}
+    for node_1, node_2 in edge_pairs:
+        name_1 = node_names.get(int(node_1), int(node_1))
+        name_2 = node_names.get(int(node_2), int(node_2))
+        edge_files[int(node_1) * (n_nodes + 1) + int(node_2)] = (
+            outpath_base + f"_from-{name_1}_to-{name_2}_desc-fsub.tck"
+        )
+    if overwrite == False:
+        for edge_file in edge_files.values():
+            overwrite_check(edge_file)
+
+    ### Stream the selected streamlines into their edge files
+    header = read_tck_header(tck_file)
+    dtype = np.dtype(TCK_DTYPES[header["datatype"]])
+    points, starts, lengths = read_tck_points(tck_file)
+    open_files = OrderedDict()
+    offsets = {}
+    edge_counts = {key: 0 for key in edge_files}
+
+    def edge_handle(key):
+        if key in open_files:
+            open_files.move_to_end(key)
+            return open_files[key]
+        if len(open_files) >= max_open_files:
+            open_files.popitem(last=False)[1].close()
+        if key in offsets:
+            f = open(edge_files[key], "ab")
+        else:
+            f = open(edge_files[key], "wb")
+            offsets[key] = write_tck_header(f, header, 0)
+        open_files[key] = f
+        return f
+
+    try:
+        for chunk in streamline_chunks(lengths[selected]):
+            chunk_streamlines = selected[chunk]
+            chunk_keys = edge_keys[chunk_streamlines]
+            order = np.argsort(chunk_keys, kind="stable")
+            keys, first = np.unique(chunk_keys[order], return_index=True)
+            for key, group in zip(keys, np.split(order, first[1:])):
+                group_streamlines = chunk_streamlines[group]
+                group_lengths = lengths[group_streamlines]
+                group_points = gather_streamlines(
+                    points, starts[group_streamlines], group_lengths
+                )
+                edge_handle(key).write(
+                    delimit_streamlines(group_points, group_lengths, dtype).tobytes()
+                )
+                edge_counts[key] += len(group_streamlines)
+    finally:
+        for f in open_files.values():
+            f.close()
+
+    # Group the selected streamlines by edge once (in streamline order) for the weights
+    if weights is not None:
+        selected_keys, inverse = np.unique(edge_keys[selected], return_inverse=True)
+        edge_streamlines = np.split(
+            selected[np.argsort(inverse, kind="stable")],
+            np.cumsum(np.bincount(inverse, minlength=len(selected_keys)))[:-1],
+        )
+        edge_weights = dict(
+            zip(selected_keys.tolist(), [weights[group] for group in edge_streamlines])
+        )
+
+    # Finish every edge file (including empty ones), and save each edge's weights
+    for key, edge_file in edge_files.items():
+        if key in offsets:
+            with open(edge_file, "r+b") as f:
+                f.seek(0, os.SEEK_END)
+                finish_tck(f, offsets[key], edge_counts[key], dtype)
+        else:
+            write_tck(edge_file, [], header=header, overwrite=True)
+        if weights is not None:
+            save_sift2_weights(
+                edge_weights.get(int(key), weights[:0]),
+                edge_file.replace("_desc-fsub.tck", "_desc-fsubSIFT2weights.csv"),
+                overwrite=overwrite,
+            )
+
+    print(
+        f"\n Extracted {len(selected)} streamlines into {len(edge_files)} edge files \n"
+    )
+
+    return {
+        (int(node_1), int(node_2)): edge_files[
+            int(node_1) * (n_nodes + 1) + int(node_2)
+        ]
+        for node_1, node_2 in edge_pairs
+    }
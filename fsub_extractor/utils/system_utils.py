@@ -1,6 +1,10 @@
 import os.path as op
 import os
 import subprocess
+import hashlib
+import json
+import threading
+import warnings
 
 
 def overwrite_check(file):
@@ -51,12 +55,16 @@ def find_program(program):
     raise Exception(f"Command {program} could not be found in PATH.")
 
 
-def run_command(cmd_list, verbose=True):
+def run_command(cmd_list, verbose=True, env=None):
     """Interface for running CLI commands in Python. Crashes if command returns an error.
     Parameters
     ==========
     cmd_list: list
             List containing arguments for the function, e.g. ['CommandName', '--argName1', 'arg1'...]
+    verbose: bool
+            Whether to print the command before running it
+    env: dict
+            Environment for the command. Default (None) inherits the current environment.
 
     Outputs
     =======
@@ -73,10 +81,362 @@ def run_command(cmd_list, verbose=True):
         print(*cmd_list, sep=" ")
         print("########################################\n")
 
-    return_code = subprocess.run(cmd_list).returncode
+    return_code = subprocess.run(cmd_list, env=env).returncode
     if return_code != 0:
         raise Exception(
             f"Command {function_name} exited with errors. See message above for more information."
         )
 
     return None
+
+
+def run_commands_parallel(cmd_lists, n_jobs=None, envs=None, verbose=True):
+    """Runs several CLI commands concurrently. Crashes if any command returns an error.
+    Parameters
+    ==========
+    cmd_lists: list
+            List of command lists, each formatted as for run_command
+    n_jobs: int
+            Maximum number of commands to run at once. Default (None) runs all at once.
+    envs: list
+            List of environments (dict or None), one per command. Default inherits the current environment.
+    verbose: bool
+            Whether to print the commands before running them
+
+    Outputs
+    =======
+    None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if envs == None:
+        envs = [None] * len(cmd_lists)
+    if n_jobs == None:
+        n_jobs = len(cmd_lists)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        futures = [
+            executor.submit(run_command, cmd_list, verbose, env)
+            for cmd_list, env in zip(cmd_lists, envs)
+        ]
+        # Re-raise the first error, if any
+        for future in futures:
+            future.result()
+
+    return None
+
+
+def file_hash(file, chunk_size=2**20):
+    """Computes the SHA-1 hash of a file's contents, reading it in chunks.
+    Parameters
+    ==========
+    file: str
+            Path to file to hash
+    chunk_size: int
+            Number of bytes to read at a time
+
+    Outputs
+    =======
+    digest: str
+            Hexadecimal SHA-1 digest of the file
+    """
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def string_hash(string):
+    """Computes the SHA-1 hash of a string (e.g., a description of parameters).
+    Parameters
+    ==========
+    string: str
+            String to hash
+
+    Outputs
+    =======
+    digest: str
+            Hexadecimal SHA-1 digest of the string
+    """
+    return hashlib.sha1(string.encode()).hexdigest()
+
+
+def load_json(file):
+    """Loads a JSON file (e.g., a sidecar), returning an empty dict if it does not exist.
+    Parameters
+    ==========
+    file: str
+            Path to JSON file
+
+    Outputs
+    =======
+    data: dict
+            Contents of the JSON file
+    """
+    if op.exists(file) == False:
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+
+def save_json(data, file):
+    """Saves a dict to a JSON file (e.g., a sidecar).
+    Parameters
+    ==========
+    data: dict
+            JSON-serializable data to save
+    file: str
+            Path to JSON file
+
+    Outputs
+    =======
+    file: str
+            Path to JSON file
+    """
+    with open(file, "w") as f:
+        json.dump(data, f, indent=4)
+
+    return file
+
+
+# Files up to this size (bytes) are also hashed, so identical rewrites of them can be told apart from changes
+SIGNATURE_HASH_MAX_SIZE = 2**26
+
+
+def file_signature(file):
+    """Describes a file's state by its size and modification time, plus its contents' hash if it is small.
+    Parameters
+    ==========
+    file: str
+            Path to file
+
+    Outputs
+    =======
+    signature: dict
+            Size (bytes), MTime (ns) and, for files up to SIGNATURE_HASH_MAX_SIZE, SHA1 of the file
+    """
+    stat = os.stat(file)
+    signature = {"Size": stat.st_size, "MTime": stat.st_mtime_ns}
+    if stat.st_size <= SIGNATURE_HASH_MAX_SIZE:
+        signature["SHA1"] = file_hash(file)
+
+    return signature
+
+
+def signature_matches(file, signature):
+    """Checks whether a file is unchanged since its signature was taken.
+    A file with the same size and modification time is unchanged. Only if the size is the same but the modification
+    time differs is the hash compared (when the signature has one), so rewriting a small file with identical contents
+    (e.g., rerunning a deterministic step) does not make it look changed.
+
+    Parameters
+    ==========
+    file: str
+            Path to file
+    signature: dict
+            Signature from file_signature
+
+    Outputs
+    =======
+    matches: bool
+            Whether the file exists and is unchanged
+    """
+    if op.isfile(file) == False:
+        return False
+    stat = os.stat(file)
+    if stat.st_size != signature["Size"]:
+        return False
+
+    if stat.st_mtime_ns == signature["MTime"]:
+        return True
+
+    return "SHA1" in signature and file_hash(file) == signature["SHA1"]
+
+
+def step_files(value):
+    """Collects the paths of existing files in a (nested) step argument or return value.
+    Parameters
+    ==========
+    value:
+            A string, or list, tuple or dict (values) of them
+
+    Outputs
+    =======
+    files: list
+            Paths in value that are existing files
+    """
+    if isinstance(value, str):
+        return [value] if op.isfile(value) else []
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [file for item in value for file in step_files(item)]
+
+    return []
+
+
+def encode_step_value(value, hash_arrays=False):
+    """Converts a step argument or return value into JSON-serializable data that decode_step_value can rebuild.
+    Tuples and dicts (which may have non-string keys) are wrapped so they round-trip, and numpy scalars become Python
+    numbers. Numpy arrays cannot be rebuilt, so they are only accepted with hash_arrays, as a hash of their bytes.
+
+    Parameters
+    ==========
+    value:
+            None, a bool, number or string, a numpy scalar or array, or a list, tuple or dict of them
+    hash_arrays: bool
+            Whether to encode numpy arrays by their dtype, shape and contents' hash, and other objects by their repr
+            (e.g., to hash step parameters)
+
+    Outputs
+    =======
+    data:
+            JSON-serializable data
+    """
+    import numpy as np
+
+    if isinstance(value, np.ndarray):
+        if hash_arrays == False:
+            raise Exception("Cannot record a numpy array in a manifest.")
+        return {
+            "Array": [
+                str(value.dtype),
+                list(value.shape),
+                hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest(),
+            ]
+        }
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value == None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode_step_value(item, hash_arrays) for item in value]
+    if isinstance(value, tuple):
+        return {"Tuple": [encode_step_value(item, hash_arrays) for item in value]}
+    if isinstance(value, dict):
+        return {
+            "Dict": [
+                [
+                    encode_step_value(key, hash_arrays),
+                    encode_step_value(item, hash_arrays),
+                ]
+                for key, item in value.items()
+            ]
+        }
+
+    if hash_arrays:
+        return {"Repr": repr(value)}
+
+    raise Exception(
+        f"Cannot record a value of type {type(value).__name__} in a manifest."
+    )
+
+
+def decode_step_value(data):
+    """Rebuilds a value encoded by encode_step_value.
+    Parameters
+    ==========
+    data:
+            Data from encode_step_value (e.g., loaded from a manifest)
+
+    Outputs
+    =======
+    value:
+            The encoded value
+    """
+    if isinstance(data, list):
+        return [decode_step_value(item) for item in data]
+    if isinstance(data, dict) and "Tuple" in data:
+        return tuple(decode_step_value(item) for item in data["Tuple"])
+    if isinstance(data, dict) and "Dict" in data:
+        return {
+            decode_step_value(key): decode_step_value(item)
+            for key, item in data["Dict"]
+        }
+
+    return data
+
+
+# Steps may run in concurrent threads, and each rewrites the whole manifest
+manifest_lock = threading.Lock()
+
+
+def run_step(manifest, step, function, *args, outputs=None, **kwargs):
+    """Runs a workflow step, unless a manifest shows its outputs are up to date (like make)
+    The manifest records, for each step, the parameters it was run with, the signatures of the files it read (any
+    argument that is an existing file) and wrote (any file it returned, plus any existing file in outputs), and its
+    return value (see encode_step_value). A step is skipped, returning the recorded value, if its parameters are the
+    same and none of these files changed or was deleted. Parameters are hashed by value (numpy arrays by their
+    contents); files passed as parameters are hashed by path, as their contents are covered by their signatures.
+
+    Parameters
+    ==========
+    manifest: str
+            Path to manifest (.json). If None, the step always runs.
+    step: str
+            Name of the step in the manifest
+    function: callable
+            Function to run
+    args, kwargs:
+            Arguments for function
+    outputs: list
+            Paths of outputs that function may write but does not return (e.g., figures, caches or side outputs).
+            Paths that do not exist after the step are ignored.
+
+    Outputs
+    =======
+    Function returns the return value of function (or the one recorded in the manifest)
+    """
+    if manifest == None:
+        return function(*args, **kwargs)
+    if outputs == None:
+        outputs = []
+
+    params = [function.__name__, list(args), sorted(kwargs.items())]
+    params_hash = string_hash(
+        json.dumps(encode_step_value(params, hash_arrays=True), sort_keys=True)
+    )
+    record = load_json(manifest).get(step, {})
+    if record.get("ParamsHash") == params_hash:
+        recorded_outputs = record["Outputs"]
+        inputs = [
+            file for file in step_files([args, kwargs]) if file not in recorded_outputs
+        ]
+        if sorted(set(inputs)) == sorted(record["Inputs"]) and all(
+            signature_matches(file, signature)
+            for file, signature in list(record["Inputs"].items())
+            + list(recorded_outputs.items())
+        ):
+            print(f"\n Skipping up-to-date step: {step} \n")
+            return decode_step_value(record["ReturnValue"])
+
+    input_signatures = {
+        file: file_signature(file) for file in step_files([args, kwargs])
+    }
+    return_value = function(*args, **kwargs)
+    output_files = set(step_files([return_value, outputs]))
+    try:
+        return_data = encode_step_value(return_value)
+    except Exception as error:
+        warnings.warn(f"Step {step} will not be skipped when resuming: {error}")
+        return return_value
+
+    # Reload, as other steps may have been recorded while this one ran
+    with manifest_lock:
+        manifest_data = load_json(manifest)
+        manifest_data[step] = {
+            "Function": function.__name__,
+            "ParamsHash": params_hash,
+            "Inputs": {
+                file: signature
+                for file, signature in input_signatures.items()
+                if file not in output_files
+            },
+            "Outputs": {file: file_signature(file) for file in sorted(output_files)},
+            "ReturnValue": return_data,
+        }
+        save_json(manifest_data, manifest)
+
+    return return_value
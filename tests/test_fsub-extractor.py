@@ -0,0 +1,1535 @@
+import glob
+import os.path as op
+import shutil
+import numpy as np
+import pytest
+from fsub_extractor.cli_starters.extractor_start import get_parser
+
+
+def test_extractor_parser_sweep_lists(tmp_path):
+    tract = op.join(tmp_path, "tract.tck")
+    roi = op.join(tmp_path, "roi.nii.gz")
+    open(tract, "w").close()
+    open(roi, "w").close()
+
+    base_args = ["--subject", "sub-01", "--tract", tract, "--roi1", roi]
+    args = get_parser().parse_args(base_args)
+    assert args.search_dist == 2.0
+    assert args.search_type == "radial"
+    assert args.roi_resampling == "mrtrix"
+    assert args.projection_backend == "freesurfer"
+    assert args.cull_streamlines == False
+
+    args = get_parser().parse_args(
+        base_args
+        + ["--search-dist", "3", "1.5", "--search-type", "end", "radial"]
+        + ["--gmwmi-thresh", "0.1", "0.5"]
+    )
+    assert args.search_dist == [3.0, 1.5]
+    assert args.search_type == ["end", "radial"]
+    assert args.gmwmi_thresh == [0.1, 0.5]
+
+
+def make_tractogram(out_dir, n_streamlines=2000, seed=0):
+    """Writes a random tractogram, a two-ROI atlas and SIFT2 weights into out_dir"""
+    import nibabel as nib
+    from nibabel.streamlines import Tractogram, TckFile
+
+    rng = np.random.default_rng(seed)
+    affine = np.diag([1.5, 1.5, 1.5, 1])
+    affine[:3, 3] = -30
+    rois = np.zeros((40, 40, 40), dtype=np.float32)
+    rois[5:10, 10:15, 20:24] = 1
+    rois[28:33, 25:30, 8:12] = 2
+    rois_file = op.join(out_dir, "rois.nii.gz")
+    nib.save(nib.Nifti1Image(rois, affine), rois_file)
+
+    # Streamlines run between random points, with more of them ending in the ROIs
+    centres = [
+        nib.affines.apply_affine(affine, np.argwhere(rois == label)) for label in [1, 2]
+    ]
+    streamlines = []
+    for i in range(n_streamlines):
+        ends = rng.random((2, 3)) * 60 - 30
+        for end in range(2):
+            if rng.random() < 0.3:
+                roi = centres[rng.integers(2)]
+                ends[end] = roi[rng.integers(len(roi))] + rng.normal(0, 1, 3)
+        steps = np.linspace(0, 1, rng.integers(2, 12))[:, None]
+        streamlines.append((ends[0] + steps * (ends[1] - ends[0])).astype(np.float32))
+    tck_file = op.join(out_dir, "tract.tck")
+    TckFile(Tractogram(streamlines, affine_to_rasmm=np.eye(4))).save(tck_file)
+
+    weights_file = op.join(out_dir, "weights.csv")
+    np.savetxt(weights_file, rng.random(n_streamlines)[None])
+
+    return tck_file, rois_file, weights_file, streamlines
+
+
+def load_streamlines(tck_file):
+    import nibabel as nib
+
+    return list(nib.streamlines.load(tck_file).streamlines)
+
+
+def same_streamlines(streamlines_1, streamlines_2):
+    return len(streamlines_1) == len(streamlines_2) and all(
+        np.array_equal(s1, s2) for s1, s2 in zip(streamlines_1, streamlines_2)
+    )
+
+
+FAKE_TCKGEN = r"""#!{python}
+import json, os, sys
+import numpy as np
+
+# Accepts a quarter of its seeds, and writes streamlines that record the seed and their number
+args = sys.argv[1:]
+select = int(args[args.index("-select") + 1])
+outfile = args[args.index("-select") + 2]
+max_seeds = int(args[args.index("-seeds") + 1])
+seed = int(os.environ["MRTRIX_RNG_SEED"])
+rng = np.random.default_rng(seed)
+count = attempts = 0
+streamlines = []
+while count < select and (max_seeds == 0 or attempts < max_seeds):
+    attempts += 1
+    if rng.random() < 0.25:
+        # Starts at the seed (held exactly by float32 in two parts), ends in one of 4x4x4 voxels
+        streamlines.append([[seed // 4096, seed % 4096, count], list(rng.integers(0, 4, 3))])
+        count += 1
+data = [point for streamline in streamlines for point in streamline + [[np.nan] * 3]]
+data = np.array(data + [[np.inf] * 3], dtype="<f4")
+header = "mrtrix tracks\ndatatype: Float32LE\ncount: %010d\ntotal_count: %010d\n" % (count, attempts)
+header += "file: . %d\nEND\n"
+offset = len(header % 0) + 4
+with open(outfile, "wb") as f:
+    f.write((header % offset).encode().ljust(offset, b" "))
+    f.write(data.tobytes())
+with open(os.environ["FAKE_TCKGEN_LOG"], "a") as f:
+    f.write(json.dumps({{"seed": seed, "args": args, "count": count, "attempts": attempts}}) + "\n")
+"""
+
+
+@pytest.fixture
+def fake_tckgen(tmp_path, monkeypatch):
+    """Puts a stand-in for tckgen on the PATH, and returns the inputs for generate_tck_mrtrix and a log reader"""
+    import json
+    import os
+    import sys
+
+    bin_dir = op.join(tmp_path, "bin")
+    os.mkdir(bin_dir)
+    tckgen = op.join(bin_dir, "tckgen")
+    with open(tckgen, "w") as f:
+        f.write(FAKE_TCKGEN.format(python=sys.executable))
+    os.chmod(tckgen, 0o755)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    log_file = op.join(tmp_path, "tckgen_log.jsonl")
+    monkeypatch.setenv("FAKE_TCKGEN_LOG", log_file)
+
+    inputs = {}
+    for name in ["wmfod", "roi_begin", "fivett"]:
+        inputs[name] = op.join(tmp_path, f"{name}.nii.gz")
+        with open(inputs[name], "w") as f:
+            f.write(name)
+
+    def read_log():
+        if op.exists(log_file) == False:
+            return []
+        with open(log_file) as f:
+            return [json.loads(line) for line in f]
+
+    return inputs, read_log
+
+
+def generated_seeds(tck_file):
+    """Returns the seed recorded in each streamline written by the fake tckgen"""
+    return [
+        int(streamline[0, 0]) * 4096 + int(streamline[0, 1])
+        for streamline in load_streamlines(tck_file)
+    ]
+
+
+@pytest.mark.parametrize("two_rois", [True, False])
+def test_culling_keeps_outputs(tmp_path, capsys, two_rois):
+    from fsub_extractor.utils.streamline_utils import (
+        extract_tck_mrtrix,
+        read_assignments,
+        read_connectome,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    if two_rois == False:
+        import nibabel as nib
+
+        rois_img = nib.load(rois_file)
+        rois = np.where(rois_img.get_fdata() == 1, 1, 0).astype(np.float32)
+        rois_file = op.join(tmp_path, "roi1.nii.gz")
+        nib.save(nib.Nifti1Image(rois, rois_img.affine), rois_file)
+
+    outputs = {}
+    for cull in [True, False]:
+        outpath_base = op.join(tmp_path, f"cull-{cull}")
+        fsub = extract_tck_mrtrix(
+            tck_file,
+            rois_file,
+            outpath_base,
+            two_rois,
+            sift2_weights=weights_file,
+            native=True,
+            native_assignment=True,
+            cull=cull,
+            binary_assignments=True,
+            membership=True,
+        )
+        outputs[cull] = (
+            load_streamlines(fsub),
+            read_assignments(outpath_base + "_desc-assignments.npy"),
+            read_connectome(outpath_base + "_desc-connectome.npy"),
+            np.load(outpath_base + "_desc-membership.npz")["bitsets"],
+        )
+
+    # Culling should have dropped something, changed nothing, and cleaned up after itself
+    assert "Kept" in capsys.readouterr().out
+    assert glob.glob(op.join(tmp_path, "*candidates*")) == []
+    assert len(outputs[True][0]) > 0
+    assert same_streamlines(outputs[True][0], outputs[False][0])
+    for culled, unculled in zip(outputs[True][1:], outputs[False][1:]):
+        assert np.array_equal(culled, unculled)
+
+
+def test_endpoint_index(tmp_path, capsys):
+    from nibabel.streamlines import Tractogram, TckFile
+    from fsub_extractor.utils.streamline_utils import (
+        build_endpoint_index,
+        extract_tck_mrtrix,
+        load_endpoint_index,
+        query_endpoint_index,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(
+        tmp_path, n_streamlines=500
+    )
+    index_file = op.join(tmp_path, "tract_endpoints.npz")
+    index = build_endpoint_index(tck_file, index_file, cell_size=3.0)
+    endpoints = np.array([[s[0], s[-1]] for s in streamlines])
+    assert np.array_equal(index["endpoints"], endpoints)
+
+    # Box queries through the cell hash match a brute-force search, including boxes off the grid
+    rng = np.random.default_rng(0)
+    boxes = [np.sort(rng.uniform(-35, 35, (2, 3)), axis=0) for _ in range(20)]
+    boxes += [np.array([[-100, -100, -100], [-90, -90, -90]])]
+    for lower, upper in boxes:
+        expected = np.all((endpoints >= lower) & (endpoints <= upper), axis=2)
+        assert np.array_equal(query_endpoint_index(index, lower, upper), expected)
+
+    # The saved index is reused while the tractogram is unchanged, and rebuilt once it changes
+    modified_time = op.getmtime(index_file)
+    index = load_endpoint_index(tck_file, index_file)
+    assert op.getmtime(index_file) == modified_time
+    assert np.array_equal(index["endpoints"], endpoints)
+    TckFile(Tractogram(streamlines[::-1], affine_to_rasmm=np.eye(4))).save(tck_file)
+    index = load_endpoint_index(tck_file, index_file)
+    assert "out of date" in capsys.readouterr().out
+    assert np.array_equal(index["endpoints"], endpoints[::-1])
+
+    # Culling with the index extracts the same sub-bundle as without it
+    bundles = []
+    for endpoint_index in [None, index_file]:
+        bundles += [
+            load_streamlines(
+                extract_tck_mrtrix(
+                    tck_file,
+                    rois_file,
+                    op.join(tmp_path, f"index-{endpoint_index != None}"),
+                    True,
+                    native=True,
+                    native_assignment=True,
+                    cull=True,
+                    endpoint_index=endpoint_index,
+                )
+            )
+        ]
+    assert len(bundles[0]) > 0
+    assert same_streamlines(bundles[0], bundles[1])
+
+
+def test_sweep_membership(tmp_path):
+    from fsub_extractor.utils.streamline_utils import (
+        extract_tck_mrtrix,
+        extract_tck_sweep,
+        load_membership,
+        query_membership,
+        read_assignments,
+        search_setting_label,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    settings = [("radial", 2.0), ("radial", 3.5), ("end", 2.0)]
+    node_names = {1: "roiA", 2: "roiB"}
+    sweep_base = op.join(tmp_path, "sweep")
+    fsub_files = extract_tck_sweep(
+        tck_file,
+        rois_file,
+        sweep_base,
+        True,
+        settings,
+        membership=True,
+        node_names=node_names,
+    )
+    for setting in settings:
+        single_base = op.join(tmp_path, f"single-{search_setting_label(*setting)}")
+        fsub = extract_tck_mrtrix(
+            tck_file,
+            rois_file,
+            single_base,
+            True,
+            search_type=setting[0],
+            search_dist=setting[1],
+            native=True,
+            native_assignment=True,
+            membership=True,
+            node_names=node_names,
+        )
+        assert same_streamlines(
+            load_streamlines(fsub_files[setting]), load_streamlines(fsub)
+        )
+
+        sweep_membership = load_membership(
+            f"{sweep_base}_desc-{search_setting_label(*setting)}_desc-membership.npz"
+        )
+        single_membership = load_membership(single_base + "_desc-membership.npz")
+        assignments = read_assignments(single_base + "_desc-assignments.txt")
+        for expression, expected in [
+            ("roiA", np.any(assignments == 1, axis=1)),
+            (
+                "roiA & roiB",
+                np.any(assignments == 1, axis=1) & np.any(assignments == 2, axis=1),
+            ),
+            ("~roiB", ~np.any(assignments == 2, axis=1)),
+        ]:
+            assert np.array_equal(
+                query_membership(sweep_membership, expression), np.flatnonzero(expected)
+            )
+            assert np.array_equal(
+                query_membership(single_membership, expression),
+                np.flatnonzero(expected),
+            )
+
+
+def test_append_tck(tmp_path):
+    from nibabel.streamlines import Tractogram, TckFile
+    from fsub_extractor.utils.streamline_utils import append_tck, read_tck_header
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(
+        tmp_path, n_streamlines=30
+    )
+    part_files = []
+    for i, part in enumerate([streamlines[:10], streamlines[10:25], streamlines[25:]]):
+        part_files += [op.join(tmp_path, f"part-{i}.tck")]
+        TckFile(Tractogram(part, affine_to_rasmm=np.eye(4))).save(part_files[-1])
+
+    # Counts are updated in place when the header has room for them
+    size_before = op.getsize(part_files[0])
+    append_tck(part_files[0], part_files[1:])
+    assert same_streamlines(load_streamlines(part_files[0]), streamlines)
+    assert int(read_tck_header(part_files[0])["count"]) == 30
+    assert op.getsize(part_files[0]) > size_before
+
+    # Otherwise the file is rewritten
+    short_file = op.join(tmp_path, "short.tck")
+    with open(part_files[1], "rb") as f:
+        data = f.read()
+    text = b"mrtrix tracks\ncount: 15\ndatatype: Float32LE\nfile: . 64\nEND\n"
+    with open(short_file, "wb") as f:
+        f.write(text.ljust(64, b"\0"))
+        f.write(data[int(read_tck_header(part_files[1])["offset"]) :])
+    append_tck(short_file, [part_files[2]])
+    assert same_streamlines(load_streamlines(short_file), streamlines[10:])
+
+
+def test_read_assignments(tmp_path):
+    from fsub_extractor.utils.streamline_utils import (
+        read_assignments,
+        save_assignments,
+    )
+
+    pairs_file = op.join(tmp_path, "pairs.txt")
+    with open(pairs_file, "w") as f:
+        f.write("# tck2connectome comment\n0 1\n2 1\n\n0 0\n")
+    assignments = read_assignments(pairs_file)
+    assert np.array_equal(assignments, [[0, 1], [2, 1], [0, 0]])
+    save_assignments(assignments, op.join(tmp_path, "pairs.npy"))
+    assert np.array_equal(read_assignments(op.join(tmp_path, "pairs.npy")), assignments)
+
+    # -assignment_all_voxels lists any number of nodes per streamline
+    all_voxels_file = op.join(tmp_path, "all_voxels.txt")
+    with open(all_voxels_file, "w") as f:
+        f.write("1 2 3\n1\n")
+    with pytest.raises(Exception, match="exactly two nodes"):
+        read_assignments(all_voxels_file)
+
+
+def test_run_step(tmp_path, monkeypatch):
+    import os
+    from fsub_extractor.utils import system_utils
+
+    manifest = op.join(tmp_path, "manifest.json")
+    in_file = op.join(tmp_path, "in.txt")
+    out_file = op.join(tmp_path, "out.txt")
+    side_file = op.join(tmp_path, "side.txt")
+    with open(in_file, "w") as f:
+        f.write("a")
+    calls = []
+
+    def step(in_file, out_file, suffix="!"):
+        calls.append(suffix)
+        with open(in_file) as f:
+            text = f.read()
+        for file in [out_file, side_file]:
+            with open(file, "w") as f:
+                f.write(text + suffix)
+        return out_file, np.float64(len(text))
+
+    def run(suffix="!"):
+        return system_utils.run_step(
+            manifest,
+            "step",
+            step,
+            in_file,
+            out_file,
+            suffix=suffix,
+            outputs=[side_file],
+        )
+
+    assert run() == (out_file, 1.0)
+    assert run() == (out_file, 1.0) and len(calls) == 1
+    # Changed parameters
+    run("?")
+    assert len(calls) == 2
+    # Deleted side output
+    os.remove(side_file)
+    run("?")
+    assert len(calls) == 3
+    # Touched, but unchanged, input
+    os.utime(in_file, ns=(0, 0))
+    run("?")
+    assert len(calls) == 3
+    # Changed input
+    with open(in_file, "w") as f:
+        f.write("b")
+    run("?")
+    assert len(calls) == 4
+
+    # Large files are not hashed, so touching them counts as a change
+    monkeypatch.setattr(system_utils, "SIGNATURE_HASH_MAX_SIZE", 0)
+    run("!")
+    assert len(calls) == 5
+    assert "SHA1" not in system_utils.load_json(manifest)["step"]["Inputs"][in_file]
+    os.utime(in_file, ns=(0, 0))
+    run("!")
+    assert len(calls) == 6
+    monkeypatch.undo()
+
+    # Return values are recorded as plain JSON, and rebuilt with their types
+    def sweep_step(values):
+        calls.append(values)
+        return {("radial", np.float64(2.0)): out_file, ("end", 0.5): [out_file, None]}
+
+    def run_sweep(values):
+        return system_utils.run_step(manifest, "sweep", sweep_step, values)
+
+    values = np.zeros(10000)
+    expected = {("radial", 2.0): out_file, ("end", 0.5): [out_file, None]}
+    assert run_sweep(values) == expected
+    assert run_sweep(values.copy()) == expected and len(calls) == 7
+    assert "Dict" in system_utils.load_json(manifest)["sweep"]["ReturnValue"]
+    # Arrays that print the same ("...") but differ still change the parameters
+    values[5000] = 1
+    run_sweep(values)
+    assert len(calls) == 8
+
+
+def test_assign_streamlines_native(tmp_path):
+    import nibabel as nib
+    from nibabel.streamlines import Tractogram, TckFile
+    from fsub_extractor.utils.streamline_utils import (
+        assign_streamlines_native,
+        read_assignments,
+        read_connectome,
+    )
+
+    # 1 mm voxels with voxel centres at integer coordinates
+    rois = np.zeros((20, 20, 20), dtype=np.float32)
+    rois[5, 5, 5] = 1
+    rois[12, 12, 12] = 2
+    rois_file = op.join(tmp_path, "rois.nii.gz")
+    nib.save(nib.Nifti1Image(rois, np.eye(4)), rois_file)
+
+    endpoints = [
+        # Inside ROI 1 and inside ROI 2
+        ([5.2, 5.1, 4.9], [12.3, 12, 12]),
+        # 1.5 mm from ROI 1, and 2.5 mm from ROI 2
+        ([6.5, 5, 5], [12, 14.5, 12]),
+        # Nearer ROI 2 than ROI 1, both in range of a 10 mm search
+        ([10, 10, 10], [1, 1, 1]),
+        # Far from both
+        ([17, 2, 17], [2, 17, 2]),
+        # Inside ROI 1 but 0.78 mm from its centre, and at the centre of ROI 2
+        ([5.45, 5.45, 5.45], [12, 12, 12]),
+    ]
+    streamlines = [
+        np.linspace(start, end, 5).astype(np.float32) for start, end in endpoints
+    ]
+    tck_file = op.join(tmp_path, "tract.tck")
+    TckFile(Tractogram(streamlines, affine_to_rasmm=np.eye(4))).save(tck_file)
+    weights_file = op.join(tmp_path, "weights.csv")
+    np.savetxt(weights_file, np.array([[0.5, 1, 2, 4, 8]]))
+
+    expected = {
+        ("radial", 2.0): [[1, 2], [1, 0], [0, 0], [0, 0], [1, 2]],
+        ("radial", 10.0): [[1, 2], [1, 2], [2, 1], [0, 0], [1, 2]],
+        # As in tck2connectome, the containing voxel is out of range if its centre is
+        ("radial", 0.5): [[1, 2], [0, 0], [0, 0], [0, 0], [0, 2]],
+        ("end", 2.0): [[1, 2], [0, 0], [0, 0], [0, 0], [1, 2]],
+    }
+    for (search_type, search_dist), expected_assignments in expected.items():
+        assignments_out = op.join(
+            tmp_path, f"{search_type}{search_dist}_assignments.txt"
+        )
+        connectome_out = op.join(tmp_path, f"{search_type}{search_dist}_connectome.txt")
+        assignments = assign_streamlines_native(
+            tck_file,
+            rois_file,
+            assignments_out,
+            connectome_out,
+            search_dist=search_dist,
+            search_type=search_type,
+            sift2_weights=weights_file,
+        )
+        assert np.array_equal(assignments, expected_assignments)
+        assert np.array_equal(read_assignments(assignments_out), expected_assignments)
+
+        # Only streamlines assigned at both ends count, in the upper triangle
+        expected_connectome = np.zeros((2, 2))
+        for weight, (node_1, node_2) in zip([0.5, 1, 2, 4, 8], expected_assignments):
+            if node_1 > 0 and node_2 > 0:
+                node_1, node_2 = sorted([node_1, node_2])
+                expected_connectome[node_1 - 1, node_2 - 1] += weight
+        assert np.allclose(read_connectome(connectome_out), expected_connectome)
+
+
+@pytest.mark.skipif(
+    shutil.which("tck2connectome") == None, reason="MRtrix3 is not installed"
+)
+@pytest.mark.parametrize("search_type", ["radial", "end"])
+def test_validate_native_assignment(tmp_path, search_type):
+    from fsub_extractor.utils.streamline_utils import validate_native_assignment
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    agreement = validate_native_assignment(
+        tck_file,
+        rois_file,
+        op.join(tmp_path, "validate"),
+        search_dist=2.0,
+        search_type=search_type,
+    )
+    assert agreement == 1.0
+
+
+def test_tck_round_trip(tmp_path):
+    from fsub_extractor.utils.streamline_utils import (
+        concatenate_tck,
+        read_tck_header,
+        read_tck_points,
+        transform_tck,
+        write_tck,
+        write_tck_subset,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(
+        tmp_path, n_streamlines=200
+    )
+    lengths = np.array([len(streamline) for streamline in streamlines])
+
+    # Read as nibabel does
+    points, starts, read_lengths = read_tck_points(tck_file, chunk_size=1000)
+    assert np.array_equal(read_lengths, lengths)
+    assert same_streamlines(
+        [points[start : start + length] for start, length in zip(starts, lengths)],
+        streamlines,
+    )
+
+    # Write in several chunks
+    written_file = op.join(tmp_path, "written.tck")
+    count = write_tck(
+        written_file,
+        [
+            (
+                np.concatenate(streamlines[first : first + 64]),
+                lengths[first : first + 64],
+            )
+            for first in range(0, len(streamlines), 64)
+        ],
+        header=read_tck_header(tck_file),
+    )
+    assert count == len(streamlines)
+    assert int(read_tck_header(written_file)["count"]) == len(streamlines)
+    assert same_streamlines(load_streamlines(written_file), streamlines)
+
+    # Subsets keep the given order, and concatenation keeps file order
+    indices = np.random.default_rng(1).permutation(len(streamlines))[:50]
+    subset_file = write_tck_subset(tck_file, op.join(tmp_path, "subset.tck"), indices)
+    assert same_streamlines(
+        load_streamlines(subset_file), [streamlines[i] for i in indices]
+    )
+    concatenated_file = concatenate_tck(
+        [tck_file, subset_file], op.join(tmp_path, "concatenated.tck")
+    )
+    assert same_streamlines(
+        load_streamlines(concatenated_file),
+        streamlines + [streamlines[i] for i in indices],
+    )
+
+    xfm = np.array(
+        [[0, -1, 0, 10], [1, 0, 0, -5], [0, 0, 2, 1], [0, 0, 0, 1]], dtype=np.float64
+    )
+    transformed_file = transform_tck(
+        tck_file, op.join(tmp_path, "transformed.tck"), xfm, chunk_size=100
+    )
+    for transformed, streamline in zip(load_streamlines(transformed_file), streamlines):
+        assert np.allclose(
+            transformed, streamline @ xfm[:3, :3].T + xfm[:3, 3], atol=1e-4
+        )
+
+
+@pytest.mark.parametrize("virtual", [False, True])
+def test_sharded_extraction(tmp_path, virtual):
+    import nibabel as nib
+    from fsub_extractor.utils.streamline_utils import (
+        extract_tck_mrtrix,
+        load_virtual_streamlines,
+        load_sift2_weights,
+        read_assignments,
+        read_connectome,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    # Exclude streamlines passing through a slab, to test masking too
+    exclude = np.zeros((40, 40, 40), dtype=np.float32)
+    exclude[:, :, 18:20] = 1
+    exclude_file = op.join(tmp_path, "exclude.nii.gz")
+    nib.save(nib.Nifti1Image(exclude, nib.load(rois_file).affine), exclude_file)
+
+    outputs = {}
+    for n_shards in [1, 3]:
+        outpath_base = op.join(tmp_path, f"shards-{n_shards}")
+        fsub = extract_tck_mrtrix(
+            tck_file,
+            rois_file,
+            outpath_base,
+            True,
+            sift2_weights=weights_file,
+            exclude_mask=exclude_file,
+            native=True,
+            native_assignment=True,
+            virtual=virtual,
+            binary_assignments=True,
+            n_shards=n_shards,
+        )
+        if virtual:
+            fsub_streamlines = list(load_virtual_streamlines(fsub))
+        else:
+            fsub_streamlines = load_streamlines(fsub)
+        outputs[n_shards] = (
+            fsub_streamlines,
+            read_assignments(outpath_base + "_desc-assignments.npy"),
+            read_connectome(outpath_base + "_desc-connectome.npy"),
+            load_sift2_weights(
+                outpath_base + "desc-fsubSIFT2weights_desc-masked.csv", cache=False
+            ),
+        )
+
+    assert len(outputs[1][0]) > 0
+    assert same_streamlines(outputs[3][0], outputs[1][0])
+    for sharded, unsharded in zip(outputs[3][1:], outputs[1][1:]):
+        assert np.allclose(sharded, unsharded)
+
+
+def test_virtual_tck(tmp_path):
+    from nibabel.streamlines import Tractogram, TckFile
+    from fsub_extractor.utils.streamline_utils import (
+        load_virtual_streamlines,
+        materialize_virtual_tck,
+        save_virtual_tck,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(
+        tmp_path, n_streamlines=300
+    )
+    # Sparse selections are stored as indices, dense ones as a bitset
+    for n, indices in enumerate([np.array([3, 50, 299]), np.arange(0, 300, 2)]):
+        virtual_file = save_virtual_tck(
+            tck_file, indices, op.join(tmp_path, f"fsub-{n}_selection.npz")
+        )
+        expected = [streamlines[i] for i in indices]
+        assert same_streamlines(list(load_virtual_streamlines(virtual_file)), expected)
+        materialized_file = materialize_virtual_tck(virtual_file)
+        assert materialized_file == op.join(tmp_path, f"fsub-{n}.tck")
+        assert same_streamlines(load_streamlines(materialized_file), expected)
+
+    # Selections of a changed parent are refused
+    TckFile(Tractogram(streamlines[::-1], affine_to_rasmm=np.eye(4))).save(tck_file)
+    with pytest.raises(Exception, match="has changed"):
+        load_virtual_streamlines(virtual_file)
+
+
+def test_fs_space_extraction(tmp_path):
+    import nibabel as nib
+    from fsub_extractor.utils.froi_utils import dwi_to_fs_xfm
+    from fsub_extractor.utils.streamline_utils import (
+        extract_tck_mrtrix,
+        load_virtual_streamlines,
+        read_tck_header,
+        rebase_virtual_tck,
+        save_virtual_tck,
+        transform_tck,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(
+        tmp_path, n_streamlines=500
+    )
+    # A 90 degree rotation about z and a shift, as a 3x4 mrtrix transform (DWI to FS)
+    xfm = np.array(
+        [[0, -1, 0, 2], [1, 0, 0, -4], [0, 0, 1, 1], [0, 0, 0, 1]], dtype=np.float64
+    )
+    xfm_file = op.join(tmp_path, "dwi2fs.txt")
+    np.savetxt(xfm_file, xfm[:3], header="DWI to FS")
+    assert np.allclose(dwi_to_fs_xfm(xfm_file), xfm)
+    assert np.allclose(dwi_to_fs_xfm(xfm_file, invert=True), np.linalg.inv(xfm))
+
+    # Points are transformed chunk by chunk, across streamline boundaries
+    tck_file_fs = transform_tck(
+        tck_file, op.join(tmp_path, "tract_space-FS.tck"), xfm, chunk_size=1000
+    )
+    streamlines_fs = load_streamlines(tck_file_fs)
+    assert len(streamlines_fs) == len(streamlines)
+    for streamline, streamline_fs in zip(streamlines, streamlines_fs):
+        assert np.allclose(streamline @ xfm[:3, :3].T + xfm[:3, 3], streamline_fs)
+    assert read_tck_header(tck_file_fs)["count"] == read_tck_header(tck_file)["count"]
+
+    # Assigning FS-space streamlines to FS-space ROIs cuts the same DWI-space sub-bundle
+    rois_img = nib.load(rois_file)
+    rois_file_fs = op.join(tmp_path, "rois_space-FS.nii.gz")
+    nib.save(nib.Nifti1Image(rois_img.get_fdata(), xfm @ rois_img.affine), rois_file_fs)
+    bundles = {}
+    for space, rois, connectome_tck in [
+        ("DWI", rois_file, None),
+        ("FS", rois_file_fs, tck_file_fs),
+    ]:
+        bundles[space] = load_streamlines(
+            extract_tck_mrtrix(
+                tck_file,
+                rois,
+                op.join(tmp_path, f"space-{space}"),
+                True,
+                native=True,
+                native_assignment=True,
+                connectome_tck=connectome_tck,
+            )
+        )
+    assert len(bundles["DWI"]) > 0
+    assert same_streamlines(bundles["FS"], bundles["DWI"])
+
+    # A sub-bundle of the DWI-space tractogram can be read from the FS-space one
+    indices = np.array([0, 7, 499])
+    virtual_file = rebase_virtual_tck(
+        save_virtual_tck(tck_file, indices, op.join(tmp_path, "fsub_selection.npz")),
+        tck_file_fs,
+        op.join(tmp_path, "fsub_space-FS_selection.npz"),
+    )
+    assert same_streamlines(
+        list(load_virtual_streamlines(virtual_file)),
+        [streamlines_fs[i] for i in indices],
+    )
+
+
+def test_itk_to_mrtrix_xfm(tmp_path):
+    from scipy.io import savemat
+    from fsub_extractor.utils.anat_utils import convert_to_mrtrix_reg, itk_to_mrtrix_xfm
+
+    # 90 degree rotation about z, scaling, about a centre, then a translation (all in LPS)
+    matrix = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1.5]])
+    translation = np.array([1, 2, 3])
+    centre = np.array([10, -20, 5])
+    txt_file = op.join(tmp_path, "reg.txt")
+    with open(txt_file, "w") as f:
+        f.write("#Insight Transform File V1.0\n#Transform 0\n")
+        f.write("Transform: MatrixOffsetTransformBase_double_3_3\n")
+        f.write(
+            "Parameters: " + " ".join(map(str, [*matrix.ravel(), *translation])) + "\n"
+        )
+        f.write("FixedParameters: " + " ".join(map(str, centre)) + "\n")
+    mat_file = op.join(tmp_path, "reg.mat")
+    savemat(
+        mat_file,
+        {
+            "AffineTransform_double_3_3": np.concatenate([matrix.ravel(), translation])[
+                :, None
+            ],
+            "fixed": centre[:, None].astype(np.float64),
+        },
+    )
+
+    def itk_apply(ras_points):
+        lps_points = ras_points * [-1, -1, 1]
+        mapped = (lps_points - centre) @ matrix.T + centre + translation
+        return mapped * [-1, -1, 1]
+
+    points = np.random.default_rng(0).normal(0, 30, (20, 3))
+    for reg_file in [txt_file, mat_file]:
+        xfm = itk_to_mrtrix_xfm(reg_file)
+        assert np.allclose(points @ xfm[:3, :3].T + xfm[:3, 3], itk_apply(points))
+
+    # The converted file is reused while the registration is unchanged
+    mrtrix_file = op.join(tmp_path, "reg_mrtrix.txt")
+    convert_to_mrtrix_reg(txt_file, mrtrix_file)
+    assert np.allclose(np.loadtxt(mrtrix_file), itk_to_mrtrix_xfm(txt_file))
+    modified_time = op.getmtime(mrtrix_file)
+    convert_to_mrtrix_reg(txt_file, mrtrix_file, overwrite=False)
+    assert op.getmtime(mrtrix_file) == modified_time
+
+
+def test_projection_operator_from_mesh():
+    from fsub_extractor.utils.froi_utils import projection_operator_from_mesh
+
+    # Octahedron around voxel (10, 10, 10), with outward normals along the axes
+    vertices = np.array(
+        [
+            [14, 10, 10],
+            [6, 10, 10],
+            [10, 14, 10],
+            [10, 6, 10],
+            [10, 10, 14],
+            [10, 10, 6],
+        ],
+        dtype=np.float64,
+    )
+    faces = np.array(
+        [
+            [0, 2, 4],
+            [2, 1, 4],
+            [1, 3, 4],
+            [3, 0, 4],
+            [2, 0, 5],
+            [1, 2, 5],
+            [3, 1, 5],
+            [0, 3, 5],
+        ]
+    )
+    # Vertex 0 stays in its voxel, and vertex 1 reaches past the centre into vertex 0's voxel
+    thickness = np.array([0.4, 8, 2, 2, 2, 2])
+    shape = (20, 20, 20)
+    operator = projection_operator_from_mesh(
+        vertices, faces, thickness, np.eye(4), shape, ["-1", "0", "0.5"]
+    )
+
+    expected = {
+        # Vertex 0 writes its voxel last (at fraction 0), after vertex 1 (at fraction -1)
+        (14, 10, 10): 0,
+        (10, 10, 10): 1,
+        (6, 10, 10): 1,
+        (10, 12, 10): 2,
+        (10, 13, 10): 2,
+        (10, 14, 10): 2,
+        (10, 8, 10): 3,
+        (10, 7, 10): 3,
+        (10, 6, 10): 3,
+        (10, 10, 12): 4,
+        (10, 10, 13): 4,
+        (10, 10, 14): 4,
+        (10, 10, 8): 5,
+        (10, 10, 7): 5,
+        (10, 10, 6): 5,
+    }
+    operator = operator.tocoo()
+    assert np.all(operator.data == 1)
+    assert {
+        tuple(np.unravel_index(voxel, shape)): vertex
+        for vertex, voxel in zip(operator.row, operator.col)
+    } == expected
+    assert operator.nnz == len(expected)
+
+
+def test_project_rois_batch(tmp_path, monkeypatch):
+    import os
+    import nibabel as nib
+    from scipy import sparse
+    from fsub_extractor.utils import froi_utils
+
+    fs_dir = op.join(tmp_path, "fs")
+    os.makedirs(op.join(fs_dir, "sub-01", "mri"))
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nib.save(
+        nib.MGHImage(np.zeros((4, 4, 4), dtype=np.float32), affine),
+        op.join(fs_dir, "sub-01", "mri", "orig.mgz"),
+    )
+
+    # Each hemisphere has 6 vertices, and vertex i fills voxel i (lh) or voxel i + 5 (rh), so voxel 5 is in both
+    n_vertices = 6
+
+    def fake_get_projection_operator(fs_dir, subject, hemi, projfrac_params, **kwargs):
+        first_voxel = 0 if hemi == "lh" else 5
+        return sparse.csr_matrix(
+            (
+                np.ones(n_vertices),
+                (np.arange(n_vertices), np.arange(n_vertices) + first_voxel),
+            ),
+            shape=(n_vertices, 64),
+        )
+
+    monkeypatch.setattr(
+        froi_utils, "get_projection_operator", fake_get_projection_operator
+    )
+
+    def save_surface_roi(name, vertices):
+        values = np.zeros((n_vertices, 1, 1), dtype=np.float32)
+        values[vertices] = 1
+        roi_file = op.join(tmp_path, f"{name}.mgz")
+        nib.save(nib.MGHImage(values, np.eye(4)), roi_file)
+        return roi_file
+
+    rois = {
+        # B is listed later, so it takes vertex 1 from A
+        "lh": [save_surface_roi("lh.A", [0, 1]), save_surface_roi("lh.B", [1, 2, 5])],
+        "rh": [save_surface_roi("rh.C_1", [0, 3])],
+    }
+    dseg_out, dseg_table_out = froi_utils.project_rois_batch(
+        rois, fs_dir, "sub-01", str(tmp_path), "test", save_masks=True
+    )
+
+    # Labels are consecutive across hemispheres, and the left hemisphere wins where they overlap
+    expected = np.zeros(64, dtype=np.int32)
+    expected[[0, 1, 2, 5, 8]] = [1, 2, 2, 2, 3]
+    dseg_img = nib.load(dseg_out)
+    assert np.allclose(dseg_img.affine, affine)
+    assert np.array_equal(np.asarray(dseg_img.dataobj).ravel(), expected)
+    with open(dseg_table_out) as f:
+        assert f.read() == "index\tname\themi\n1\tA\tlh\n2\tB\tlh\n3\tC1\trh\n"
+    for label, name in enumerate(["A", "B", "C1"], start=1):
+        mask = nib.load(
+            op.join(tmp_path, f"sub-01_rec-surf2vol_space-FS_desc-{name}.nii.gz")
+        ).get_fdata()
+        assert np.array_equal(mask.ravel(), expected == label)
+
+    with pytest.raises(Exception, match="operator"):
+        froi_utils.project_rois_batch(
+            rois,
+            fs_dir,
+            "sub-01",
+            str(tmp_path),
+            "test",
+            projection_backend="freesurfer",
+        )
+
+
+def test_roi(tmp_path):
+    from fsub_extractor.utils.froi_utils import ROI
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -10
+    data = np.zeros((10, 10, 10))
+    data[1:4, 1:4, 1:4] = 1
+    data[3:6, 3:6, 3:6] = 2
+    data[8, 8, 8] = 3
+    roi = ROI.from_array(data, affine, labelled=True)
+
+    assert len(roi) == np.count_nonzero(data)
+    assert np.array_equal(roi.to_array(), data)
+    assert np.array_equal(roi.voxels(), np.argwhere(data))
+    assert sorted(np.unique(roi.labels)) == [1, 2, 3]
+
+    roi_file = roi.to_nifti(op.join(tmp_path, "roi.nii.gz"))
+    assert np.array_equal(ROI.from_nifti(roi_file, labelled=True).to_array(), data)
+    assert np.array_equal(ROI.from_nifti(roi_file).to_array(), data > 0)
+
+    # Dense equivalents of the set operations
+    roi_1 = roi.select_labels([1])
+    roi_2 = roi.select_labels([2, 3])
+    assert np.array_equal(roi_1.to_array() > 0, data == 1)
+    assert np.array_equal(roi_2.to_array() > 0, data >= 2)
+
+    block = np.zeros(data.shape)
+    block[2:5, 2:5, 2:5] = 7
+    other = ROI.from_array(block, affine, labelled=True)
+    assert np.array_equal(roi.union(other).to_array(), np.where(data > 0, data, block))
+    assert np.array_equal(
+        roi.intersection(other).to_array(), np.where(block > 0, data, 0)
+    )
+    assert np.array_equal(
+        roi.difference(other).to_array(), np.where(block > 0, 0, data)
+    )
+    assert np.array_equal(roi.relabel(5).to_array(), 5 * (data > 0))
+
+    voxels = np.array(
+        [[1, 1, 1], [4, 4, 4], [8, 8, 8], [0, 0, 0], [-1, 2, 2], [10, 0, 0]]
+    )
+    assert np.array_equal(roi.lookup_voxels(voxels), [1, 2, 3, 0, 0, 0])
+    points = voxels * 2.0 - 10 + 0.4
+    assert np.array_equal(roi.lookup_points(points), [1, 2, 3, 0, 0, 0])
+
+    with pytest.raises(Exception):
+        roi.union(ROI.from_array(block, np.eye(4)))
+
+
+def test_extract_connectome_weights(tmp_path):
+    from fsub_extractor.utils.streamline_utils import (
+        extract_connectome,
+        read_assignments,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    edge_files = extract_connectome(
+        tck_file,
+        rois_file,
+        op.join(tmp_path, "sub"),
+        sift2_weights=weights_file,
+        include_self=True,
+        search_type="radial",
+        search_dist=3.0,
+    )
+    assignments = np.sort(
+        read_assignments(op.join(tmp_path, "sub_desc-assignments.txt")), axis=1
+    )
+    weights = np.loadtxt(weights_file)
+
+    assert len(edge_files) > 1
+    for (node_1, node_2), edge_file in edge_files.items():
+        in_edge = np.flatnonzero(
+            (assignments[:, 0] == node_1) & (assignments[:, 1] == node_2)
+        )
+        assert same_streamlines(
+            load_streamlines(edge_file), [streamlines[i] for i in in_edge]
+        )
+        edge_weights = np.loadtxt(
+            edge_file.replace("_desc-fsub.tck", "_desc-fsubSIFT2weights.csv"),
+            ndmin=1,
+        )
+        assert np.allclose(edge_weights, weights[in_edge])
+
+
+@pytest.mark.parametrize("invert", [False, True])
+def test_resample_roi_once(tmp_path, invert):
+    import nibabel as nib
+    from scipy.ndimage import affine_transform
+    from fsub_extractor.utils.froi_utils import resample_roi_once
+
+    # 1 mm ROI grid in FS space, and an oblique 2 mm GMWMI grid in DWI space
+    roi_affine = np.eye(4)
+    roi_affine[:3, 3] = -20
+    roi = np.zeros((40, 40, 40), dtype=np.float32)
+    roi[12:20, 15:25, 18:22] = 1
+    roi_file = op.join(tmp_path, "sub_space-FS_desc-roi.nii.gz")
+    nib.save(nib.Nifti1Image(roi, roi_affine), roi_file)
+
+    gmwmi_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    gmwmi_affine[:3, 3] = [-21.3, -19.6, -20.2]
+    gmwmi = (np.random.default_rng(0).random((20, 20, 20)) > 0.3).astype(np.float32)
+    gmwmi_file = op.join(tmp_path, "gmwmi.nii.gz")
+    nib.save(nib.Nifti1Image(gmwmi, gmwmi_affine), gmwmi_file)
+
+    # DWI-to-FS transform (mrtransform -linear convention), a small rotation and shift
+    angle = 0.1
+    xfm = np.array(
+        [
+            [np.cos(angle), -np.sin(angle), 0, 1.3],
+            [np.sin(angle), np.cos(angle), 0, -2.2],
+            [0, 0, 1, 0.7],
+            [0, 0, 0, 1],
+        ]
+    )
+    xfm_file = op.join(tmp_path, "xfm.txt")
+    np.savetxt(xfm_file, np.linalg.inv(xfm) if invert else xfm)
+
+    roi_out = resample_roi_once(
+        roi_file,
+        "roi",
+        op.join(tmp_path, "sub"),
+        mrtrix_xfm=xfm_file,
+        invert=invert,
+        gmwmi=gmwmi_file,
+    )
+
+    # Nearest-neighbour resampling of the ROI onto the GMWMI grid, masked by the GMWMI
+    expected = (
+        affine_transform(
+            roi,
+            np.linalg.inv(roi_affine) @ xfm @ gmwmi_affine,
+            output_shape=gmwmi.shape,
+            order=0,
+        )
+        * gmwmi
+    )
+    out_img = nib.load(roi_out)
+    assert np.allclose(out_img.affine, gmwmi_affine)
+    assert np.count_nonzero(expected) > 0
+    assert np.array_equal(out_img.get_fdata(), expected)
+
+    # Without a target grid, only the header moves
+    roi_moved = resample_roi_once(
+        roi_file, "roi", op.join(tmp_path, "sub"), mrtrix_xfm=xfm_file, invert=invert
+    )
+    moved_img = nib.load(roi_moved)
+    assert op.basename(roi_moved) == "sub_space-DWI_desc-roi.nii.gz"
+    assert np.array_equal(moved_img.get_fdata(), roi)
+    assert np.allclose(moved_img.affine, np.linalg.inv(xfm) @ roi_affine)
+
+
+def test_bbox_cropping(tmp_path):
+    import nibabel as nib
+    from fsub_extractor.utils.froi_utils import (
+        bbox_offset,
+        mask_bbox,
+        merge_rois,
+        transform_bbox,
+        union_bbox,
+    )
+
+    roi1 = np.zeros((20, 20, 20), dtype=np.float32)
+    roi1[0:3, 5:8, 10:12] = 1
+    roi2 = np.zeros_like(roi1)
+    roi2[15:20, 2:4, 6:9] = 1
+
+    # The margin is clipped to the grid, and empty masks have no bounding box
+    assert mask_bbox(roi1) == (slice(0, 4), slice(4, 9), slice(9, 13))
+    assert mask_bbox(roi2, margin=0) == (slice(15, 20), slice(2, 4), slice(6, 9))
+    assert mask_bbox(np.zeros_like(roi1)) == None
+    bbox = union_bbox([mask_bbox(roi1), None, mask_bbox(roi2)])
+    assert bbox == (slice(0, 20), slice(1, 9), slice(5, 13))
+    assert union_bbox([None]) == None
+    assert np.array_equal(bbox_offset(bbox), [0, 1, 5])
+
+    # Every target voxel whose nearest source voxel is in the box lies in the transformed box
+    rng = np.random.default_rng(0)
+    shape = (30, 25, 20)
+    for _ in range(5):
+        vox2vox = np.eye(4)
+        vox2vox[:3, :3] = rng.normal(0, 0.2, (3, 3)) + np.diag([1.3, 0.8, 1.1])
+        vox2vox[:3, 3] = rng.normal(0, 2, 3)
+        source_bbox = mask_bbox(roi1, margin=0)
+        target_bbox = transform_bbox(source_bbox, vox2vox, shape)
+        target_voxels = np.argwhere(np.ones(shape, dtype=bool))
+        source_voxels = np.rint(
+            nib.affines.apply_affine(np.linalg.inv(vox2vox), target_voxels)
+        )
+        in_source = np.all(
+            (source_voxels >= bbox_offset(source_bbox))
+            & (source_voxels < [axis.stop for axis in source_bbox]),
+            axis=1,
+        )
+        in_target = np.zeros(shape, dtype=bool)
+        in_target[target_bbox] = True
+        assert in_source.any()
+        assert np.all(in_target[tuple(target_voxels[in_source].T)])
+    # A box moved off the target grid has no bounding box there
+    shift = np.eye(4)
+    shift[:3, 3] = 100
+    assert transform_bbox(mask_bbox(roi1), shift, shape) == None
+
+    # Merging within the bounding box matches merging the whole grid
+    affine = np.diag([1.5, 1.5, 1.5, 1])
+    roi_files = []
+    for n, roi in enumerate([roi1, roi2], start=1):
+        roi_files += [op.join(tmp_path, f"roi{n}.nii.gz")]
+        nib.save(nib.Nifti1Image(roi, affine), roi_files[-1])
+    merged = nib.load(merge_rois(*roi_files, op.join(tmp_path, "merged.nii.gz")))
+    assert np.allclose(merged.affine, affine)
+    assert np.array_equal(merged.get_fdata(), roi1 + 2 * roi2)
+
+    nib.save(nib.Nifti1Image(roi2, affine * 2), roi_files[1])
+    with pytest.raises(Exception, match="same voxel grid"):
+        merge_rois(*roi_files, op.join(tmp_path, "merged.nii.gz"))
+
+
+def test_generate_tck_top_up(tmp_path, fake_tckgen):
+    import os
+    from fsub_extractor.utils.streamline_utils import generate_tck_mrtrix
+    from fsub_extractor.utils.system_utils import load_json
+
+    inputs, read_log = fake_tckgen
+    outfile = op.join(tmp_path, "fsub.tck")
+    sidecar = op.join(tmp_path, "fsub.json")
+    generate_tck_mrtrix(n_streamlines=40, outfile=outfile, seed=7, **inputs)
+    first = load_streamlines(outfile)
+    first_seeds = load_json(sidecar)["RandomSeeds"]
+    assert len(first) == 40 and first_seeds == [7]
+
+    # A larger request tops up the output in place, even without overwrite, and never reuses a seed
+    os.utime(inputs["wmfod"], ns=(0, 0))
+    generate_tck_mrtrix(
+        n_streamlines=100, outfile=outfile, n_shards=2, overwrite=False, **inputs
+    )
+    topped_up = load_streamlines(outfile)
+    info = load_json(sidecar)
+    assert len(topped_up) == 100
+    assert same_streamlines(topped_up[:40], first)
+    assert info["Count"] == 100
+    assert len(info["RandomSeeds"]) == 3
+    assert len(set(info["RandomSeeds"])) == 3
+    assert set(generated_seeds(outfile)) == set(info["RandomSeeds"])
+    assert len(read_log()) == 3
+
+    # The same request is reused
+    generate_tck_mrtrix(n_streamlines=100, outfile=outfile, overwrite=False, **inputs)
+    assert len(read_log()) == 3
+
+    # A changed input starts again
+    with open(inputs["wmfod"], "w") as f:
+        f.write("changed")
+    with pytest.raises(Exception):
+        generate_tck_mrtrix(
+            n_streamlines=120, outfile=outfile, overwrite=False, **inputs
+        )
+    generate_tck_mrtrix(n_streamlines=120, outfile=outfile, seed=7, **inputs)
+    assert load_json(sidecar)["RandomSeeds"] == [7]
+    assert len(load_streamlines(outfile)) == 120
+
+
+def test_sweep_shares_stages(tmp_path, monkeypatch):
+    import os
+    import nibabel as nib
+    from fsub_extractor.functions import extractor as extractor_module
+    from fsub_extractor.functions.sweep import extractor_sweep
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    rois_img = nib.load(rois_file)
+    roi_files = []
+    for label in [1, 2]:
+        roi_files += [op.join(tmp_path, f"roi{label}.nii.gz")]
+        roi = (rois_img.get_fdata() == label).astype(np.float32)
+        nib.save(nib.Nifti1Image(roi, rois_img.affine), roi_files[-1])
+    fs_dir = op.join(tmp_path, "fs")
+    os.makedirs(op.join(fs_dir, "sub-01", "surf"))
+    open(op.join(fs_dir, "sub-01", "surf", "lh.white"), "w").close()
+    reg_file = op.join(tmp_path, "dwi2fs.txt")
+    with open(reg_file, "w") as f:
+        f.write("#Insight Transform File V1.0\n#Transform 0\n")
+        f.write("Transform: MatrixOffsetTransformBase_double_3_3\n")
+        f.write("Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\nFixedParameters: 0 0 0\n")
+
+    # Stand-ins for the FreeSurfer and MRtrix stages, which count their runs
+    calls = {"anat_to_gmwmi": [], "project_roi": [], "convert_reg": 0}
+
+    def fake_anat_to_gmwmi(anat, outdir, subject, threshold=0, fivett=None, **kwargs):
+        calls["anat_to_gmwmi"] += [(threshold, fivett)]
+        outputs = [
+            op.join(outdir, f"{subject}_space-FS_{desc}.nii.gz")
+            for desc in ["desc-5tt", "desc-gmwmi", "rec-binarized_desc-gmwmi"]
+        ]
+        for output in outputs:
+            nib.save(
+                nib.Nifti1Image(np.ones(rois_img.shape, np.float32), rois_img.affine),
+                output,
+            )
+        return tuple(outputs)
+
+    def fake_project_roi(roi_in, roi_name, fs_dir, subject, hemi, outdir, **kwargs):
+        calls["project_roi"] += [(roi_name, tuple(kwargs["projfrac_params"]))]
+        roi_projected = op.join(
+            outdir, f"{subject}_rec-surf2vol_space-FS_desc-{roi_name}.nii.gz"
+        )
+        shutil.copy(roi_in, roi_projected)
+        return roi_projected
+
+    convert_to_mrtrix_reg = extractor_module.convert_to_mrtrix_reg
+
+    def counted_convert_to_mrtrix_reg(*args, **kwargs):
+        calls["convert_reg"] += 1
+        return convert_to_mrtrix_reg(*args, **kwargs)
+
+    monkeypatch.setattr(extractor_module, "anat_to_gmwmi", fake_anat_to_gmwmi)
+    monkeypatch.setattr(extractor_module, "project_roi", fake_project_roi)
+    monkeypatch.setattr(
+        extractor_module, "convert_to_mrtrix_reg", counted_convert_to_mrtrix_reg
+    )
+
+    args = get_parser().parse_args(
+        ["--subject", "sub-01", "--tract", tck_file, "--hemi", "lh"]
+        + ["--roi1", roi_files[0], "--roi2", roi_files[1], "--fs-dir", fs_dir]
+        + ["--dwi2fs", reg_file, "--reg-type", "itk", "--extraction-space", "FS"]
+        + ["--roi-resampling", "composed", "--native-extraction"]
+        + ["--native-assignment", "--gmwmi-thresh", "0.1", "0.5"]
+        + ["--projfrac-params=-1,0,0.05;-0.5,0,0.05"]
+        + ["--out-dir", op.join(tmp_path, "out")]
+    )
+    sweep_dirs = extractor_sweep(**vars(args))
+
+    # 2 thresholds x 2 projfrac parameters, with each stage run once per value it depends on
+    assert len(sweep_dirs) == 4
+    assert calls["convert_reg"] == 1
+    assert [thresh for thresh, fivett in calls["anat_to_gmwmi"]] == [0.1, 0.5]
+    # The 5TT of the first threshold is reused by the second
+    assert calls["anat_to_gmwmi"][1][1] == op.join(
+        sweep_dirs[0], "sub-01", "anat", "sub-01_space-FS_desc-5tt.nii.gz"
+    )
+    assert sorted(calls["project_roi"]) == sorted(
+        (name, projfrac)
+        for name in ["roi1", "roi2"]
+        for projfrac in [("-1", "0", "0.05"), ("-0.5", "0", "0.05")]
+    )
+
+    # Every combination still extracted its own sub-bundle, from ROIs intersected with its own GMWMI
+    for sweep_dir in sweep_dirs:
+        dwi_dir = op.join(sweep_dir, "sub-01", "dwi")
+        assert len(glob.glob(op.join(dwi_dir, "*_desc-fsub*.tck"))) == 1
+
+
+def test_native_masking(tmp_path):
+    import nibabel as nib
+    from fsub_extractor.utils.streamline_utils import (
+        extract_tck_mrtrix,
+        read_assignments,
+    )
+
+    tck_file, rois_file, weights_file, streamlines = make_tractogram(tmp_path)
+    rois_img = nib.load(rois_file)
+    affine = rois_img.affine
+    masks = {}
+    for name, box in [
+        ("exclude", (slice(18, 22), slice(0, 40), slice(0, 40))),
+        ("include", (slice(0, 40), slice(10, 30), slice(5, 25))),
+        ("streamline", (slice(2, 38), slice(2, 38), slice(2, 38))),
+    ]:
+        mask = np.zeros(rois_img.shape, dtype=np.float32)
+        mask[box] = 1
+        masks[name] = op.join(tmp_path, f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(mask, affine), masks[name])
+
+    def inside(points, name):
+        mask = nib.load(masks[name]).get_fdata() > 0
+        voxels = np.rint(nib.affines.apply_affine(np.linalg.inv(affine), points))
+        voxels = voxels.astype(int)
+        in_grid = np.all((voxels >= 0) & (voxels < mask.shape), axis=1)
+        return in_grid & mask[tuple(np.clip(voxels, 0, 39).T)]
+
+    def extract(name, **mask_args):
+        outpath_base = op.join(tmp_path, name)
+        fsub = extract_tck_mrtrix(
+            tck_file,
+            rois_file,
+            outpath_base,
+            True,
+            sift2_weights=weights_file,
+            native=True,
+            native_assignment=True,
+            **mask_args,
+        )
+        assignments = np.sort(
+            read_assignments(outpath_base + "_desc-assignments.txt"), axis=1
+        )
+        return fsub, np.flatnonzero(np.all(assignments == [1, 2], axis=1))
+
+    # Reference tckedit: truncate at the first point leaving the streamline mask, then include / exclude
+    fsub, selected = extract(
+        "masked",
+        exclude_mask=masks["exclude"],
+        include_mask=masks["include"],
+        streamline_mask=masks["streamline"],
+    )
+    weights = np.loadtxt(weights_file)
+    expected = []
+    expected_weights = []
+    for i in selected:
+        streamline = streamlines[i]
+        outside = np.flatnonzero(~inside(streamline, "streamline"))
+        if len(outside) > 0:
+            streamline = streamline[: outside[0]]
+        if (
+            len(streamline) > 0
+            and np.any(inside(streamline, "include"))
+            and not np.any(inside(streamline, "exclude"))
+        ):
+            expected += [streamline]
+            expected_weights += [weights[i]]
+    assert op.basename(fsub) == "masked_desc-fsub_desc-masked.tck"
+    assert len(expected) > 0 and len(expected) < len(selected)
+    assert same_streamlines(load_streamlines(fsub), expected)
+    assert np.allclose(
+        np.loadtxt(
+            fsub.replace(
+                "_desc-fsub_desc-masked.tck", "desc-fsubSIFT2weights_desc-masked.csv"
+            )
+        ),
+        expected_weights,
+    )
+
+    # Like tckedit, a streamline mask alone is not applied
+    with pytest.warns(UserWarning):
+        fsub, selected = extract("streamline", streamline_mask=masks["streamline"])
+    assert op.basename(fsub) == "streamline_desc-fsub.tck"
+    assert same_streamlines(load_streamlines(fsub), [streamlines[i] for i in selected])
+
+
+@pytest.mark.parametrize("nthreads", [None, 6])
+def test_run_tckgen_shards(tmp_path, fake_tckgen, nthreads):
+    import os
+    from fsub_extractor.utils.streamline_utils import read_tck_header, run_tckgen
+
+    inputs, read_log = fake_tckgen
+    cmd_tckgen = ["tckgen", inputs["wmfod"], "-seeds", "0"]
+    outfile = op.join(tmp_path, "fsub.tck")
+    seeds = run_tckgen(cmd_tckgen, 100, outfile, n_shards=3, nthreads=nthreads, seed=5)
+
+    # Shard i is seeded with seed + i, selects its share, and gets its share of the threads
+    log = sorted(read_log(), key=lambda run: run["seed"])
+    assert seeds == [5, 6, 7]
+    assert [run["seed"] for run in log] == seeds
+    assert [int(run["args"][run["args"].index("-select") + 1]) for run in log] == [
+        34,
+        33,
+        33,
+    ]
+    shard_threads = max(1, (nthreads or os.cpu_count()) // 3)
+    for run in log:
+        assert run["args"][run["args"].index("-nthreads") + 1] == str(shard_threads)
+
+    # The merged file holds the shards in order, and sums their counts
+    header = read_tck_header(outfile)
+    assert int(header["count"]) == 100
+    assert int(header["total_count"]) == sum(run["attempts"] for run in log)
+    assert generated_seeds(outfile) == [5] * 34 + [6] * 33 + [7] * 33
+    assert glob.glob(op.join(tmp_path, "fsub_shard-*")) == []
+
+    # A seed cap is split across shards
+    read_log_before = len(read_log())
+    run_tckgen(cmd_tckgen, 100, outfile, n_shards=2, seed=5, max_seeds=40)
+    for run in read_log()[read_log_before:]:
+        assert run["args"][run["args"].index("-seeds") + 1] == "20"
+        assert run["attempts"] == 20
+    assert int(read_tck_header(outfile)["total_count"]) == 40
+
+
+def test_generate_tck_pilot(tmp_path, fake_tckgen):
+    from fsub_extractor.utils.streamline_utils import (
+        PILOT_SEED_MARGIN,
+        PILOT_ZERO_ACCEPTANCE_FACTOR,
+        generate_tck_mrtrix,
+        read_tck_header,
+    )
+    from fsub_extractor.utils.system_utils import load_json
+
+    inputs, read_log = fake_tckgen
+    outfile = op.join(tmp_path, "fsub.tck")
+    generate_tck_mrtrix(
+        n_streamlines=200,
+        outfile=outfile,
+        n_shards=2,
+        seed=3,
+        pilot_seeds=100,
+        **inputs,
+    )
+
+    # The pilot takes the first seed, and caps the main run from its acceptance rate
+    pilot, *shards = read_log()
+    info = load_json(op.join(tmp_path, "fsub.json"))
+    budget = info["Budget"]
+    assert pilot["seed"] == 3 and sorted(run["seed"] for run in shards) == [4, 5]
+    assert pilot["args"][pilot["args"].index("-seeds") + 1] == "100"
+    assert budget["PilotCount"] == pilot["count"]
+    assert budget["PilotAcceptanceRate"] == pilot["count"] / 100
+    assert budget["MaxSeeds"] == int(
+        np.ceil(
+            PILOT_SEED_MARGIN * np.ceil((200 - pilot["count"]) / (pilot["count"] / 100))
+        )
+    )
+    for run in shards:
+        assert int(run["args"][run["args"].index("-seeds") + 1]) == int(
+            np.ceil(budget["MaxSeeds"] / 2)
+        )
+        assert int(run["args"][run["args"].index("-select") + 1]) < 100
+
+    # The pilot's streamlines are kept, ahead of the main run's
+    header = read_tck_header(outfile)
+    assert int(header["count"]) == info["Count"] == 200
+    assert int(header["total_count"]) == sum(run["attempts"] for run in read_log())
+    assert info["RandomSeeds"] == [3, 4, 5]
+    assert generated_seeds(outfile)[: pilot["count"]] == [3] * pilot["count"]
+    assert glob.glob(op.join(tmp_path, "fsub_desc-*")) == []
+
+    # A pilot that accepts nothing still caps the main run
+    with pytest.warns(UserWarning) as record:
+        generate_tck_mrtrix(
+            n_streamlines=200,
+            outfile=op.join(tmp_path, "empty.tck"),
+            seed=0,
+            pilot_seeds=1,
+            **inputs,
+        )
+    messages = [str(warning.message) for warning in record]
+    assert any("No streamlines were accepted" in message for message in messages)
+    assert any("Only" in message for message in messages)
+    budget = load_json(op.join(tmp_path, "empty.json"))["Budget"]
+    assert budget["PilotCount"] == 0
+    assert budget["MaxSeeds"] == PILOT_ZERO_ACCEPTANCE_FACTOR
+
+
+def test_generate_tck_adaptive(tmp_path, fake_tckgen):
+    import nibabel as nib
+    from fsub_extractor.utils.streamline_utils import (
+        generate_tck_adaptive,
+        read_tck_header,
+    )
+    from fsub_extractor.utils.system_utils import load_json
+
+    # The fake tckgen ends streamlines uniformly in the 4x4x4 voxels of this grid
+    inputs, read_log = fake_tckgen
+    inputs["roi_begin"] = op.join(tmp_path, "roi_begin.nii.gz")
+    nib.save(
+        nib.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)), inputs["roi_begin"]
+    )
+
+    outfile = op.join(tmp_path, "fsub.tck")
+    generate_tck_adaptive(
+        n_streamlines=50000,
+        outfile=outfile,
+        increment=200,
+        tolerance=0.1,
+        seed=1,
+        **inputs,
+    )
+    info = load_json(op.join(tmp_path, "fsub.json"))
+    history = info["Convergence"]["History"]
+    errors = [step["Error"] for step in history]
+
+    # Generation stops at the first increment whose estimated error is below the tolerance
+    assert errors[-1] < 0.1 and all(error >= 0.1 for error in errors[:-1])
+    assert errors[0] > errors[-1]
+    assert history[-1]["Count"] == info["Count"] < 50000
+    assert [step["Count"] for step in history] == list(
+        range(400, info["Count"] + 1, 200)
+    )
+    header = read_tck_header(outfile)
+    assert int(header["count"]) == info["Count"]
+    assert int(header["total_count"]) == sum(run["attempts"] for run in read_log())
+
+    # Each increment has its own seed, and its streamlines are appended in order
+    seeds = generated_seeds(outfile)
+    assert info["RandomSeeds"] == list(range(1, 1 + len(history) + 1))
+    assert seeds == sorted(seeds) and set(seeds) == set(info["RandomSeeds"])
+    assert op.exists(op.join(tmp_path, "fsub_desc-increment.tck")) == False
+
+    # Without a reachable tolerance, generation runs to n_streamlines
+    generate_tck_adaptive(
+        n_streamlines=1000,
+        outfile=op.join(tmp_path, "full.tck"),
+        increment=300,
+        tolerance=0,
+        **inputs,
+    )
+    info = load_json(op.join(tmp_path, "full.json"))
+    assert info["Count"] == 1000
+    assert [step["Count"] for step in info["Convergence"]["History"]] == [
+        600,
+        900,
+        1000,
+    ]